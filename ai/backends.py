@@ -0,0 +1,377 @@
+"""
+CPU inference backends for the classifier (and the CLIP vision tower).
+
+    CLASSIFIER_BACKEND = eager | channels_last | jit | compile | bf16 | int8
+    CLIP_BACKEND       = eager | compile | bf16 | int8
+
+eager          stock fp32
+channels_last  fp32, NHWC weights/inputs (faster oneDNN convolutions)
+jit            channels_last + TorchScript trace + freeze (folds BN into convs)
+compile        channels_last + torch.compile (falls back to jit on old torch)
+bf16           channels_last + bfloat16 autocast; eager if the CPU has no bf16 support
+int8           ResNet: FX static quantization calibrated on dataset images;
+               CLIP: dynamic int8 quantization of the transformer's Linear layers
+
+A backend that cannot be built here falls back to eager with a log line; the
+active one is exposed as `model.backend_name`.
+
+Accuracy check against the fp32 baseline (folder of <class_name>/*.jpg):
+
+    python -m ai.backends --val-dir path/to/val --backends eager,jit,bf16,int8 --limit 500
+
+CLIP backends: embedding cosine drift and top-k retrieval agreement against fp32.
+Indexes, centroids and result-cache entries are tied to the CLIP backend; after
+switching it, run `python build_indexes.py` to re-embed the indexes offline:
+
+    python -m ai.backends --val-dir path/to/val --clip-backends eager,bf16,int8 --limit 500
+
+CLIP preprocessing (decode_image + clip_tensor) against the stock CLIPProcessor:
+
+    python -m ai.backends --val-dir path/to/val --clip-preprocess --limit 200
+"""
+import argparse
+import contextlib
+import copy
+import os
+import random
+import time
+from pathlib import Path
+from typing import List, Optional
+
+import torch
+import torch.nn as nn
+
+CLASSIFIER_BACKEND = os.environ.get("CLASSIFIER_BACKEND", "eager")
+CLIP_BACKEND = os.environ.get("CLIP_BACKEND", "eager")
+# images used to calibrate int8 activation ranges (default: sampled from the dataset)
+CALIBRATION_DIR = os.environ.get("INT8_CALIBRATION_DIR")
+CALIBRATION_IMAGES = int(os.environ.get("INT8_CALIBRATION_IMAGES", "64"))
+
+CLASSIFIER_BACKENDS = ("eager", "channels_last", "jit", "compile", "bf16", "int8")
+CLIP_BACKENDS = ("eager", "compile", "bf16", "int8")
+
+
+def bf16_supported() -> bool:
+    try:
+        return bool(torch.ops.mkldnn._is_mkldnn_bf16_supported())
+    except Exception:
+        return False
+
+
+class InferenceModel(nn.Module):
+    """Wraps a prepared classifier: converts the input layout and autocasts; returns fp32 logits."""
+
+    def __init__(self, model, backend_name: str, channels_last: bool = False, bf16: bool = False):
+        super().__init__()
+        self.model = model
+        self.backend_name = backend_name
+        self.channels_last = channels_last
+        self.bf16 = bf16
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        if self.channels_last:
+            x = x.contiguous(memory_format=torch.channels_last)
+        with autocast(self):
+            out = self.model(x)
+        return out.float()
+
+
+def autocast(model):
+    """bf16 autocast context for models prepared with the bf16 backend, else a no-op."""
+    if getattr(model, "bf16", False):
+        return torch.autocast("cpu", dtype=torch.bfloat16)
+    return contextlib.nullcontext()
+
+
+def _example() -> torch.Tensor:
+    return torch.zeros(1, 3, 224, 224)
+
+
+def _calibration_batches(n: int = CALIBRATION_IMAGES, batch_size: int = 16) -> List[torch.Tensor]:
+    """ResNet-preprocessed tensors from CALIBRATION_DIR or a sample of the dataset."""
+    from .utils import load_image
+
+    if CALIBRATION_DIR:
+        files = [p for p in Path(CALIBRATION_DIR).rglob("*") if p.suffix.lower() in {".jpg", ".jpeg", ".png"}]
+    else:
+        from .dataset_manifest import all_classes, class_files
+
+        files = [p for c in all_classes() for p, _, _ in class_files(c)[:4]]
+    random.Random(0).shuffle(files)
+    xs = []
+    for f in files[:n]:
+        try:
+            xs.append(load_image(f))
+        except Exception:
+            continue
+    if not xs:
+        print("[BACKEND] No calibration images found; calibrating on noise")
+        xs = [torch.rand(1, 3, 224, 224) for _ in range(8)]
+    return [torch.cat(xs[i:i + batch_size]) for i in range(0, len(xs), batch_size)]
+
+
+def _int8_classifier(model: nn.Module) -> nn.Module:
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    torch.backends.quantized.engine = "x86" if "x86" in torch.backends.quantized.supported_engines else "fbgemm"
+    qconfig = get_default_qconfig_mapping(torch.backends.quantized.engine)
+    prepared = prepare_fx(copy.deepcopy(model).eval(), qconfig, example_inputs=(_example(),))
+    with torch.no_grad():
+        for batch in _calibration_batches():
+            prepared(batch)
+    return convert_fx(prepared)
+
+
+def _jit(model: nn.Module) -> nn.Module:
+    with torch.no_grad():
+        traced = torch.jit.trace(model, _example().contiguous(memory_format=torch.channels_last))
+    return torch.jit.freeze(traced.eval())
+
+
+def prepare_classifier(model: nn.Module, backend: Optional[str] = None) -> InferenceModel:
+    """fp32 eval-mode CNN -> InferenceModel running on the requested backend."""
+    backend = backend or CLASSIFIER_BACKEND
+    model = model.eval()
+    if backend != "eager" and next(model.parameters()).is_cuda:
+        print(f"[BACKEND] {backend} is a CPU backend; using eager on CUDA")
+        backend = "eager"
+    try:
+        if backend == "eager":
+            return InferenceModel(model, "eager")
+        if backend == "int8":
+            return InferenceModel(_int8_classifier(model), "int8")
+
+        model = model.to(memory_format=torch.channels_last)
+        if backend == "channels_last":
+            return InferenceModel(model, backend, channels_last=True)
+        if backend == "jit":
+            return InferenceModel(_jit(model), backend, channels_last=True)
+        if backend == "compile":
+            if hasattr(torch, "compile"):
+                compiled = torch.compile(model)
+                with torch.no_grad():
+                    # compilation happens on the first call: fail here, not inside a request
+                    compiled(_example().contiguous(memory_format=torch.channels_last))
+                return InferenceModel(compiled, backend, channels_last=True)
+            print("[BACKEND] torch.compile unavailable; using jit")
+            return InferenceModel(_jit(model), "jit", channels_last=True)
+        if backend == "bf16":
+            if bf16_supported():
+                return InferenceModel(model, backend, channels_last=True, bf16=True)
+            print("[BACKEND] CPU has no bf16 support; using channels_last fp32")
+            return InferenceModel(model, "channels_last", channels_last=True)
+        raise ValueError(f"Unknown classifier backend '{backend}' (choose from {CLASSIFIER_BACKENDS})")
+    except ValueError:
+        raise
+    except Exception as exc:
+        print(f"[BACKEND] {backend} failed ({exc}); falling back to eager")
+        return InferenceModel(model.to(memory_format=torch.contiguous_format), "eager")
+
+
+def prepare_clip(model, backend: Optional[str] = None):
+    """Apply a backend to a CLIPModel's vision side in place; sets model.backend_name / model.bf16."""
+    backend = backend or CLIP_BACKEND
+    model.backend_name = "eager"
+    model.bf16 = False
+    if backend != "eager" and next(model.parameters()).is_cuda:
+        print(f"[BACKEND] {backend} is a CPU backend; CLIP stays eager on CUDA")
+        return model
+    vision_model = model.vision_model
+    try:
+        if backend == "eager":
+            pass
+        elif backend == "int8":
+            model.vision_model = torch.ao.quantization.quantize_dynamic(
+                model.vision_model, {nn.Linear}, dtype=torch.qint8
+            )
+            model.backend_name = "int8"
+        elif backend == "bf16":
+            if bf16_supported():
+                model.bf16 = True
+                model.backend_name = "bf16"
+            else:
+                print("[BACKEND] CPU has no bf16 support; CLIP stays fp32")
+        elif backend == "compile":
+            if hasattr(torch, "compile"):
+                model.vision_model = torch.compile(model.vision_model)
+                with torch.no_grad():
+                    # compilation happens on the first call: fail here, not inside the batcher
+                    model.get_image_features(pixel_values=_example())
+                model.backend_name = "compile"
+            else:
+                print("[BACKEND] torch.compile unavailable; CLIP stays eager")
+        else:
+            raise ValueError(f"Unknown CLIP backend '{backend}' (choose from {CLIP_BACKENDS})")
+    except ValueError:
+        raise
+    except Exception as exc:
+        print(f"[BACKEND] CLIP {backend} failed ({exc}); using eager")
+        model.vision_model = vision_model
+        model.backend_name = "eager"
+        model.bf16 = False
+    return model
+
+
+# ==== ACCURACY CHECK ====
+def _val_set(val_dir: Path, limit: int):
+    from .image_model import class_to_idx
+
+    items = []
+    for class_dir in sorted(p for p in val_dir.iterdir() if p.is_dir()):
+        label = class_to_idx.get(class_dir.name)
+        for f in sorted(class_dir.rglob("*")):
+            if f.suffix.lower() in {".jpg", ".jpeg", ".png"}:
+                items.append((f, label))
+    random.Random(0).shuffle(items)
+    return items[:limit] if limit else items
+
+
+def check_backends(val_dir: Path, backends: List[str], limit: int = 500, batch_size: int = 1) -> List[dict]:
+    """Top-1 agreement / accuracy / max prob drift vs fp32 eager, plus per-image latency."""
+    from .image_model import build_resnet
+    from .utils import load_image
+
+    items = _val_set(val_dir, limit)
+    if not items:
+        raise RuntimeError(f"No images under {val_dir}")
+    xs = [load_image(f) for f, _ in items]
+    labels = [label for _, label in items]
+    batches = [torch.cat(xs[i:i + batch_size]) for i in range(0, len(xs), batch_size)]
+
+    def run(model):
+        with torch.no_grad():
+            model(batches[0])  # warm-up
+            start = time.perf_counter()
+            probs = torch.cat([torch.softmax(model(b), dim=1) for b in batches])
+        return probs, (time.perf_counter() - start) * 1000 / len(xs)
+
+    base = build_resnet()
+    ref, ref_ms = run(prepare_classifier(copy.deepcopy(base), "eager"))
+    ref_top1 = ref.argmax(dim=1)
+
+    rows = []
+    for name in backends:
+        model = prepare_classifier(copy.deepcopy(base), name)
+        probs, ms = run(model)
+        top1 = probs.argmax(dim=1)
+        labelled = [(int(t), l) for t, l in zip(top1.tolist(), labels) if l is not None]
+        rows.append({
+            "backend": model.backend_name,
+            "requested": name,
+            "agreement": float((top1 == ref_top1).float().mean()),
+            "accuracy": sum(t == l for t, l in labelled) / len(labelled) if labelled else None,
+            "max_prob_diff": float((probs - ref).abs().max()),
+            "ms_per_image": ms,
+            "speedup": ref_ms / ms if ms else None,
+        })
+    return rows
+
+
+def check_clip_preprocessing(val_dir: Path, limit: int = 200) -> dict:
+    """Cosine between embeddings of our CLIP transform and of CLIPProcessor on the same images."""
+    from PIL import Image
+
+    from .clip_features import encode_pixels
+    from .model_registry import get_clip
+    from .utils import clip_tensor, decode_image
+
+    items = _val_set(val_dir, limit)
+    if not items:
+        raise RuntimeError(f"No images under {val_dir}")
+    _, processor = get_clip()
+    sims = []
+    for f, _ in items:
+        ours = encode_pixels(clip_tensor(decode_image(f)), bulk=True)[0]
+        with Image.open(f) as img:
+            ref_pixels = processor(images=img.convert("RGB"), return_tensors="pt")["pixel_values"]
+        ref = encode_pixels(ref_pixels, bulk=True)[0]
+        sims.append(float((ours * ref).sum()))
+    sims.sort()
+    return {
+        "images": len(sims),
+        "mean_cosine": sum(sims) / len(sims),
+        "p05_cosine": sims[int(0.05 * (len(sims) - 1))],
+        "min_cosine": sims[0],
+    }
+
+
+def check_clip_backends(val_dir: Path, backends: List[str], limit: int = 500, k: int = 5) -> List[dict]:
+    """Per CLIP backend: cosine to the fp32 embedding and overlap of each image's top-k neighbours."""
+    from .model_registry import _load_clip
+    from .utils import clip_tensor, decode_image
+
+    items = _val_set(val_dir, limit)
+    if len(items) <= k:
+        raise RuntimeError(f"Need more than {k} images under {val_dir}")
+    pixels = [clip_tensor(decode_image(f)) for f, _ in items]
+
+    def run(model):
+        with torch.inference_mode(), autocast(model):
+            model.get_image_features(pixel_values=pixels[0])  # warm-up
+            start = time.perf_counter()
+            emb = torch.cat([model.get_image_features(pixel_values=x).float() for x in pixels])
+        emb = emb / emb.norm(dim=-1, keepdim=True)
+        return emb, (time.perf_counter() - start) * 1000 / len(pixels)
+
+    def neighbours(emb):
+        sims = emb @ emb.T
+        sims.fill_diagonal_(-2.0)  # an image is not its own neighbour
+        return sims.topk(k, dim=1).indices.tolist()
+
+    base, _ = _load_clip("eager")
+    ref, ref_ms = run(base)
+    ref_nn = neighbours(ref)
+
+    rows = []
+    for name in backends:
+        model = prepare_clip(copy.deepcopy(base), name)
+        emb, ms = run(model)
+        cos = (emb * ref).sum(dim=1)
+        overlap = [len(set(a) & set(b)) / k for a, b in zip(neighbours(emb), ref_nn)]
+        rows.append({
+            "backend": model.backend_name,
+            "requested": name,
+            "mean_cosine": float(cos.mean()),
+            "min_cosine": float(cos.min()),
+            "topk_agreement": sum(overlap) / len(overlap),
+            "ms_per_image": ms,
+            "speedup": ref_ms / ms if ms else None,
+        })
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare classifier backends against fp32 eager.")
+    parser.add_argument("--val-dir", required=True, help="folder of <class_name>/*.jpg")
+    parser.add_argument("--backends", default=",".join(CLASSIFIER_BACKENDS))
+    parser.add_argument("--limit", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--clip-preprocess", action="store_true", help="check CLIP preprocessing vs CLIPProcessor")
+    parser.add_argument("--clip-backends", help="comma-separated CLIP backends to check instead of the classifier")
+    parser.add_argument("--k", type=int, default=5, help="neighbours compared by --clip-backends")
+    args = parser.parse_args()
+
+    if args.clip_backends:
+        rows = check_clip_backends(Path(args.val_dir), args.clip_backends.split(","), args.limit, args.k)
+        print(f"{'backend':<10}{'cos':>8}{'min cos':>9}{f'top{args.k}':>8}{'ms/img':>9}{'speedup':>9}")
+        for r in rows:
+            print(f"{r['backend']:<10}{r['mean_cosine']:>8.4f}{r['min_cosine']:>9.4f}{r['topk_agreement']:>8.3f}"
+                  f"{r['ms_per_image']:>9.1f}{r['speedup']:>8.2f}x")
+        return
+
+    if args.clip_preprocess:
+        r = check_clip_preprocessing(Path(args.val_dir), args.limit)
+        print(f"{r['images']} images: cosine mean {r['mean_cosine']:.4f}  p05 {r['p05_cosine']:.4f}  min {r['min_cosine']:.4f}")
+        return
+
+    rows = check_backends(Path(args.val_dir), args.backends.split(","), args.limit, args.batch_size)
+    print(f"{'backend':<14}{'agree':>8}{'acc':>8}{'maxΔp':>9}{'ms/img':>9}{'speedup':>9}")
+    for r in rows:
+        acc = f"{r['accuracy']:.3f}" if r["accuracy"] is not None else "-"
+        print(f"{r['backend']:<14}{r['agreement']:>8.3f}{acc:>8}{r['max_prob_diff']:>9.4f}"
+              f"{r['ms_per_image']:>9.1f}{r['speedup']:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Dynamic micro-batching for model forwards.
+Concurrent requests submit single inputs; one worker thread per model groups
+whatever is queued (up to a size / wait limit) into one batched forward and
+hands each caller its own result.
+"""
+import os
+import queue
+import threading
+import time
+import weakref
+from concurrent.futures import Future
+from typing import Any, Callable, List, Optional
+
+from .metrics import SIZE_BUCKETS, observe
+
+# on by default; INFERENCE_BATCHING=0 falls back to direct per-request forwards
+BATCHING_ENABLED = os.environ.get("INFERENCE_BATCHING", "1") not in {"0", "false", "False", "no"}
+MAX_BATCH_SIZE = int(os.environ.get("INFERENCE_MAX_BATCH", "16"))
+MAX_WAIT_MS = float(os.environ.get("INFERENCE_MAX_WAIT_MS", "5"))
+
+
+class MicroBatcher:
+    """
+    `fn` receives a list of submitted items and must return a list of results
+    in the same order. `weight(item)` lets one item count as several samples
+    (e.g. a list of augmented views) towards `max_batch_size`.
+
+    A lone request is dispatched immediately; the batcher only waits up to
+    `max_wait_ms` for company when the previous batch had more than one item,
+    i.e. when there is actually concurrent traffic.
+
+    A batch never exceeds `max_batch_size`: an item that would overflow it is
+    held back for the next batch (an item heavier than the cap runs alone).
+    Bulk work (index builds) should call `fn` directly instead of queueing here,
+    so it never sits in front of live requests.
+
+    The worker thread starts on the first submit() and again in a forked child
+    (gunicorn --preload): threads do not survive fork, the queue object does.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[List[Any]], List[Any]],
+        max_batch_size: int = MAX_BATCH_SIZE,
+        max_wait_ms: float = MAX_WAIT_MS,
+        weight: Optional[Callable[[Any], int]] = None,
+    ):
+        self.name = name
+        self.fn = fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.weight = weight or (lambda item: 1)
+        self._queue: "queue.Queue" = queue.Queue()
+        self._last_batch_items = 1
+        self._carry = None  # item that did not fit into the previous batch
+        self.batches = 0
+        self.items = 0
+        self.last_batch_size = 0
+        self._thread: Optional[threading.Thread] = None
+        self._pid: Optional[int] = None  # process the worker thread runs in
+        self._start_lock = threading.Lock()
+        _batchers.add(self)
+
+    def _ensure_worker(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                self._thread = threading.Thread(target=self._loop, name=f"batcher-{self.name}", daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+
+    def _after_fork(self):
+        """In the child: drop the parent's pending work (its callers live in the parent) and lock."""
+        self._queue = queue.Queue()
+        self._carry = None
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def submit(self, item) -> Future:
+        self._ensure_worker()
+        fut: Future = Future()
+        self._queue.put((item, fut))
+        return fut
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    def _collect(self):
+        first, self._carry = (self._carry, None) if self._carry is not None else (self._queue.get(), None)
+        batch = [first]
+        size = self.weight(first[0])
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch_size:
+            try:
+                if self._last_batch_items > 1:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    nxt = self._queue.get(timeout=timeout)
+                else:
+                    nxt = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            w = self.weight(nxt[0])
+            if size + w > self.max_batch_size:
+                self._carry = nxt
+                break
+            batch.append(nxt)
+            size += w
+        return batch, size
+
+    def _loop(self):
+        while True:
+            batch, size = self._collect()
+            self._last_batch_items = len(batch)
+            items = [item for item, _ in batch]
+            start = time.perf_counter()
+            try:
+                results = self.fn(items)
+            except Exception as exc:
+                for _, fut in batch:
+                    fut.set_exception(exc)
+                continue
+            observe("batch_forward_seconds", time.perf_counter() - start, model=self.name)
+            observe("batch_size", size, buckets=SIZE_BUCKETS, model=self.name)
+            for (_, fut), res in zip(batch, results):
+                fut.set_result(res)
+            self.batches += 1
+            self.items += len(batch)
+            self.last_batch_size = size
+
+    def stats(self) -> dict:
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "avg_items_per_batch": round(self.items / self.batches, 2) if self.batches else None,
+            "last_batch_size": self.last_batch_size,
+            "queued": self._queue.qsize() + (self._carry is not None),
+        }
+
+
+_batchers: "weakref.WeakSet[MicroBatcher]" = weakref.WeakSet()
+
+
+def _reset_after_fork():
+    for batcher in list(_batchers):
+        batcher._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
@@ -0,0 +1,155 @@
+"""
+Product catalog (products_nodup.csv) loaded lazily, once per process, and shared
+by product_info.py and the price features.
+
+Rows are served from two prebuilt dicts (by class_name and by slug), so lookups
+are O(1) instead of a DataFrame scan per request. The parsed dicts are also
+pickled next to the CSV and reused on the next start while the CSV's size/mtime
+are unchanged; editing the CSV triggers a rebuild (checked at most every
+CATALOG_CHECK_SECONDS while the app runs).
+"""
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import pandas as pd
+
+BASE_DIR = Path(__file__).resolve().parent
+PRODUCTS_CSV = BASE_DIR / "products_nodup.csv"
+SNAPSHOT_PATH = BASE_DIR / "products_nodup.catalog.pkl"
+SNAPSHOT_VERSION = 1
+
+CLASS_COLUMN = "class_name"
+SLUG_COLUMN = "slug"
+
+CATALOG_CHECK_SECONDS = float(os.environ.get("CATALOG_CHECK_SECONDS", "30"))
+
+_lock = threading.Lock()
+_state = {"catalog": None, "checked": 0.0}
+
+
+class Catalog:
+    """Immutable snapshot of the CSV: column list + first row per class and per slug."""
+
+    def __init__(self, source: tuple, columns: List[str], by_class: Dict[str, dict], by_slug: Dict[str, dict]):
+        self.source = source  # (size, mtime_ns) of the CSV this was built from
+        self.columns = columns
+        self.by_class = by_class
+        self.by_slug = by_slug
+
+    @classmethod
+    def from_csv(cls, source: tuple) -> "Catalog":
+        df = pd.read_csv(PRODUCTS_CSV)
+        records = df.to_dict("records")
+        by_class: Dict[str, dict] = {}
+        by_slug: Dict[str, dict] = {}
+        for row in records:
+            if CLASS_COLUMN in row:
+                by_class.setdefault(row[CLASS_COLUMN], row)
+            if SLUG_COLUMN in row:
+                by_slug.setdefault(row[SLUG_COLUMN], row)
+        return cls(source, list(df.columns), by_class, by_slug)
+
+
+def _csv_source() -> Optional[tuple]:
+    try:
+        st = PRODUCTS_CSV.stat()
+    except OSError:
+        return None
+    return st.st_size, st.st_mtime_ns
+
+
+def _load_snapshot(source: tuple) -> Optional[Catalog]:
+    try:
+        with open(SNAPSHOT_PATH, "rb") as f:
+            data = pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError):
+        return None
+    if data.get("version") != SNAPSHOT_VERSION or data.get("source") != source:
+        return None
+    return Catalog(source, data["columns"], data["by_class"], data["by_slug"])
+
+
+def _save_snapshot(catalog: Catalog):
+    # per process/thread tmp name: workers starting together each rename their own complete file
+    tmp = SNAPSHOT_PATH.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(
+                {
+                    "version": SNAPSHOT_VERSION,
+                    "source": catalog.source,
+                    "columns": catalog.columns,
+                    "by_class": catalog.by_class,
+                    "by_slug": catalog.by_slug,
+                },
+                f,
+                protocol=pickle.HIGHEST_PROTOCOL,
+            )
+        tmp.replace(SNAPSHOT_PATH)
+    except OSError as exc:
+        print(f"[CSV] Could not write catalog snapshot: {exc}")
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def _build(source: Optional[tuple]) -> Optional[Catalog]:
+    if source is None:
+        print(f"[CSV] ERROR: File {PRODUCTS_CSV} not found")
+        return None
+    catalog = _load_snapshot(source)
+    if catalog is not None:
+        print("[CSV] Loaded products catalog from snapshot")
+        return catalog
+    catalog = Catalog.from_csv(source)
+    print(f"[CSV] Loaded {PRODUCTS_CSV.name} successfully ({len(catalog.by_slug)} slugs)")
+    _save_snapshot(catalog)
+    return catalog
+
+
+def get_catalog() -> Optional[Catalog]:
+    """Current catalog (None if the CSV is missing); reloads after the CSV changes."""
+    now = time.monotonic()
+    catalog = _state["catalog"]
+    if catalog is not None and now - _state["checked"] < CATALOG_CHECK_SECONDS:
+        return catalog
+    with _lock:
+        catalog = _state["catalog"]
+        source = _csv_source()
+        if catalog is None or catalog.source != source:
+            catalog = _build(source)
+            _state["catalog"] = catalog
+        _state["checked"] = now
+        return catalog
+
+
+def is_loaded() -> bool:
+    """True once a lookup (or warm-up) has built the catalog."""
+    return _state["catalog"] is not None
+
+
+def product_by_class(class_name: str) -> Optional[dict]:
+    catalog = get_catalog()
+    return catalog.by_class.get(class_name) if catalog is not None else None
+
+
+def product_by_slug(slug: str) -> Optional[dict]:
+    catalog = get_catalog()
+    return catalog.by_slug.get(slug) if catalog is not None else None
+
+
+def all_slugs() -> List[str]:
+    catalog = get_catalog()
+    return list(catalog.by_slug) if catalog is not None else []
+
+
+def catalog_version() -> Optional[tuple]:
+    """(size, mtime_ns) of the CSV the current catalog was built from."""
+    catalog = get_catalog()
+    return catalog.source if catalog is not None else None
+
@@ -0,0 +1,112 @@
+"""
+CLIP feature helpers shared by the sneaker gate and FAISS search.
+All vectors returned here are L2-normalized so cosine similarity is a dot product.
+"""
+from typing import List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from .backends import CLIP_BACKEND, autocast
+from .batching import BATCHING_ENABLED, MicroBatcher
+from .model_registry import DEVICE, get_clip, get_entry, set_warmup
+from .utils import CLIP_PREPROCESS_VERSION, clip_tensor, decode_image
+
+
+def pixel_values(imgs: List[Image.Image]) -> torch.Tensor:
+    """RGB images -> CLIP pixel tensor (N, 3, 224, 224), via the shared reduced decode."""
+    return torch.cat([clip_tensor(decode_image(img)) for img in imgs])
+
+
+def _encode_batch(pixels: torch.Tensor) -> np.ndarray:
+    clip_model, _ = get_clip()
+    with torch.inference_mode(), autocast(clip_model):
+        emb = clip_model.get_image_features(pixel_values=pixels.to(DEVICE)).float()
+        emb = emb / emb.norm(dim=-1, keepdim=True)
+    return emb.float().cpu().numpy()
+
+
+def _encode_requests(requests: List[torch.Tensor]) -> List[np.ndarray]:
+    """Batcher callback: one forward over the pixel tensors of all queued requests."""
+    emb = _encode_batch(torch.cat(requests))
+    out, start = [], 0
+    for pixels in requests:
+        out.append(emb[start:start + pixels.shape[0]])
+        start += pixels.shape[0]
+    return out
+
+
+# concurrent callers share CLIP forwards (see ai/batching.py); preprocessing
+# happens on the caller's thread so the batcher thread only runs the model
+_clip_batcher = (
+    MicroBatcher("clip", _encode_requests, weight=lambda pixels: pixels.shape[0]) if BATCHING_ENABLED else None
+)
+
+
+def encode_images(imgs: List[Image.Image], bulk: bool = False) -> np.ndarray:
+    """
+    Embed several RGB images in ONE batched forward -> normalized float32
+    array of shape (N, D). Much cheaper on CPU than N batch-of-1 calls.
+    bulk=True (index builds) runs the forward on the caller's thread instead of
+    queueing behind/in front of live requests in the micro-batcher.
+    """
+    if not imgs:
+        return np.zeros((0, 0), dtype="float32")
+    return encode_pixels(pixel_values(imgs), bulk=bulk)
+
+
+def encode_pixels(pixels: torch.Tensor, bulk: bool = False) -> np.ndarray:
+    """Embed an already preprocessed (N, 3, 224, 224) CLIP pixel tensor."""
+    if _clip_batcher is not None and not bulk:
+        return _clip_batcher(pixels)
+    return _encode_batch(pixels)
+
+
+def encode_image(img: Image.Image) -> np.ndarray:
+    """Embed one RGB image -> normalized float32 vector of shape (D,)."""
+    return encode_images([img])[0]
+
+
+def _warmup_clip():
+    """One dummy image forward (see model_registry.warm_up)."""
+    _encode_batch(pixel_values([Image.new("RGB", (224, 224))]))
+
+
+set_warmup("clip", _warmup_clip)
+
+
+def clip_backend() -> str:
+    """Backend of the loaded CLIP model (the configured one if not loaded yet)."""
+    slot = get_entry("clip").peek()  # one read: an idle unload cannot clear it in between
+    return slot[0][0].backend_name if slot is not None else CLIP_BACKEND
+
+
+def embedding_key() -> str:
+    """
+    What produces CLIP vectors here: preprocessing version + the backend actually
+    running (loads CLIP, so a backend that fell back to eager is named as such).
+    build_indexes.py rebuilds indexes made under another key.
+    """
+    clip_model, _ = get_clip()
+    return f"clip-{CLIP_PREPROCESS_VERSION}-{clip_model.backend_name}"
+
+
+def clip_batcher_stats() -> Optional[dict]:
+    return _clip_batcher.stats() if _clip_batcher is not None else None
+
+
+def encode_texts(texts: List[str]) -> torch.Tensor:
+    """Embed text prompts -> normalized tensor of shape (N, D) on CPU."""
+    clip_model, clip_processor = get_clip()
+    inputs = clip_processor(text=texts, return_tensors="pt", padding=True).to(DEVICE)
+    with torch.no_grad():
+        emb = clip_model.get_text_features(**inputs)
+    emb = emb / emb.norm(dim=-1, keepdim=True)
+    return emb.float().cpu()
+
+
+def logit_scale() -> float:
+    """CLIP's learned temperature (logits = scale * cosine)."""
+    clip_model, _ = get_clip()
+    return float(clip_model.logit_scale.exp().item())
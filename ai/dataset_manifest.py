@@ -0,0 +1,210 @@
+"""
+Cached listing of the scraped dataset (Scraping_part/goat_data):
+
+    class -> slug -> {filename: [size, mtime]}
+
+Built once, saved as JSON and refreshed incrementally: a class or slug folder is
+only re-listed when its own mtime changed (i.e. files were added/removed/renamed),
+so a refresh costs one stat per folder instead of one per image. Files modified in
+place keep their folder mtime; refresh(full=True) or refresh_class(name, full=True)
+re-stats everything. The slug selector, the FAISS builder and /similar read from here.
+
+Readers do not take the lock: a refresh never mutates the published dicts, it
+builds new ones and swaps them into _state with one assignment.
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+PROJECT_ROOT = Path(__file__).resolve().parents[1]
+DATA_ROOT = PROJECT_ROOT / "Scraping_part" / "goat_data"
+MANIFEST_PATH = Path(
+    os.environ.get("DATASET_MANIFEST_PATH", str(PROJECT_ROOT / "faiss_cache" / "dataset_manifest.json"))
+)
+# how old the in-memory listing may get before the next read triggers a refresh (0 = never)
+DATASET_REFRESH_SECONDS = float(os.environ.get("DATASET_REFRESH_SECONDS", "300"))
+IMAGE_EXTS = {".jpg", ".jpeg", ".png"}
+
+_lock = threading.RLock()
+_state = {"classes": None, "dirs": {}, "refreshed": 0.0}
+
+
+def _mtime(path: Path) -> Optional[int]:
+    try:
+        return path.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+def _subdirs(path: Path) -> List[str]:
+    with os.scandir(path) as it:
+        return sorted(e.name for e in it if e.is_dir())
+
+
+def _scan_slug(slug_dir: Path) -> Dict[str, list]:
+    files = {}
+    with os.scandir(slug_dir) as it:
+        for e in it:
+            if Path(e.name).suffix.lower() in IMAGE_EXTS and e.is_file():
+                st = e.stat()
+                files[e.name] = [st.st_size, st.st_mtime]
+    return files
+
+
+def _refresh_class(classes: dict, dirs: dict, class_name: str, full: bool):
+    """Update `classes`/`dirs` (private copies) for one class; its slug dict is always a new one."""
+    class_dir = DATA_ROOT / class_name
+    key = class_name
+    mtime = _mtime(class_dir)
+    if mtime is None:
+        classes.pop(class_name, None)
+        dirs.pop(key, None)
+        return
+
+    old = classes.get(class_name)
+    if old is None or full or dirs.get(key) != mtime:
+        names = _subdirs(class_dir)
+        slugs = {name: (old or {}).get(name) for name in names}
+        dirs[key] = mtime
+    else:
+        slugs = dict(old)
+    for slug in list(slugs):
+        slug_dir = class_dir / slug
+        skey = f"{class_name}/{slug}"
+        smtime = _mtime(slug_dir)
+        if smtime is None:
+            slugs.pop(slug)
+            dirs.pop(skey, None)
+            continue
+        if slugs[slug] is None or full or dirs.get(skey) != smtime:
+            slugs[slug] = _scan_slug(slug_dir)
+            dirs[skey] = smtime
+    classes[class_name] = slugs
+
+
+def _load():
+    try:
+        with open(MANIFEST_PATH, "r") as f:
+            data = json.load(f)
+        _state["classes"] = data["classes"]
+        _state["dirs"] = data["dirs"]
+    except (OSError, ValueError, KeyError):
+        _state["classes"] = {}
+        _state["dirs"] = {}
+
+
+def _save():
+    """Persist the listing; a failure only costs the next process a rescan, so it never breaks reads."""
+    # per process/thread tmp name: workers saving at the same time each rename their own file
+    tmp = MANIFEST_PATH.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        MANIFEST_PATH.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, "w") as f:
+            json.dump({"classes": _state["classes"], "dirs": _state["dirs"]}, f)
+        tmp.replace(MANIFEST_PATH)
+    except OSError as exc:
+        print(f"[DATASET] Could not save manifest: {exc}")
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def refresh(full: bool = False) -> dict:
+    """Bring the whole listing up to date (incremental unless full=True)."""
+    with _lock:
+        if _state["classes"] is None:
+            _load()
+        # work on copies; readers keep iterating the published dicts meanwhile
+        classes, dirs = dict(_state["classes"]), dict(_state["dirs"])
+        start = time.perf_counter()
+        root_mtime = _mtime(DATA_ROOT)
+        if root_mtime is None:
+            classes, dirs = {}, {}
+        else:
+            if full or dirs.get("") != root_mtime or not classes:
+                names = set(_subdirs(DATA_ROOT))
+                for gone in set(classes) - names:
+                    classes.pop(gone)
+                for name in names - set(classes):
+                    classes[name] = None
+                dirs[""] = root_mtime
+            for class_name in list(classes):
+                _refresh_class(classes, dirs, class_name, full)
+        _state["dirs"] = dirs  # only used under the lock
+        _state["classes"] = classes
+        _state["refreshed"] = time.monotonic()
+        _save()
+        print(f"[DATASET] Manifest refreshed in {time.perf_counter() - start:.2f}s ({len(classes)} classes)")
+        return dataset_stats()
+
+
+def refresh_class(class_name: str, full: bool = False):
+    """Re-list one class (full=True also re-stats files whose folders did not change)."""
+    with _lock:
+        _classes()
+        classes, dirs = dict(_state["classes"]), dict(_state["dirs"])
+        _refresh_class(classes, dirs, class_name, full)
+        _state["dirs"] = dirs
+        _state["classes"] = classes
+        _save()
+
+
+def _classes() -> dict:
+    stale = DATASET_REFRESH_SECONDS and time.monotonic() - _state["refreshed"] > DATASET_REFRESH_SECONDS
+    if _state["classes"] is None or stale:
+        with _lock:
+            stale = DATASET_REFRESH_SECONDS and time.monotonic() - _state["refreshed"] > DATASET_REFRESH_SECONDS
+            if _state["classes"] is None or stale:
+                refresh()
+    return _state["classes"]
+
+
+def is_loaded() -> bool:
+    """True once the listing has been refreshed in this process."""
+    return _state["classes"] is not None and _state["refreshed"] > 0
+
+
+def all_classes() -> List[str]:
+    return sorted(_classes())
+
+
+def has_class(class_name: str) -> bool:
+    return class_name in _classes()
+
+
+def slugs_for_class(class_name: str) -> List[str]:
+    """Sorted slug folder names of a class ([] if the class folder is missing)."""
+    return sorted(_classes().get(class_name) or {})
+
+
+def class_files(class_name: str) -> List[Tuple[Path, int, float]]:
+    """(path, size, mtime) of every image of a class."""
+    out = []
+    class_dir = DATA_ROOT / class_name
+    for slug, files in sorted((_classes().get(class_name) or {}).items()):
+        for name, (size, mtime) in sorted((files or {}).items()):
+            out.append((class_dir / slug / name, size, mtime))
+    return out
+
+
+def has_file(rel_path: str) -> bool:
+    """rel_path like "<class>/<slug>/<file>" relative to DATA_ROOT."""
+    parts = rel_path.replace("\\", "/").split("/")
+    if len(parts) != 3:
+        return False
+    class_name, slug, name = parts
+    files = (_classes().get(class_name) or {}).get(slug) or {}
+    return name in files
+
+
+def dataset_stats() -> dict:
+    classes = _state["classes"] or {}  # one snapshot
+    return {
+        "classes": len(classes),
+        "slugs": sum(len(s or {}) for s in classes.values()),
+        "images": sum(len(f or {}) for s in classes.values() for f in (s or {}).values()),
+    }
@@ -1,17 +1,8 @@
-from pathlib import Path
 from datetime import datetime
 
 import pandas as pd
 
-BASE_DIR = Path(__file__).resolve().parent
-PRODUCTS_CSV = BASE_DIR / "products_nodup.csv"
-
-# load once
-_products_df = pd.read_csv(PRODUCTS_CSV)
-
-# make lookup by slug for speed
-if "slug" in _products_df.columns:
-    _products_df = _products_df.set_index("slug")
+from .catalog import product_by_slug
 
 
 def _compute_release_age(release_date_str: str):
@@ -40,11 +31,10 @@ def get_features_for_slug(slug: str) -> dict:
     Return feature dict for CatBoost model, based on products_nodup.csv.
     Adjust column names here if they differ slightly in your file.
     """
-    if slug not in _products_df.index:
+    row = product_by_slug(slug)
+    if row is None:
         raise KeyError(f"Slug '{slug}' not found in products_nodup.csv")
 
-    row = _products_df.loc[slug]
-
     # adjust these names if your CSV uses slightly different ones
     class_name = row["class_name"]
     brand = row["brand"]
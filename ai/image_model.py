@@ -5,6 +5,9 @@ import torch.nn.functional as F
 from torchvision import models
 import torch.nn as nn
 
+from .backends import CLASSIFIER_BACKEND, prepare_classifier
+from .batching import BATCHING_ENABLED, MicroBatcher
+from .model_registry import get, get_entry, register
 from .utils import load_image
 
 BASE_DIR = Path(__file__).resolve().parent
@@ -35,36 +38,110 @@ def _split_brand_model(class_name: str):
 # BUILD RESNET50 ARCHITECTURE WITH CUSTOM FC HEAD
 # ----------------------------------------------------
 
-# 1) Base ResNet50 backbone
-_model = models.resnet50(weights=None)
+def build_resnet():
+    """fp32 eager ResNet50 with the trained head (the accuracy baseline for ai/backends.py)."""
+    # 1) Base ResNet50 backbone
+    model = models.resnet50(weights=None)
 
-# 2) Replace the final FC layer with the EXACT architecture matching your weights
-#    State_dict shows:
-#       fc.0 = Linear(2048 → 512)
-#       fc.1 = ReLU()
-#       fc.2 = (no weights) → Identity
-#       fc.3 = Linear(512 → num_classes)
-_model.fc = nn.Sequential(
-    nn.Linear(2048, 512),           # fc.0
-    nn.ReLU(),                      # fc.1
-    nn.Identity(),                  # fc.2
-    nn.Linear(512, len(class_to_idx))  # fc.3
-)
+    # 2) Replace the final FC layer with the EXACT architecture matching your weights
+    #    State_dict shows:
+    #       fc.0 = Linear(2048 → 512)
+    #       fc.1 = ReLU()
+    #       fc.2 = (no weights) → Identity
+    #       fc.3 = Linear(512 → num_classes)
+    model.fc = nn.Sequential(
+        nn.Linear(2048, 512),           # fc.0
+        nn.ReLU(),                      # fc.1
+        nn.Identity(),                  # fc.2
+        nn.Linear(512, len(class_to_idx))  # fc.3
+    )
 
-# 3) Load your saved state_dict
-state_dict = torch.load(MODEL_PATH, map_location=device)
-_model.load_state_dict(state_dict)   # THIS WILL NOW WORK
+    # 3) Load your saved state_dict
+    state_dict = torch.load(MODEL_PATH, map_location=device)
+    model.load_state_dict(state_dict)   # THIS WILL NOW WORK
 
-# 4) Move to device + set eval mode
-_model = _model.to(device)
-_model.eval()
+    # 4) Move to device + set eval mode
+    model = model.to(device)
+    model.eval()
+    return model
+
+
+def _load_resnet():
+    # CLASSIFIER_BACKEND picks eager / channels_last / jit / compile / bf16 / int8 (ai/backends.py)
+    model = prepare_classifier(build_resnet())
+    print(f"[MODELS] resnet50 backend: {model.backend_name}")
+    return model
+
+
+def classifier_backend() -> str:
+    """Backend of the loaded classifier (the configured one if not loaded yet)."""
+    slot = get_entry("resnet50").peek()  # one read: an idle unload cannot clear it in between
+    return slot[0].backend_name if slot is not None else CLASSIFIER_BACKEND
+
+
+def _warmup_resnet():
+    """One dummy forward so the first real request does not pay for lazy init."""
+    _classify_batch([torch.zeros(1, 3, 224, 224)])
+
+
+# shared via the model registry (loaded on first prediction)
+register("resnet50", _load_resnet, warmup=_warmup_resnet)
 
 
 # ----------------------------------------------------
 # CLASS PREDICTION FUNCTION
 # ----------------------------------------------------
 
-def predict_class(image_path):
+def _classify_batch(xs):
+    """Batcher callback: stack (1, 3, 224, 224) inputs, one forward, per-input probs."""
+    with torch.no_grad():
+        logits = get("resnet50")(torch.cat(xs).to(device))
+        probs = F.softmax(logits, dim=1).cpu()
+    return list(probs)
+
+
+# concurrent /predict calls share ResNet forwards (see ai/batching.py)
+_resnet_batcher = MicroBatcher("resnet50", _classify_batch) if BATCHING_ENABLED else None
+
+
+def class_probabilities(x: torch.Tensor) -> torch.Tensor:
+    """x: preprocessed (1, 3, 224, 224) tensor -> softmax probabilities (num_classes,)."""
+    if _resnet_batcher is not None:
+        return _resnet_batcher(x)
+    return _classify_batch([x])[0]
+
+
+def image_probabilities(image) -> torch.Tensor:
+    """Image path or PIL image -> softmax probabilities (num_classes,)."""
+    return class_probabilities(load_image(image))
+
+
+def resnet_batcher_stats():
+    return _resnet_batcher.stats() if _resnet_batcher is not None else None
+
+
+def _result_from_probs(probs: torch.Tensor, top_k: int) -> dict:
+    top_conf, top_idx = probs.topk(min(top_k, probs.shape[0]))
+    idx = int(top_idx[0].item())
+    conf = float(top_conf[0].item())
+
+    class_name = idx_to_class[idx]
+    brand, model_name = _split_brand_model(class_name)
+
+    return {
+        "class_name": class_name,
+        "brand": brand,
+        "model_name": model_name,
+        "confidence": conf,
+        "class_index": idx,
+        "top_classes": [
+            {"class_name": idx_to_class[int(i)], "confidence": float(c)}
+            for c, i in zip(top_conf.tolist(), top_idx.tolist())
+        ],
+    }
+
+
+def predict_class(image_path, top_k: int = 3):
     """
     Predict sneaker class from image path.
     Returns:
@@ -74,23 +151,25 @@ def predict_class(image_path):
           "model_name": ...,
           "confidence": float,
           "class_index": int,
+          "top_classes": [{"class_name": ..., "confidence": float}, ...],  # top_k best
         }
     """
-    with torch.no_grad():
-        x = load_image(image_path).to(device)
-        logits = _model(x)
-        probs = F.softmax(logits, dim=1)
-        conf, idx = probs.max(dim=1)
-        idx = int(idx.item())
-        conf = float(conf.item())
+    return _result_from_probs(image_probabilities(image_path), top_k)
 
-    class_name = idx_to_class[idx]
-    brand, model_name = _split_brand_model(class_name)
 
-    return {
-        "class_name": class_name,
-        "brand": brand,
-        "model_name": model_name,
-        "confidence": conf,
-        "class_index": idx,
-    }
+def predict_from_probs(probs, top_k: int = 3):
+    """predict_class output from already computed probabilities (tensor or list)."""
+    return _result_from_probs(torch.as_tensor(probs, dtype=torch.float32), top_k)
+
+
+def images_probabilities(images, batch_size: int = 32):
+    """Softmax probabilities for several images (paths or PIL), batch_size per forward."""
+    probs = []
+    for start in range(0, len(images), batch_size):
+        probs.extend(_classify_batch([load_image(img) for img in images[start:start + batch_size]]))
+    return probs
+
+
+def predict_classes(images, top_k: int = 3, batch_size: int = 32):
+    """Same as predict_class for several images (paths or PIL), batch_size per forward."""
+    return [_result_from_probs(p, top_k) for p in images_probabilities(images, batch_size)]
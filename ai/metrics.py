@@ -0,0 +1,183 @@
+"""
+Lightweight in-process metrics: counters, histograms and scrape-time gauges,
+rendered in the Prometheus text format by /metrics.
+
+    with timed("classify"):          # -> stage_seconds{stage="classify"}
+        ...
+    inc("index_cache_total", result="hit")
+    observe("batch_size", 8, model="clip", buckets=SIZE_BUCKETS)
+
+Recording is a dict lookup, a bisect and a few additions under a lock, cheap
+enough to leave on (METRICS_ENABLED=0 turns it off). Between begin_timings() and
+end_timings(), timed() also writes each stage's duration (ms) into the request's
+dict (current_timings()); use contextvars.copy_context().run to carry it into
+worker threads.
+
+Metrics live in each worker process. Every series carries a worker="<pid>" label
+(or METRICS_WORKER_ID), so a scrape that lands on another gunicorn/uwsgi worker
+shows up as a different series rather than a counter that jumps back and forth.
+Aggregate across workers in queries, e.g. sum without (worker) (rate(...)). A
+worker that is never scraped goes unseen: scrape each worker directly for full
+coverage.
+"""
+import bisect
+import contextlib
+import contextvars
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+METRICS_ENABLED = os.environ.get("METRICS_ENABLED", "1") not in {"0", "false", "False", "no"}
+# value of the worker label; the pid (read at scrape time, so forked workers differ) by default
+METRICS_WORKER_ID = os.environ.get("METRICS_WORKER_ID", "")
+
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+_HELP = {
+    "stage_seconds": "Duration of request stages",
+    "request_seconds": "End-to-end request duration",
+    "requests_total": "Requests by endpoint and status",
+    "index_cache_total": "FAISS index cache lookups",
+    "index_load_seconds": "Time to open a FAISS index from disk",
+    "batch_size": "Samples per batched model forward",
+    "batch_forward_seconds": "Duration of batched model forwards",
+    "model_load_seconds": "Time to load a registered model/component",
+    "result_cache_total": "Result cache lookups",
+}
+
+_lock = threading.Lock()
+_counters: Dict[Tuple[str, tuple], float] = {}
+_histograms: Dict[Tuple[str, tuple], "Histogram"] = {}
+_gauges: Dict[str, Tuple[Callable[[], float], str]] = {}
+_timings: contextvars.ContextVar = contextvars.ContextVar("request_timings", default=None)
+
+
+class Histogram:
+    """Cumulative-bucket histogram (Prometheus semantics)."""
+
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # last slot = +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _key(name: str, labels: dict) -> Tuple[str, tuple]:
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name: str, amount: float = 1, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + amount
+
+
+def observe(name: str, value: float, buckets=SECONDS_BUCKETS, **labels):
+    if not METRICS_ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = Histogram(buckets)
+        hist.observe(value)
+
+
+def gauge(name: str, fn: Callable[[], float], help_text: str = ""):
+    """Register a value that is read at scrape time (e.g. a cache size)."""
+    _gauges[name] = (fn, help_text)
+
+
+@contextlib.contextmanager
+def timed(stage: str, metric: str = "stage_seconds"):
+    """Record the block's duration under metric{stage=...} (and in the request timings)."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        observe(metric, elapsed, stage=stage)
+        timings = _timings.get()
+        if timings is not None:
+            timings[stage] = round(timings.get(stage, 0.0) + elapsed * 1000, 2)
+
+
+def begin_timings():
+    """Start collecting {stage: ms} for this context; returns the token for end_timings()."""
+    return _timings.set({})
+
+
+def end_timings(token):
+    _timings.reset(token)
+
+
+def current_timings() -> Optional[Dict[str, float]]:
+    return _timings.get()
+
+
+# ==== EXPOSITION ====
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels: tuple, extra: Optional[tuple] = None) -> str:
+    items = [("worker", METRICS_WORKER_ID or os.getpid())] + list(labels) + ([extra] if extra else [])
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _fmt(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+def render() -> str:
+    """All metrics in the Prometheus text exposition format (version 0.0.4)."""
+    with _lock:
+        counters = sorted(_counters.items())
+        hists = sorted(
+            (k, (h.buckets, list(h.counts), h.sum, h.count)) for k, h in _histograms.items()
+        )
+
+    lines, seen = [], set()
+
+    def header(name, kind, help_text=None):
+        if name not in seen:
+            seen.add(name)
+            lines.append(f"# HELP {name} {help_text or _HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} {kind}")
+
+    for (name, labels), value in counters:
+        header(name, "counter")
+        lines.append(f"{name}{_labels(labels)} {_fmt(value)}")
+
+    for (name, labels), (buckets, counts, total, count) in hists:
+        header(name, "histogram")
+        cumulative = 0
+        for bound, n in zip(buckets, counts):
+            cumulative += n
+            lines.append(f"{name}_bucket{_labels(labels, ('le', _fmt(bound)))} {cumulative}")
+        lines.append(f"{name}_bucket{_labels(labels, ('le', '+Inf'))} {count}")
+        lines.append(f"{name}_sum{_labels(labels)} {total!r}")
+        lines.append(f"{name}_count{_labels(labels)} {count}")
+
+    for name, (fn, help_text) in sorted(_gauges.items()):
+        try:
+            value = fn()
+        except Exception:
+            continue
+        if value is None:
+            continue
+        header(name, "gauge", help_text)
+        lines.append(f"{name}{_labels(())} {_fmt(value)}")
+
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,339 @@
+"""
+Process-wide model registry.
+Every pipeline stage (sneaker gate, FAISS search, classifier, ...) fetches its
+models from here so each worker holds exactly one copy of the weights.
+Models are loaded lazily on first use, can report their memory footprint and
+can be unloaded after sitting idle (env MODEL_IDLE_TIMEOUT, seconds).
+
+Non-model startup work (catalog, Mongo, price table, ...) is registered here too
+(unloadable=False), so warm_up() can load everything in parallel in the background
+and readiness() can report per-component state and timings for /ready. Such
+components are mostly reached through their own module's lazy path rather than
+get(); their `probe` tells readiness() when that already happened.
+"""
+import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+import torch
+
+from .metrics import observe
+
+DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
+
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
+
+# 0 disables idle unloading
+MODEL_IDLE_TIMEOUT = float(os.environ.get("MODEL_IDLE_TIMEOUT", "0"))
+
+# background warm-up: parallel loaders, and one dummy inference per model when enabled
+WARMUP_WORKERS = int(os.environ.get("WARMUP_WORKERS", "4"))
+WARMUP_DUMMY_INFERENCE = os.environ.get("WARMUP_DUMMY_INFERENCE", "0") in {"1", "true", "True", "yes"}
+
+
+class _Entry:
+    def __init__(
+        self,
+        name: str,
+        loader: Callable[[], Any],
+        unloadable: bool = True,
+        warmup: Optional[Callable[[], Any]] = None,
+        required: bool = True,
+        probe: Optional[Callable[[], bool]] = None,
+    ):
+        self.name = name
+        self.loader = loader
+        self.unloadable = unloadable
+        self.warmup = warmup
+        self.required = required
+        self.probe = probe
+        # (value,) while loaded, None otherwise: one attribute, so readers never see
+        # "loaded" together with a value that unload() already cleared
+        self._slot: Optional[tuple] = None
+        self.state = "not_loaded"  # not_loaded | loading | loaded | failed
+        self.error: Optional[str] = None
+        self.load_seconds: Optional[float] = None
+        self.warmup_seconds: Optional[float] = None
+        self.last_used = 0.0
+        self.lock = threading.Lock()
+
+    @property
+    def loaded(self) -> bool:
+        return self._slot is not None
+
+    @property
+    def value(self) -> Any:
+        slot = self._slot
+        return slot[0] if slot is not None else None
+
+    def peek(self) -> Optional[tuple]:
+        """(value,) if loaded, else None -- a consistent snapshot without loading."""
+        return self._slot
+
+
+_registry: Dict[str, _Entry] = {}
+_registry_lock = threading.Lock()
+_reaper: Optional[threading.Thread] = None
+_reaper_pid: Optional[int] = None  # threads do not survive fork: restarted in a forked worker
+
+
+def register(
+    name: str,
+    loader: Callable[[], Any],
+    unloadable: bool = True,
+    warmup: Optional[Callable[[], Any]] = None,
+    required: bool = True,
+    probe: Optional[Callable[[], bool]] = None,
+):
+    """
+    Register a loader under `name`. Loading happens on the first get() (or in
+    warm_up()). `warmup` runs one dummy inference after loading during warm_up();
+    `required` components must be loaded for readiness(). `probe() -> bool` reports
+    that the component was initialised outside get() (e.g. the catalog on its first
+    lookup), so its state follows reality.
+    """
+    with _registry_lock:
+        if name not in _registry:
+            _registry[name] = _Entry(
+                name, loader, unloadable=unloadable, warmup=warmup, required=required, probe=probe
+            )
+
+
+def set_warmup(name: str, warmup: Callable[[], Any]):
+    """Attach a dummy-inference callable to an already registered model."""
+    _registry[name].warmup = warmup
+
+
+def get_entry(name: str) -> _Entry:
+    """Registry entry (state, timings, value) without loading it."""
+    entry = _registry.get(name)
+    if entry is None:
+        raise KeyError(f"Model '{name}' is not registered")
+    return entry
+
+
+def get(name: str) -> Any:
+    """Return the shared instance for `name`, loading it if needed."""
+    entry = _registry.get(name)
+    if entry is None:
+        raise KeyError(f"Model '{name}' is not registered")
+
+    entry.last_used = time.monotonic()
+    _ensure_reaper()
+    slot = entry.peek()
+    if slot is not None:
+        return slot[0]
+
+    with entry.lock:
+        slot = entry.peek()
+        if slot is None:
+            entry.state = "loading"
+            start = time.perf_counter()
+            try:
+                value = entry.loader()
+            except Exception as exc:
+                entry.state = "failed"
+                entry.error = str(exc)
+                raise
+            entry.load_seconds = time.perf_counter() - start
+            observe("model_load_seconds", entry.load_seconds, model=name)
+            slot = entry._slot = (value,)
+            entry.state = "loaded"
+            entry.error = None
+            print(f"[MODELS] Loaded {name} in {entry.load_seconds:.2f}s")
+        return slot[0]
+
+
+def unload(name: str) -> bool:
+    """Drop the shared instance for `name`; it is reloaded on the next get()."""
+    entry = _registry.get(name)
+    if entry is None or not entry.loaded:
+        return False
+    with entry.lock:
+        entry._slot = None
+        entry.state = "not_loaded"
+    if DEVICE == "cuda":
+        torch.cuda.empty_cache()
+    print(f"[MODELS] Unloaded {name}")
+    return True
+
+
+def unload_idle(max_idle_seconds: float) -> List[str]:
+    """Unload every unloadable model not used for `max_idle_seconds`."""
+    now = time.monotonic()
+    dropped = []
+    for name, entry in list(_registry.items()):
+        if entry.loaded and entry.unloadable and now - entry.last_used >= max_idle_seconds:
+            if unload(name):
+                dropped.append(name)
+    return dropped
+
+
+def _ensure_reaper():
+    """Start the idle reaper on first use in this process (not at import: see _reset_after_fork)."""
+    global _reaper, _reaper_pid
+    if MODEL_IDLE_TIMEOUT <= 0 or _reaper_pid == os.getpid():
+        return
+    with _registry_lock:
+        if _reaper_pid == os.getpid():
+            return
+        _reaper_pid = os.getpid()
+
+    def _loop():
+        interval = max(MODEL_IDLE_TIMEOUT / 4, 1.0)
+        while True:
+            time.sleep(interval)
+            unload_idle(MODEL_IDLE_TIMEOUT)
+
+    _reaper = threading.Thread(target=_loop, name="model-idle-reaper", daemon=True)
+    _reaper.start()
+
+
+def _reset_after_fork():
+    """
+    Forked child (gunicorn --preload): locks held by the parent's threads stay held
+    forever here, and loads those threads were running never finish. Start clean.
+    """
+    global _registry_lock, _reaper, _reaper_pid
+    _registry_lock = threading.Lock()
+    _reaper, _reaper_pid = None, None
+    for entry in _registry.values():
+        entry.lock = threading.Lock()
+        if entry.state == "loading":
+            entry.state = "not_loaded"
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _nbytes(obj: Any) -> int:
+    """Parameter + buffer bytes of torch modules found in obj (tuples are walked)."""
+    if isinstance(obj, torch.nn.Module):
+        total = sum(p.numel() * p.element_size() for p in obj.parameters())
+        total += sum(b.numel() * b.element_size() for b in obj.buffers())
+        return total
+    if isinstance(obj, (tuple, list)):
+        return sum(_nbytes(x) for x in obj)
+    return 0
+
+
+def memory_report() -> Dict[str, dict]:
+    """Per-model load state and approximate weight memory in bytes."""
+    report = {}
+    now = time.monotonic()
+    for name, entry in _registry.items():
+        slot = entry.peek()
+        report[name] = {
+            "loaded": slot is not None,
+            "bytes": _nbytes(slot[0]) if slot is not None else 0,
+            "load_seconds": entry.load_seconds,
+            "idle_seconds": round(now - entry.last_used, 1) if entry.last_used else None,
+        }
+    return report
+
+
+def _warm_one(name: str, dummy: bool):
+    entry = _registry[name]
+    try:
+        get(name)
+        if dummy and entry.warmup is not None:
+            start = time.perf_counter()
+            entry.warmup()
+            entry.warmup_seconds = time.perf_counter() - start
+            print(f"[MODELS] Warm-up inference for {name} in {entry.warmup_seconds:.2f}s")
+    except Exception as exc:
+        print(f"[MODELS] Failed to load {name}: {exc}")
+
+
+def warm_up(names: Optional[List[str]] = None, dummy: Optional[bool] = None, workers: int = WARMUP_WORKERS) -> Dict[str, Future]:
+    """
+    Load the given (default: all registered) components in parallel on a
+    background pool and return immediately. A component that needs another
+    one simply get()s it and waits on that entry's lock.
+    """
+    dummy = WARMUP_DUMMY_INFERENCE if dummy is None else dummy
+    names = list(_registry) if names is None else names
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="warmup")
+    futures = {name: pool.submit(_warm_one, name, dummy) for name in names}
+    pool.shutdown(wait=False)
+    return futures
+
+
+def _sync(entry: _Entry):
+    """
+    Report an entry as loaded when its probe says its module already initialised
+    it. Only the state changes: a later get() still runs the (then cheap) loader.
+    """
+    if entry.state in ("loaded", "loading") or entry.probe is None:
+        return
+    try:
+        ready = entry.probe()
+    except Exception:
+        return
+    if ready:
+        entry.state = "loaded"
+        entry.error = None
+
+
+def readiness() -> dict:
+    """{"ready": bool, "components": {name: state/timings}}; ready once every required component loaded."""
+    components = {}
+    for name, entry in _registry.items():
+        _sync(entry)
+        components[name] = {
+            "state": entry.state,
+            "required": entry.required,
+            "load_seconds": round(entry.load_seconds, 3) if entry.load_seconds is not None else None,
+            "warmup_seconds": round(entry.warmup_seconds, 3) if entry.warmup_seconds is not None else None,
+            "error": entry.error,
+        }
+    ready = all(
+        e.loaded
+        or e.state == "loaded"
+        or not e.required
+        or (e.state == "not_loaded" and e.unloadable and e.load_seconds is not None)
+        for e in _registry.values()
+    )
+    return {"ready": ready, "components": components}
+
+
+# ----------------------------------------------------
+# SHARED CLIP
+# ----------------------------------------------------
+
+def _load_clip(backend: Optional[str] = None):
+    from transformers import CLIPModel, CLIPProcessor
+
+    try:
+        m = CLIPModel.from_pretrained(
+            CLIP_MODEL_NAME,
+            use_safetensors=True,
+            local_files_only=True,
+        )
+        p = CLIPProcessor.from_pretrained(
+            CLIP_MODEL_NAME,
+            use_fast=True,
+            local_files_only=True,
+        )
+    except Exception:
+        m = CLIPModel.from_pretrained(CLIP_MODEL_NAME, use_safetensors=True)
+        p = CLIPProcessor.from_pretrained(CLIP_MODEL_NAME, use_fast=True)
+    m = m.to(DEVICE)
+    m.eval()
+    # CLIP_BACKEND (ai/backends.py): eager / compile / bf16 / int8 on the vision side
+    from .backends import prepare_clip
+
+    m = prepare_clip(m, backend)
+    print(f"[MODELS] clip backend: {m.backend_name}")
+    return m, p
+
+
+register("clip", _load_clip)
+
+
+def get_clip():
+    """Return the shared (CLIPModel, CLIPProcessor) pair."""
+    return get("clip")
@@ -1,19 +1,53 @@
+import os
+import threading
+import time
+from datetime import date
 from pathlib import Path
 
 import pandas as pd
 from catboost import CatBoostRegressor
 
+from .catalog import all_slugs, catalog_version
 from .feature_extractor import get_features_for_slug
+from .metrics import timed
+from .model_registry import get, register, unload
 
 BASE_DIR = Path(__file__).resolve().parent
 
 # Model file sits at repo root (sneaker_price_model.cbm)
 PRICE_MODEL_PATH = BASE_DIR.parent / "sneaker_price_model.cbm"
 
-_price_model = CatBoostRegressor()
-if not PRICE_MODEL_PATH.exists():
-    raise FileNotFoundError(f"Price model missing at {PRICE_MODEL_PATH}")
-_price_model.load_model(str(PRICE_MODEL_PATH))
+# Every catalog slug is priced in one batched predict and served from memory.
+# The table is rebuilt when the day changes (release_age moves), when the .cbm or
+# the CSV changes, or after PRICE_TABLE_MAX_AGE_HOURS; sources are re-checked at
+# most every PRICE_TABLE_CHECK_SECONDS.
+PRICE_TABLE_MAX_AGE_HOURS = float(os.environ.get("PRICE_TABLE_MAX_AGE_HOURS", "24"))
+PRICE_TABLE_CHECK_SECONDS = float(os.environ.get("PRICE_TABLE_CHECK_SECONDS", "30"))
+
+
+def _model_mtime():
+    try:
+        return PRICE_MODEL_PATH.stat().st_mtime_ns
+    except OSError:
+        return None
+
+
+# mtime of the .cbm the registry currently holds
+_price_model_mtime = None
+
+
+def _load_price_model() -> CatBoostRegressor:
+    global _price_model_mtime
+    if not PRICE_MODEL_PATH.exists():
+        raise FileNotFoundError(f"Price model missing at {PRICE_MODEL_PATH}")
+    model = CatBoostRegressor()
+    _price_model_mtime = _model_mtime()
+    model.load_model(str(PRICE_MODEL_PATH))
+    return model
+
+
+# shared via the model registry (loaded on first prediction)
+register("catboost", _load_price_model, unloadable=False)
 
 FEATURE_COLS = [
     "class_name",
@@ -23,6 +57,111 @@ FEATURE_COLS = [
     "release_age",
 ]
 
+_table_lock = threading.RLock()
+_table = {"prices": {}, "errors": {}, "day": None, "built": 0.0, "source": None, "checked": 0.0}
+_refresher = None
+
+
+def _score(rows):
+    """One CatBoost predict for a list of feature dicts."""
+    with timed("catboost"):
+        df = pd.DataFrame([[f[col] for col in FEATURE_COLS] for f in rows], columns=FEATURE_COLS)
+        return get("catboost").predict(df)
+
+
+def build_price_table() -> dict:
+    """Price every slug in the catalog with ONE predict call and swap the table in."""
+    with _table_lock:
+        get("catboost")
+        if _model_mtime() != _price_model_mtime:
+            unload("catboost")
+            get("catboost")
+            print("[PRICE] Reloaded sneaker_price_model.cbm")
+
+        start = time.perf_counter()
+        rows, slugs, errors = [], [], {}
+        for slug in all_slugs():
+            try:
+                rows.append(get_features_for_slug(slug))
+                slugs.append(slug)
+            except Exception as exc:
+                errors[slug] = str(exc)
+
+        prices = {}
+        if rows:
+            for slug, features, price in zip(slugs, rows, _score(rows)):
+                prices[slug] = (float(price), features)
+
+        _table.update(
+            prices=prices,
+            errors=errors,
+            day=date.today(),
+            built=time.time(),
+            source=(_price_model_mtime, catalog_version()),
+            checked=time.monotonic(),
+        )
+        print(f"[PRICE] Priced {len(prices)} slugs in {time.perf_counter() - start:.2f}s")
+        return price_table_stats()
+
+
+def _is_stale() -> bool:
+    if _table["day"] is None:
+        return True
+    if _table["day"] != date.today():
+        return True
+    if PRICE_TABLE_MAX_AGE_HOURS and time.time() - _table["built"] > PRICE_TABLE_MAX_AGE_HOURS * 3600:
+        return True
+    if time.monotonic() - _table["checked"] < PRICE_TABLE_CHECK_SECONDS:
+        return False
+    if _table["source"] != (_model_mtime(), catalog_version()):
+        return True
+    _table["checked"] = time.monotonic()
+    return False
+
+
+def price_table_ready() -> bool:
+    """True once the table has been built in this process."""
+    return _table["day"] is not None
+
+
+def _price_table() -> dict:
+    if _is_stale():
+        with _table_lock:
+            if _is_stale():  # another thread may have rebuilt it meanwhile
+                build_price_table()
+    return _table["prices"]
+
+
+def price_table() -> dict:
+    """{slug: predicted price} for every priced catalog slug."""
+    return {slug: price for slug, (price, _) in _price_table().items()}
+
+
+def price_table_stats() -> dict:
+    return {
+        "slugs": len(_table["prices"]),
+        "errors": len(_table["errors"]),
+        "built_at": _table["built"] or None,
+    }
+
+
+def _refresh_loop():
+    while True:
+        time.sleep(max(PRICE_TABLE_CHECK_SECONDS, 1.0))
+        try:
+            _price_table()
+        except Exception as exc:
+            print(f"[PRICE] Price table refresh failed: {exc}")
+
+
+def warm_price_table():
+    """Build the table now and keep it fresh from a background thread (call at startup)."""
+    global _refresher
+    _price_table()
+    if _refresher is None:
+        _refresher = threading.Thread(target=_refresh_loop, name="price-table", daemon=True)
+        _refresher.start()
+
 
 def predict_price_for_slug(slug: str):
     """
@@ -31,7 +170,39 @@ def predict_price_for_slug(slug: str):
         price (float),
         feature_row (dict)  # good for debugging/returning to user
     """
+    hit = _price_table().get(slug)
+    if hit is not None:
+        return hit
+    # not in the table (unknown slug raises KeyError here)
     features = get_features_for_slug(slug)
-    df = pd.DataFrame([[features[col] for col in FEATURE_COLS]], columns=FEATURE_COLS)
-    price = float(_price_model.predict(df)[0])
+    price = float(_score([features])[0])
     return price, features
+
+
+def predict_prices_for_slugs(slugs):
+    """
+    Prices for several slugs, served from the price table (slugs missing from it
+    are scored together in ONE CatBoost predict call).
+    returns: list aligned with slugs of (price, feature_row, error);
+             price/feature_row are None and error is a message when the slug is unknown
+    """
+    table = _price_table()
+    results = [None] * len(slugs)
+    rows, positions = [], []
+    for pos, slug in enumerate(slugs):
+        hit = table.get(slug)
+        if hit is not None:
+            results[pos] = (hit[0], hit[1], None)
+            continue
+        try:
+            features = get_features_for_slug(slug)
+        except Exception as exc:
+            results[pos] = (None, None, str(exc))
+            continue
+        rows.append(features)
+        positions.append(pos)
+
+    if rows:
+        for pos, features, price in zip(positions, rows, _score(rows)):
+            results[pos] = (float(price), features, None)
+    return results
@@ -1,6 +1,8 @@
 from pathlib import Path
 import random
 
+from .dataset_manifest import has_class, slugs_for_class
+
 # project root = .../sneaker_app
 PROJECT_ROOT = Path(__file__).resolve().parents[1]
 GOAT_DATA_ROOT = PROJECT_ROOT / "Scraping_part" / "goat_data"
@@ -11,15 +13,16 @@ def get_slug_for_class(class_name: str) -> str:
     Given class_name e.g. 'adidas_samba', look in:
         Scraping_part/goat_data/adidas_samba/
     and return one subfolder name (GOAT slug).
+    Reads the cached dataset manifest instead of listing the folder.
     """
     class_dir = GOAT_DATA_ROOT / class_name
-    if not class_dir.exists():
+    if not has_class(class_name):
         raise FileNotFoundError(f"Class folder not found: {class_dir}")
 
-    candidates = [p.name for p in class_dir.iterdir() if p.is_dir()]
+    # sorted by the manifest
+    candidates = slugs_for_class(class_name)
     if not candidates:
         raise FileNotFoundError(f"No slug folders in {class_dir}")
 
     # deterministic: always pick the first sorted slug to keep predictions stable
-    candidates.sort()
     return candidates[0]
@@ -1,8 +1,28 @@
+import io
+import os
+
 from PIL import Image
 import torch
 from torchvision import transforms
 
 
+# Shared preprocessing front end: every image is decoded ONCE at a reduced
+# "working" resolution (short side WORKING_SIZE), and both the ResNet and the
+# CLIP input tensors are cut from that same small image.
+WORKING_SIZE = int(os.environ.get("IMAGE_WORKING_SIZE", "256"))
+
+# CLIP ViT-B/32 preprocessing constants (same as CLIPProcessor)
+CLIP_SIZE = 224
+CLIP_MEAN = [0.48145466, 0.4578275, 0.40821073]
+CLIP_STD = [0.26862954, 0.26130258, 0.27577711]
+
+# Identifies how CLIP inputs are produced. It is stored with every FAISS index, so
+# build_indexes.py re-embeds indexes made by another pipeline (e.g. the old
+# CLIPProcessor .pkl caches, or a different WORKING_SIZE). Bump it when the transform changes.
+# Equivalence vs CLIPProcessor: python -m ai.backends --clip-preprocess --val-dir ...
+CLIP_PREPROCESS_VERSION = f"v2-ws{WORKING_SIZE}"
+
+
 # basic ResNet50 preprocessing – your teammate can adjust if needed
 _transform = transforms.Compose([
     transforms.Resize(256),
@@ -14,12 +34,54 @@ _transform = transforms.Compose([
     ),
 ])
 
+_clip_transform = transforms.Compose([
+    transforms.Resize(CLIP_SIZE, interpolation=transforms.InterpolationMode.BICUBIC),
+    transforms.CenterCrop(CLIP_SIZE),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=CLIP_MEAN, std=CLIP_STD),
+])
+
+
+def decode_image(source, working_size: int = None) -> Image.Image:
+    """
+    bytes / path / PIL image -> RGB PIL image whose short side is at most working_size.
+    JPEGs are decoded with draft mode (DCT scaling by 1/2, 1/4 or 1/8), so a 12MP
+    phone photo never materializes at full resolution; one resize finishes the job.
+    """
+    working_size = working_size or WORKING_SIZE
+    if isinstance(source, Image.Image):
+        img = source
+    else:
+        img = Image.open(io.BytesIO(source) if isinstance(source, (bytes, bytearray)) else source)
+        w, h = img.size
+        if min(w, h) > working_size:
+            scale = working_size / min(w, h)
+            # draft picks the largest reduction that still keeps the requested size
+            img.draft("RGB", (int(w * scale) + 1, int(h * scale) + 1))
+
+    if img.mode != "RGB":
+        img = img.convert("RGB")
+
+    w, h = img.size
+    if min(w, h) > working_size:
+        scale = working_size / min(w, h)
+        img = img.resize((round(w * scale), round(h * scale)), Image.BICUBIC, reducing_gap=2.0)
+    return img
+
+
+def resnet_tensor(img: Image.Image) -> torch.Tensor:
+    """RGB image -> ResNet50 input of shape (1, 3, 224, 224)."""
+    return _transform(img).unsqueeze(0)
+
+
+def clip_tensor(img: Image.Image) -> torch.Tensor:
+    """RGB image -> CLIP pixel_values of shape (1, 3, 224, 224)."""
+    return _clip_transform(img).unsqueeze(0)
+
 
 def load_image(path):
     """
-    path: pathlib.Path or string path to saved image
+    path: pathlib.Path or string path to saved image (or an already decoded PIL image)
     returns: tensor of shape (1, 3, 224, 224)
     """
-    img = Image.open(path).convert("RGB")
-    tensor = _transform(img).unsqueeze(0)
-    return tensor
+    return resnet_tensor(decode_image(path))
@@ -1,26 +1,79 @@
+import contextvars
+import functools
 import io
+import json
 import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import quote
 
+import numpy as np
 from bson import ObjectId
-from flask import Flask, jsonify, request, send_file
-from werkzeug.utils import secure_filename
-
-from ai.image_model import predict_class
-from ai.price_model import predict_price_for_slug
+from flask import Flask, Response, g, jsonify, make_response, request, send_file, stream_with_context
+
+from ai.catalog import get_catalog
+from ai.catalog import is_loaded as catalog_loaded
+from ai.clip_features import clip_backend, clip_batcher_stats, encode_image, encode_images
+from ai.dataset_manifest import dataset_stats, has_file
+from ai.dataset_manifest import is_loaded as dataset_manifest_loaded
+from ai.dataset_manifest import refresh as refresh_dataset_manifest
+from ai.image_model import (
+    classifier_backend,
+    image_probabilities,
+    images_probabilities,
+    predict_from_probs,
+    resnet_batcher_stats,
+)
+from ai.metrics import begin_timings, current_timings, end_timings, gauge, inc, observe, render, timed
+from ai.model_registry import memory_report, readiness, register, warm_up
+from ai.price_model import (
+    build_price_table,
+    predict_price_for_slug,
+    predict_prices_for_slugs,
+    price_table,
+    price_table_ready,
+    price_table_stats,
+    warm_price_table,
+)
 from ai.slug_selector import get_slug_for_class
-from faiss_search import search_in_class
-from inventory import add_or_update_inventory, find_inventory, fs, inventory_col
-from is_a_sneaker import is_sneaker
+from faiss_search import (
+    QUERY_AUGMENTATION,
+    index_cache_stats,
+    index_version,
+    prewarm_indexes,
+    search_batch_in_class,
+    search_in_class,
+    tta_stats,
+)
+from global_search import GLOBAL_NAME, global_index_available, global_index_stale, search_global
+from inventory import (
+    add_or_update_inventory,
+    connect,
+    find_inventory,
+    get_fs,
+    get_inventory_col,
+    is_connected,
+    reprice_inventory,
+)
+from is_a_sneaker import (
+    gate_signature,
+    is_sneaker,
+    is_sneaker_batch,
+    prompt_embeddings_ready,
+    warm_prompt_embeddings,
+)
+import profiling
 from product_info import get_product_info
+from prototype_classifier import CLASSIFIER_MODE, classify, needs_resnet, prototype_stats, refresh_prototypes
+import result_cache
+from uploads import PERSIST_UPLOADS, UPLOAD_DIR, get_upload_bytes, read_upload
 
 # ----------------------------------
 # CONFIG
 # ----------------------------------
 BASE_DIR = Path(__file__).resolve().parent
-UPLOAD_DIR = BASE_DIR / "uploads"
-UPLOAD_DIR.mkdir(exist_ok=True)
 
 DATA_ROOT = BASE_DIR / "Scraping_part" / "goat_data"
 FAISS_CACHE = BASE_DIR / "faiss_cache"
@@ -31,6 +84,41 @@ ALLOWED_EXT = {"jpg", "jpeg", "png"}
 CONFIDENCE_LOW = 0.45
 CONFIDENCE_HIGH = 0.70
 
+# /predict stages that only need class_name run concurrently on this pool;
+# SPECULATIVE_CLASSIFY also starts the classifier in parallel with the sneaker gate
+# (only in CLASSIFIER_MODE=resnet: the prototype/cascade modes try to skip the ResNet)
+STAGE_WORKERS = int(os.environ.get("PREDICT_STAGE_WORKERS", "16"))
+SPECULATIVE_CLASSIFY = os.environ.get("SPECULATIVE_CLASSIFY", "1") not in {"0", "false", "False", "no"}
+_stage_pool = ThreadPoolExecutor(max_workers=STAGE_WORKERS, thread_name_prefix="predict-stage")
+
+
+def _submit(stage, fn, *args):
+    """Run fn on the stage pool, timed as `stage` and inside the request's timings context."""
+
+    def run():
+        with timed(stage):
+            return profiling.run_profiled(fn, *args)
+
+    return _stage_pool.submit(contextvars.copy_context().run, run)
+
+
+# load every component in parallel in the background as each worker starts serving
+# (warm_up_worker; /ready flips once done);
+# WARMUP_DUMMY_INFERENCE=1 additionally runs one dummy forward per model
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "1") not in {"0", "false", "False", "no"}
+
+# Non-model startup work, tracked next to the models so /ready can report it.
+# Nothing is loaded at import time: each loader runs on first use or in warm_up().
+# Request paths reach these through their own modules; the probe reports that to /ready.
+register("catalog", get_catalog, unloadable=False, probe=catalog_loaded)
+register("dataset_manifest", refresh_dataset_manifest, unloadable=False, probe=dataset_manifest_loaded)
+register("mongo", connect, unloadable=False, probe=is_connected)
+register("price_table", warm_price_table, unloadable=False, probe=price_table_ready)
+register("prompt_embeddings", warm_prompt_embeddings, unloadable=False, probe=prompt_embeddings_ready)
+register("faiss_prewarm", prewarm_indexes, unloadable=False, required=False)
+if CLASSIFIER_MODE != "resnet":
+    register("prototypes", refresh_prototypes, unloadable=False, required=False)
+
 
 def confidence_level(score: float):
     if score >= CONFIDENCE_HIGH:
@@ -86,6 +174,138 @@ def _relative_to_data_root(path_str: str) -> str:
         return str(p.as_posix())
 
 
+# ----------------------------------
+# PREDICT STAGES (run on _stage_pool)
+# ----------------------------------
+def _similarity_stage(query_img, query_embedding, pred, scope, rebuild_index, image_id=None, cached=None):
+    """FAISS search for the query; reuses a cached result while its index version is unchanged."""
+    result = _cached_similarity(query_img, query_embedding, pred, scope, rebuild_index, image_id, cached)
+    if scope in {"top", "global"}:
+        if not global_index_available():
+            # say so instead of silently narrowing the search to one class
+            result = dict(result, fallback="class", message="Global index not built; searched the predicted class only")
+        elif global_index_stale():
+            result = dict(result, stale=True)
+    return result
+
+
+def _cached_similarity(query_img, query_embedding, pred, scope, rebuild_index, image_id, cached):
+    use_global = scope in {"top", "global"} and global_index_available()
+    if use_global:
+        classes = None if scope == "global" else [c["class_name"] for c in pred["top_classes"]]
+        scope_key = "global" if classes is None else "top:" + ",".join(sorted(classes))
+        version = index_version(GLOBAL_NAME)
+    else:
+        scope_key = "class:" + pred["class_name"]
+        version = index_version(pred["class_name"])
+
+    if rebuild_index:
+        return _run_similarity(query_img, query_embedding, pred, scope, rebuild_index, use_global)
+
+    hit = result_cache.cached_similar(cached or {}, scope_key, version)
+    if hit is not None:
+        return hit
+
+    result = _run_similarity(query_img, query_embedding, pred, scope, rebuild_index, use_global)
+    if result["source"] != "error":
+        # tagged with the version read before searching: if the index is rebuilt
+        # meanwhile, this entry is already stale and will not be served
+        result_cache.store_similar(image_id, scope_key, version, result)
+    return result
+
+
+def _run_similarity(query_img, query_embedding, pred, scope, rebuild_index, use_global):
+    try:
+        if use_global:
+            classes = None if scope == "global" else [c["class_name"] for c in pred["top_classes"]]
+            similar = search_global(
+                query_img=query_img,
+                top_k=5,
+                classes=classes,
+                use_query_augmentation=QUERY_AUGMENTATION,
+                query_embedding=query_embedding,
+                confidence=float(pred["confidence"]),
+            )
+            source = scope
+        else:
+            similar = search_in_class(
+                query_img=query_img,
+                class_name=pred["class_name"],
+                top_k=5,
+                use_query_augmentation=QUERY_AUGMENTATION,
+                augment_index=False,
+                rebuild_index=rebuild_index,
+                query_embedding=query_embedding,
+                confidence=float(pred["confidence"]),
+            )
+            source = "cache"
+        return {"items": normalize_similar_items(similar), "source": source}
+    except Exception as exc:
+        return {"items": [], "source": "error", "message": str(exc)}
+
+
+def _pricing_stage(class_name):
+    fields = {}
+    try:
+        slug = get_slug_for_class(class_name)
+        fields["slug_used"] = slug
+        price, feature_row = predict_price_for_slug(slug)
+        fields["predicted_price"] = round(float(price), 2)
+        fields["retail_price_usd"] = feature_row.get("retail_price_usd")
+        fields["release_age"] = feature_row.get("release_age")
+        fields["silhouette"] = feature_row.get("silhouette")
+    except Exception as exc:
+        fields["pricing_error"] = str(exc)
+    return fields
+
+
+def _classification_fields(pred, level):
+    return {
+        "class_name": pred["class_name"],
+        "brand": pred["brand"],
+        "model_name": pred["model_name"],
+        "product_name": f"{pred['brand']} {pred['model_name']}".strip(),
+        "product_type": pred["class_name"],
+        "confidence": float(pred["confidence"]),
+        "confidence_level": level,
+    }
+
+
+def _apply_product_info(response, info):
+    """Product info from CSV (read-only display; override brand/model/retail if available)."""
+    response["product_info"] = info
+    if info:
+        response["brand"] = info.get("brand") or response.get("brand")
+        response["product_name"] = info.get("product_name") or response.get("product_name")
+        response["retail_price_usd"] = info.get("retail_price_usd") or response.get("retail_price_usd")
+        response["silhouette"] = info.get("silhouette") or response.get("silhouette")
+
+
+def _apply_status(response, level):
+    if level == "low":
+        response["status"] = "low_confidence"
+        response["decision"] = "manual_check"
+        response["message"] = "Confidence below 45%; please confirm or override."
+    else:
+        response["status"] = "ok"
+        response["decision"] = "continue"
+
+
+NOT_SNEAKER = {
+    "status": "not_sneaker",
+    "decision": "stop",
+    "message": "Uploaded image is not recognized as a sneaker.",
+}
+
+
+def _inventory_stage(class_name):
+    try:
+        slug = get_slug_for_class(class_name)
+    except Exception:
+        slug = None
+    return find_inventory(class_name=class_name, slug=slug)
+
+
 # ----------------------------------
 # FLASK APP
 # ----------------------------------
@@ -94,9 +314,99 @@ app = Flask(
     static_folder=str(BASE_DIR / "frontend" / "build" / "static"),
     static_url_path="/static",
 )
-app.config["UPLOAD_FOLDER"] = str(UPLOAD_DIR)
 REACT_BUILD = BASE_DIR / "frontend" / "build"
 
+gauge("index_cache_entries", lambda: index_cache_stats()["entries"], "FAISS indexes held in memory")
+gauge("index_cache_bytes", lambda: index_cache_stats()["bytes"], "Approximate bytes of cached FAISS indexes")
+
+
+_warmed = {"pid": None}
+_warm_lock = threading.Lock()
+
+
+def warm_up_worker():
+    """
+    Start the background warm-up once per process. Runs from the first request a
+    worker sees (usually a /ready or /health probe), so it also happens under
+    gunicorn/uwsgi, not only with `python app.py`. It is not started at import:
+    with a preloading master (gunicorn --preload) the warm-up threads and the locks
+    they hold would not survive the fork into the workers. A gunicorn
+    post_worker_init hook may call it too, to warm before the first request.
+    """
+    if not WARMUP_ON_START:
+        return
+    with _warm_lock:
+        if _warmed["pid"] == os.getpid():
+            return
+        _warmed["pid"] = os.getpid()
+    warm_up()
+
+
+@app.before_request
+def _start_request_metrics():
+    warm_up_worker()
+    g.request_start = time.perf_counter()
+    g.timings_token = begin_timings()
+
+
+@app.after_request
+def _record_request_metrics(resp):
+    # streamed responses (/predict/batch) are measured up to the start of the body
+    endpoint = request.endpoint or "unknown"
+    if "request_start" in g:
+        observe("request_seconds", time.perf_counter() - g.request_start, endpoint=endpoint)
+    inc("requests_total", endpoint=endpoint, status=resp.status_code)
+    return resp
+
+
+@app.teardown_request
+def _end_request_metrics(exc):
+    token = g.pop("timings_token", None)
+    if token is not None:
+        try:
+            end_timings(token)
+        except ValueError:  # reset from a different context (streamed body)
+            pass
+
+
+def _profilable(view):
+    """?profile=1 / X-Profile: 1 (PROFILING_ENABLED, see profiling.py) -> "profile" block in the JSON."""
+
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not profiling.requested(request.args, request.headers):
+            return view(*args, **kwargs)
+        session = profiling.try_start(request.endpoint or "request")
+        if session is None:
+            summary = {"error": "another request is being profiled"}
+            resp = make_response(view(*args, **kwargs))
+        else:
+            try:
+                resp = make_response(view(*args, **kwargs))
+            finally:
+                summary = profiling.finish(session)
+        if resp.is_json:
+            data = resp.get_json()
+            if isinstance(data, dict):
+                data["profile"] = summary
+                resp.set_data(json.dumps(convert_for_json(data), default=str))
+        return resp
+
+    return wrapper
+
+
+def _wants_timings() -> bool:
+    return request.args.get("timings") in {"1", "true", "True", "yes"}
+
+
+def _add_timings(response):
+    """?timings=1 -> per-stage milliseconds for this request in the JSON."""
+    if _wants_timings():
+        timings = dict(current_timings() or {})
+        timings["total"] = round((time.perf_counter() - g.request_start) * 1000, 2)
+        response["timings"] = timings
+    return response
+
 
 @app.route("/", defaults={"path": ""})
 @app.route("/<path:path>")
@@ -115,17 +425,55 @@ def serve_frontend(path):
         {
             "status": "ok",
             "message": "Frontend build not found. Use npm start (port 3000) or npm run build.",
-            "api": ["/health", "/predict", "/inventory", "/add-to-inventory"],
+            "api": ["/health", "/ready", "/metrics", "/predict", "/predict/batch", "/inventory", "/add-to-inventory", "/inventory/reprice"],
         }
     )
 
 
+def _inference_info(classified_by=None) -> dict:
+    """Backends the classifier / CLIP actually run on (CLASSIFIER_BACKEND, CLIP_BACKEND)."""
+    info = {"classifier_backend": classifier_backend(), "clip_backend": clip_backend()}
+    if classified_by is not None:
+        # "prototype" (CLIP centroids) or "resnet", see prototype_classifier.py
+        info["classified_by"] = classified_by
+    return info
+
+
 @app.route("/health", methods=["GET"])
 def health():
-    return jsonify({"status": "ok"})
+    """Liveness: answers as soon as the process serves requests, warm or not (see /ready)."""
+    return jsonify(
+        {
+            "status": "ok",
+            "models": memory_report(),
+            "index_cache": index_cache_stats(),
+            "batching": {"clip": clip_batcher_stats(), "resnet50": resnet_batcher_stats()},
+            "inference": _inference_info(),
+            "classifier": prototype_stats(),
+            "result_cache": result_cache.result_cache_stats(),
+            "query_tta": tta_stats(),
+            "price_table": price_table_stats(),
+            "dataset": dataset_stats(),
+        }
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    """Prometheus scrape endpoint: stage/request latency histograms, cache and batching counters."""
+    return Response(render(), mimetype="text/plain; version=0.0.4")
+
+
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness: 200 once every required component is loaded, 503 before; per-component state/timings."""
+    report = readiness()
+    report["status"] = "ready" if report["ready"] else "starting"
+    return jsonify(report), (200 if report["ready"] else 503)
 
 
 @app.route("/predict", methods=["POST"])
+@_profilable
 def predict():
     if "file" not in request.files:
         return jsonify({"error": "No file part in request"}), 400
@@ -137,93 +485,267 @@ def predict():
     if ext not in ALLOWED_EXT:
         return jsonify({"error": "Unsupported file type"}), 400
 
-    # persist upload for debugging / FAISS query
-    filename = secure_filename(file.filename)
-    save_path = UPLOAD_DIR / filename
-    file.save(save_path)
+    # read + decode once in memory; every stage below shares this PIL image
+    try:
+        with timed("decode"):
+            upload = read_upload(file)
+    except Exception:
+        return jsonify({"error": "Could not decode image"}), 400
+    query_img = upload.image
 
     rebuild_index = request.args.get("rebuild_index") in {"1", "true", "True", "yes"}
 
-    response = {"image_path": str(save_path)}
+    # image_id lets /add-to-inventory attach the bytes later without a re-upload
+    response = {"image_id": upload.image_id}
+    if PERSIST_UPLOADS:
+        response["image_path"] = str(UPLOAD_DIR / f"{upload.image_id}.{upload.ext}")
+
+    # repeated upload of the same bytes -> reuse embedding / gate / probs / similar results
+    cached = result_cache.lookup(upload.image_id)
+    response["result_cache"] = "hit" if cached else "miss"
+
+    # speculatively start the classifier while the gate runs; discarded if the gate says no
+    pred_future = None
+    if SPECULATIVE_CLASSIFY and CLASSIFIER_MODE == "resnet" and "probs" not in cached:
+        pred_future = _submit("resnet", image_probabilities, query_img)
+
+    # 1) Sneaker gate (embedding-first: the clean CLIP vector is reused by FAISS)
+    if "embedding" in cached:
+        query_embedding = np.asarray(cached["embedding"], dtype="float32")
+    else:
+        with timed("clip_embed"):
+            query_embedding = encode_image(query_img)
+        result_cache.store(upload.image_id, embedding=query_embedding.tolist())
 
-    # 1) Sneaker gate
-    gate = is_sneaker(save_path)
+    sig = gate_signature()
+    if cached.get("gate", {}).get("sig") == sig:
+        gate = cached["gate"]["result"]
+    else:
+        with timed("gate"):
+            gate = is_sneaker(image_embedding=query_embedding)
+        result_cache.store(upload.image_id, gate={"sig": sig, "result": gate})
     response["sneaker_check"] = gate
     if not gate["is_sneaker"]:
-        response.update(
-            {
-                "status": "not_sneaker",
-                "decision": "stop",
-                "message": "Uploaded image is not recognized as a sneaker.",
-            }
-        )
-        return jsonify(response)
-
-    # 2) Classification
-    pred = predict_class(save_path)
+        response.update(NOT_SNEAKER)
+        if pred_future is not None:
+            pred_future.cancel()
+        return jsonify(_add_timings(response))
+
+    # 2) Classification (CLASSIFIER_MODE: ResNet, CLIP centroids, or centroids with ResNet fallback)
+    def resnet_probs():
+        if "probs" in cached:
+            return cached["probs"]
+        if pred_future is not None:
+            probs = pred_future.result()
+        else:
+            # cascade fallback: the forward runs inside "classify", recorded as its own stage too
+            with timed("resnet"):
+                probs = image_probabilities(query_img)
+        probs = probs.tolist()
+        result_cache.store(upload.image_id, probs=probs)
+        return probs
+
+    with timed("classify"):
+        probs, classified_by = classify(query_embedding, resnet_probs)
+    pred = predict_from_probs(probs)
     class_name = pred["class_name"]
     conf = float(pred["confidence"])
     level = confidence_level(conf)
 
-    response.update(
-        {
-            "class_name": class_name,
-            "brand": pred["brand"],
-            "model_name": pred["model_name"],
-            "product_name": f"{pred['brand']} {pred['model_name']}".strip(),
-            "product_type": class_name,
-            "confidence": conf,
-            "confidence_level": level,
-        }
+    response.update(_classification_fields(pred, level))
+
+    # 3-6) Everything below only depends on class_name -> run concurrently
+    #    scope=class (default): predicted class only; scope=top: the classifier's top-k
+    #    classes (default when confidence is low); scope=global: whole catalog.
+    scope = request.args.get("scope") or ("top" if level == "low" else "class")
+    similar_future = _submit(
+        "similarity",
+        _similarity_stage, query_img, query_embedding, pred, scope, rebuild_index, upload.image_id, cached
     )
+    pricing_future = _submit("pricing", _pricing_stage, class_name)
+    info_future = _submit("product_info", get_product_info, class_name)
+    inventory_future = _submit("inventory", _inventory_stage, class_name)
 
     # 3) Similarity search (FAISS over scraped images)
-    try:
-        similar = search_in_class(
-            query_img=save_path,
-            class_name=class_name,
-            top_k=5,
-            use_query_augmentation=True,
-            augment_index=False,
-            rebuild_index=rebuild_index,
-        )
-        response["similar_images"] = {"items": normalize_similar_items(similar), "source": "cache"}
-    except Exception as exc:
-        response["similar_images"] = {"items": [], "source": "error", "message": str(exc)}
+    response["similar_images"] = similar_future.result()
 
     # 4) Choose slug & price prediction
-    try:
-        slug = get_slug_for_class(class_name)
-        response["slug_used"] = slug
-        price, feature_row = predict_price_for_slug(slug)
-        response["predicted_price"] = round(float(price), 2)
-        response["retail_price_usd"] = feature_row.get("retail_price_usd")
-        response["release_age"] = feature_row.get("release_age")
-        response["silhouette"] = feature_row.get("silhouette")
-    except Exception as exc:
-        response["pricing_error"] = str(exc)
+    response.update(pricing_future.result())
 
     # 5) Product info from CSV (read-only display; override brand/model/retail if available)
-    info = get_product_info(class_name)
-    response["product_info"] = info
-    if info:
-        response["brand"] = info.get("brand") or response.get("brand")
-        response["product_name"] = info.get("product_name") or response.get("product_name")
-        response["retail_price_usd"] = info.get("retail_price_usd") or response.get("retail_price_usd")
-        response["silhouette"] = info.get("silhouette") or response.get("silhouette")
+    _apply_product_info(response, info_future.result())
 
     # 6) Inventory lookup
-    response["inventory"] = find_inventory(class_name=class_name, slug=response.get("slug_used"))
+    response["inventory"] = inventory_future.result()
+    response["inference"] = _inference_info(classified_by)
 
-    if level == "low":
-        response["status"] = "low_confidence"
-        response["decision"] = "manual_check"
-        response["message"] = "Confidence below 45%; please confirm or override."
-    else:
-        response["status"] = "ok"
-        response["decision"] = "continue"
+    _apply_status(response, level)
+
+    return jsonify(convert_for_json(_add_timings(response)))
 
-    return jsonify(convert_for_json(response))
+
+@app.route("/predict/batch", methods=["POST"])
+def predict_batch():
+    """
+    Multi-image /predict. Accepts N files under "files" and streams one JSON object
+    per line (application/x-ndjson) as each item is done. Gate, classifier and CLIP
+    run as real batches, FAISS queries are grouped per predicted class into one
+    multi-row search, and all slugs are priced with a single CatBoost call.
+    Query-time augmentation is not applied here.
+    """
+    files = request.files.getlist("files") or request.files.getlist("file")
+    files = [f for f in files if f.filename]
+    if not files:
+        return jsonify({"error": "No files in request"}), 400
+
+    items, rejected = [], []
+    for pos, file in enumerate(files):
+        ext = file.filename.split(".")[-1].lower()
+        if ext not in ALLOWED_EXT:
+            rejected.append({"index": pos, "filename": file.filename, "error": "Unsupported file type"})
+            continue
+        try:
+            upload = read_upload(file)
+        except Exception:
+            rejected.append({"index": pos, "filename": file.filename, "error": "Could not decode image"})
+            continue
+        items.append({"index": pos, "filename": file.filename, "image_id": upload.image_id, "_img": upload.image})
+
+    def line(obj):
+        return json.dumps(convert_for_json(obj), default=str) + "\n"
+
+    def generate():
+        for err in rejected:
+            yield line(err)
+        if not items:
+            return
+
+        # 1) Gate: one CLIP forward for the images not in the result cache + one matmul
+        imgs = [item.pop("_img") for item in items]
+        cached = [result_cache.lookup(item["image_id"]) for item in items]
+        missing = [k for k, c in enumerate(cached) if "embedding" not in c]
+        with timed("clip_embed"):
+            fresh = dict(zip(missing, encode_images([imgs[k] for k in missing]))) if missing else {}
+        for k, emb in fresh.items():
+            result_cache.store(items[k]["image_id"], embedding=emb.tolist())
+        embeddings = np.vstack([
+            fresh[k] if k in fresh else np.asarray(c["embedding"], dtype="float32") for k, c in enumerate(cached)
+        ])
+        keep = []
+        with timed("gate"):
+            gates = is_sneaker_batch(embeddings)
+        for k, (item, gate) in enumerate(zip(items, gates)):
+            item["sneaker_check"] = gate
+            if gate["is_sneaker"]:
+                keep.append(k)
+            else:
+                item.update(NOT_SNEAKER)
+                yield line(item)
+        if not keep:
+            return
+
+        # 2) Classification: CLIP centroids where CLASSIFIER_MODE allows, one batched
+        #    ResNet forward for the rest (cached probabilities reused)
+        with timed("classify"):
+            todo = [k for k in keep if "probs" not in cached[k] and needs_resnet(embeddings[k])]
+            batch_probs = []
+            if todo:
+                try:
+                    with timed("resnet"):
+                        batch_probs = images_probabilities([imgs[k] for k in todo])
+                except Exception as exc:
+                    # retried per item by resnet_probs below, so a failure only costs those items
+                    print(f"[PREDICT] Batched ResNet forward failed: {exc}")
+            for k, probs in zip(todo, batch_probs):
+                cached[k]["probs"] = probs.tolist()
+                result_cache.store(items[k]["image_id"], probs=cached[k]["probs"])
+
+        def resnet_probs(k):
+            if "probs" not in cached[k]:  # centroids changed between the two checks
+                with timed("resnet"):
+                    cached[k]["probs"] = images_probabilities([imgs[k]])[0].tolist()
+            return cached[k]["probs"]
+
+        preds, classified_by = {}, {}
+        for k in keep:
+            try:
+                probs, classified_by[k] = classify(embeddings[k], lambda k=k: resnet_probs(k))
+                preds[k] = predict_from_probs(probs)
+            except Exception as exc:
+                items[k].update({"status": "error", "decision": "stop", "error": f"Classification failed: {exc}"})
+                yield line(items[k])
+        if not preds:
+            return
+
+        # 4) Slugs + one CatBoost call for every distinct slug
+        slug_by_class = {}
+        for class_name in {p["class_name"] for p in preds.values()}:
+            try:
+                slug_by_class[class_name] = get_slug_for_class(class_name)
+            except Exception as exc:
+                slug_by_class[class_name] = exc
+        slugs = sorted({v for v in slug_by_class.values() if isinstance(v, str)})
+        try:
+            with timed("pricing"):
+                priced = dict(zip(slugs, predict_prices_for_slugs(slugs)))
+        except Exception as exc:
+            # e.g. no CatBoost model file: same pricing_error /predict reports, per item
+            priced = {slug: (None, None, str(exc)) for slug in slugs}
+
+        # 3/5/6) per class: one multi-row FAISS search, product info, inventory
+        groups = {}
+        for k, pred in preds.items():
+            groups.setdefault(pred["class_name"], []).append(k)
+
+        for class_name, members in groups.items():
+            try:
+                with timed("similarity"):
+                    hits = search_batch_in_class(class_name, embeddings[members], top_k=5)
+                similar = [{"items": normalize_similar_items(h), "source": "cache"} for h in hits]
+            except Exception as exc:
+                similar = [{"items": [], "source": "error", "message": str(exc)}] * len(members)
+
+            slug = slug_by_class[class_name]
+            pricing = {}
+            if isinstance(slug, str):
+                pricing["slug_used"] = slug
+                price, feature_row, error = priced[slug]
+                if error:
+                    pricing["pricing_error"] = error
+                else:
+                    pricing["predicted_price"] = round(price, 2)
+                    pricing["retail_price_usd"] = feature_row.get("retail_price_usd")
+                    pricing["release_age"] = feature_row.get("release_age")
+                    pricing["silhouette"] = feature_row.get("silhouette")
+            else:
+                pricing["pricing_error"] = str(slug)
+
+            errors = {}
+            try:
+                with timed("product_info"):
+                    info = get_product_info(class_name)
+            except Exception as exc:
+                info, errors["product_info_error"] = None, str(exc)
+            try:
+                with timed("inventory"):
+                    inventory = find_inventory(class_name=class_name, slug=slug if isinstance(slug, str) else None)
+            except Exception as exc:
+                inventory, errors["inventory_error"] = [], str(exc)
+
+            for k, sim in zip(members, similar):
+                response = items[k]
+                level = confidence_level(float(preds[k]["confidence"]))
+                response.update(_classification_fields(preds[k], level))
+                response["similar_images"] = sim
+                response.update(pricing)
+                _apply_product_info(response, info)
+                response["inventory"] = inventory
+                response.update(errors)
+                response["inference"] = _inference_info(classified_by[k])
+                _apply_status(response, level)
+                yield line(response)
+
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
 
 
 @app.route("/add-to-inventory", methods=["POST"])
@@ -249,9 +771,18 @@ def add_inventory():
     price_modified = data.get("price")
     price_predicted = data.get("price_predicted") or data.get("predicted_price")
 
-    # Optional: attach uploaded image bytes
-    image_bytes = None
-    if "image_path" in data and data["image_path"]:
+    # Optional: attach uploaded image bytes (image_id from /predict, or a legacy image_path)
+    image_bytes, content_type = None, "image/jpeg"
+    warning = None
+    if data.get("image_id"):
+        stored = get_upload_bytes(data["image_id"])
+        if stored is None:
+            # e.g. /predict was served by another worker (or before a restart) and
+            # PERSIST_UPLOADS is off: save the item anyway, without its image
+            warning = "Image not found on this server (expired or uploaded to another worker); saved without image"
+        else:
+            image_bytes, content_type = stored
+    elif "image_path" in data and data["image_path"]:
         try:
             image_bytes = Path(data["image_path"]).read_bytes()
         except Exception:
@@ -263,7 +794,11 @@ def add_inventory():
         price_modified=price_modified,
         price_predicted=price_predicted,
         image_bytes=image_bytes,
+        content_type=content_type,
     )
+    result["image_attached"] = image_bytes is not None
+    if warning:
+        result["warning"] = warning
 
     return jsonify(result)
 
@@ -271,7 +806,7 @@ def add_inventory():
 @app.route("/inventory", methods=["GET"])
 def list_inventory():
     items = []
-    for item in inventory_col.find({}):
+    for item in get_inventory_col().find({}):
         item["_id"] = str(item["_id"])
         if item.get("image_gridfs_id"):
             item["image_gridfs_id"] = str(item["image_gridfs_id"])
@@ -279,10 +814,27 @@ def list_inventory():
     return jsonify(convert_for_json(items))
 
 
+@app.route("/dataset/refresh", methods=["POST"])
+def refresh_dataset():
+    """Re-scan the dataset manifest now (?full=1 also re-stats unchanged folders)."""
+    full = request.args.get("full") in {"1", "true", "True", "yes"}
+    return jsonify(refresh_dataset_manifest(full=full))
+
+
+@app.route("/inventory/reprice", methods=["POST"])
+def reprice_all_inventory():
+    """Re-price every inventory item from the precomputed price table in one pass."""
+    if request.args.get("rebuild") in {"1", "true", "True", "yes"}:
+        build_price_table()
+    summary = reprice_inventory(price_table())
+    summary["price_table"] = price_table_stats()
+    return jsonify(summary)
+
+
 @app.route("/image/<image_id>")
 def get_image(image_id):
     try:
-        gridout = fs.get(ObjectId(image_id))
+        gridout = get_fs().get(ObjectId(image_id))
     except Exception:
         return jsonify({"error": "not found"}), 404
     return send_file(io.BytesIO(gridout.read()), mimetype=gridout.content_type)
@@ -304,11 +856,18 @@ def serve_similar():
     except Exception:
         return jsonify({"error": "forbidden"}), 403
 
-    if not target_path.exists():
+    # manifest lookup first; only a miss (e.g. an image added since the last refresh) hits the disk
+    rel = target_path.relative_to(DATA_ROOT.resolve()).as_posix()
+    if not has_file(rel) and not target_path.exists():
         return jsonify({"error": "not found"}), 404
 
-    return send_file(target_path, mimetype="image/jpeg")
+    try:
+        return send_file(target_path, mimetype="image/jpeg")
+    except FileNotFoundError:
+        # listed in the manifest but deleted since its last refresh
+        return jsonify({"error": "not found"}), 404
 
 
 if __name__ == "__main__":
+    warm_up_worker()
     app.run(debug=True, host="0.0.0.0", port=5000)
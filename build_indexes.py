@@ -0,0 +1,96 @@
+"""
+Offline bulk builder for the per-class FAISS indexes.
+
+    python build_indexes.py                      # every class in ai/class_indices.json
+    python build_indexes.py adidas_samba vans_old_skool --batch-size 64 --workers 12
+    python build_indexes.py --rebuild            # re-embed classes that already have a cache
+    python build_indexes.py --refresh            # embed only new/changed images, drop deleted ones
+    python build_indexes.py --global             # then (re)build the cross-class index from the class caches
+
+Classes with an existing cache are skipped unless it was embedded under another
+embedding key (old .pkl caches, a different CLIP_BACKEND); those are rebuilt. A
+class interrupted mid-build resumes from its faiss_cache/<class>.partial.npz
+checkpoint, so the command can simply be re-run after a crash or Ctrl+C.
+"""
+import argparse
+import json
+import time
+from pathlib import Path
+
+import faiss_search
+from ai import dataset_manifest
+from ai.clip_features import embedding_key
+from faiss_search import get_or_build_index, index_embedding, is_cached, refresh_class_index
+from global_search import build_global_index
+
+BASE_DIR = Path(__file__).resolve().parent
+CLASS_INDICES_PATH = BASE_DIR / "ai" / "class_indices.json"
+
+
+def all_classes():
+    with open(CLASS_INDICES_PATH, "r") as f:
+        class_to_idx = json.load(f)
+    return sorted(class_to_idx, key=class_to_idx.get)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build FAISS indexes for sneaker classes.")
+    parser.add_argument("classes", nargs="*", help="class names (default: all classes)")
+    parser.add_argument("--batch-size", type=int, default=faiss_search.BUILD_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=faiss_search.BUILD_WORKERS)
+    parser.add_argument("--augment-index", action="store_true")
+    parser.add_argument("--rebuild", action="store_true", help="rebuild classes that are already cached")
+    parser.add_argument("--refresh", action="store_true", help="incrementally update classes that are already cached")
+    parser.add_argument("--global", dest="build_global", action="store_true",
+                        help="rebuild the cross-class index once the classes are done")
+    args = parser.parse_args()
+
+    faiss_search.BUILD_BATCH_SIZE = args.batch_size
+    faiss_search.BUILD_WORKERS = args.workers
+
+    dataset_manifest.refresh(full=args.rebuild or args.refresh)
+    classes = args.classes or all_classes()
+    started = time.perf_counter()
+    failed = []
+
+    for i, class_name in enumerate(classes, 1):
+        prefix = f"[{i}/{len(classes)}] {class_name}"
+        cached = is_cached(class_name)
+        # vectors from another pipeline: neither kept nor topped up incrementally
+        stale = cached and index_embedding(class_name) != embedding_key()
+        if cached and not (args.rebuild or args.refresh or stale):
+            print(f"{prefix}: cached, skipping")
+            continue
+        if not dataset_manifest.has_class(class_name):
+            print(f"{prefix}: no data folder, skipping")
+            failed.append(class_name)
+            continue
+
+        rebuild = args.rebuild or stale
+        if stale and not args.rebuild:
+            print(f"{prefix}: embedded with {index_embedding(class_name) or 'unknown'}, rebuilding for {embedding_key()}")
+
+        t0 = time.perf_counter()
+        try:
+            if cached and args.refresh and not rebuild:
+                summary = refresh_class_index(class_name, batch_size=args.batch_size, workers=args.workers)
+                action = "rebuilt" if summary.get("rebuilt") else "refreshed"
+                print(f"{prefix}: {action} in {time.perf_counter() - t0:.1f}s "
+                      f"(+{summary.get('added', 0)} ~{summary.get('changed', 0)} -{summary.get('removed', 0)})")
+                continue
+            index, _ = get_or_build_index(class_name, rebuild=rebuild, augment_index=args.augment_index)
+            print(f"{prefix}: {index.ntotal} vectors in {time.perf_counter() - t0:.1f}s")
+        except Exception as exc:
+            print(f"{prefix}: FAILED ({exc})")
+            failed.append(class_name)
+
+    if args.build_global:
+        t0 = time.perf_counter()
+        meta = build_global_index()
+        print(f"[global] {meta['ntotal']} vectors in {time.perf_counter() - t0:.1f}s")
+
+    print(f"Done in {time.perf_counter() - started:.1f}s; {len(failed)} class(es) not built: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,77 +2,100 @@
 FAISS similarity search scoped per class using CLIP embeddings.
 Builds/loads per-class indices under faiss_cache and searches top-k images.
 """
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Dict, Tuple, List
+from typing import Dict, Tuple, List, Optional
+import atexit
+import contextlib
+import hashlib
+import json
+import os
 import pickle
 import random
+import re
+import shutil
+import threading
+import time
 
 import faiss
 import numpy as np
-import torch
 from PIL import Image, ImageEnhance
-from transformers import CLIPModel, CLIPProcessor
+
+from ai.clip_features import embedding_key, encode_image, encode_images
+from ai import dataset_manifest
+from ai.metrics import inc, observe, timed
+from ai.utils import decode_image
 
 
 BASE_DIR = Path(__file__).resolve().parent
 DATA_ROOT = BASE_DIR / "Scraping_part" / "goat_data"
 INDEX_CACHE_DIR = BASE_DIR / "faiss_cache"
 INDEX_CACHE_DIR.mkdir(exist_ok=True)
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
-# ==== MODEL ====
-def _load_clip():
-    model_name = "openai/clip-vit-base-patch32"
-    try:
-        m = CLIPModel.from_pretrained(
-            model_name,
-            use_safetensors=True,
-            local_files_only=True,
-        ).to(DEVICE)
-        p = CLIPProcessor.from_pretrained(
-            model_name,
-            use_fast=True,
-            local_files_only=True,
-        )
-        return m, p
-    except Exception:
-        m = CLIPModel.from_pretrained(
-            model_name,
-            use_safetensors=True,
-        ).to(DEVICE)
-        p = CLIPProcessor.from_pretrained(model_name, use_fast=True)
-        return m, p
+# Bulk build settings (decode workers, CLIP batch size, checkpoint interval in batches)
+BUILD_BATCH_SIZE = int(os.environ.get("FAISS_BUILD_BATCH_SIZE", "32"))
+BUILD_WORKERS = int(os.environ.get("FAISS_BUILD_WORKERS", str(min(8, os.cpu_count() or 1))))
+CHECKPOINT_EVERY = 10
 
+# In-memory index cache budget (MB, 0 = unbounded) and how many popular classes to load at startup
+INDEX_CACHE_MAX_MB = float(os.environ.get("FAISS_CACHE_MAX_MB", "1024"))
+PREWARM_TOP_N = int(os.environ.get("FAISS_PREWARM_TOP_N", "0"))
+POPULARITY_FILE = INDEX_CACHE_DIR / "popularity.json"
 
-clip_model, clip_processor = _load_clip()
+# Index factory string used for new builds ("Flat", "HNSW32", "IVF1024,SQ8", "IVF1024,PQ64", "auto"),
+# per-class overrides in INDEX_TYPES_FILE ({"nike_air_jordan_1_high": "HNSW32"}), and search knobs.
+INDEX_TYPE = os.environ.get("FAISS_INDEX_TYPE", "Flat")
+INDEX_TYPES_FILE = Path(os.environ.get("FAISS_INDEX_TYPES_FILE", str(INDEX_CACHE_DIR / "index_types.json")))
+NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
 
-# Cache for indices in memory
-_index_cache: Dict[str, Tuple[faiss.Index, List[str]]] = {}
+# Query-time augmentation: "always" (6 views), "off" (clean view only) or "adaptive":
+# search with the clean view first and only add the augmented views when the top-1/top-2
+# score margin or the classifier confidence is low, and never while more than
+# TTA_MAX_INFLIGHT searches are running.
+QUERY_TTA = os.environ.get("FAISS_QUERY_TTA", "adaptive")
+TTA_MARGIN = float(os.environ.get("FAISS_TTA_MARGIN", "0.03"))
+# Classifier confidence below which TTA always runs. Same as app.CONFIDENCE_LOW: only
+# predictions the app itself labels "low" are augmented unconditionally. Medium ones
+# (0.45-0.70) usually have the right class already, and an ambiguous neighbour
+# ranking there is still caught by the TTA_MARGIN test. At 0.70 (CONFIDENCE_HIGH)
+# every non-high request was augmented, so adaptive mode saved almost nothing.
+TTA_CONFIDENCE = float(os.environ.get("FAISS_TTA_CONFIDENCE", "0.45"))
+TTA_MAX_INFLIGHT = int(os.environ.get("FAISS_TTA_MAX_INFLIGHT", "4"))
+# value for the use_query_augmentation argument of the search functions
+QUERY_AUGMENTATION = {"always": True, "off": False}.get(QUERY_TTA, "adaptive")
 
 
 # ==== AUGMENTATION ====
-def augment_image(img: Image.Image, strength: str = "light") -> List[Image.Image]:
-    """Apply random augmentations to image."""
+def image_seed(img: Image.Image) -> int:
+    """Stable seed derived from the pixels, so an image always gets the same augmentations."""
+    return int.from_bytes(hashlib.sha1(img.tobytes()).digest()[:8], "big")
+
+
+def augment_image(img: Image.Image, strength: str = "light", seed: Optional[int] = None) -> List[Image.Image]:
+    """Apply seeded random augmentations to image (seed defaults to image_seed(img))."""
+    rng = random.Random(image_seed(img) if seed is None else seed)
     augmented: List[Image.Image] = []
     augmented.append(img)
 
     if strength in ["light", "medium", "heavy"]:
         enhancer = ImageEnhance.Brightness(img)
-        augmented.append(enhancer.enhance(random.uniform(0.85, 1.15)))
+        augmented.append(enhancer.enhance(rng.uniform(0.85, 1.15)))
 
         enhancer = ImageEnhance.Contrast(img)
-        augmented.append(enhancer.enhance(random.uniform(0.9, 1.1)))
+        augmented.append(enhancer.enhance(rng.uniform(0.9, 1.1)))
 
     if strength in ["medium", "heavy"]:
         enhancer = ImageEnhance.Color(img)
-        augmented.append(enhancer.enhance(random.uniform(0.9, 1.1)))
+        augmented.append(enhancer.enhance(rng.uniform(0.9, 1.1)))
 
-        augmented.append(img.rotate(random.uniform(-10, 10), fillcolor=(255, 255, 255)))
+        augmented.append(img.rotate(rng.uniform(-10, 10), fillcolor=(255, 255, 255)))
 
         w, h = img.size
-        crop_size = int(min(w, h) * random.uniform(0.85, 0.95))
-        left = random.randint(0, w - crop_size)
-        top = random.randint(0, h - crop_size)
+        crop_size = int(min(w, h) * rng.uniform(0.85, 0.95))
+        left = rng.randint(0, w - crop_size)
+        top = rng.randint(0, h - crop_size)
         cropped = img.crop((left, top, left + crop_size, top + crop_size))
         augmented.append(cropped.resize((w, h), Image.LANCZOS))
 
@@ -80,131 +103,1074 @@ def augment_image(img: Image.Image, strength: str = "light") -> List[Image.Image
         augmented.append(img.transpose(Image.FLIP_LEFT_RIGHT))
 
         enhancer = ImageEnhance.Sharpness(img)
-        augmented.append(enhancer.enhance(random.uniform(0.8, 1.2)))
+        augmented.append(enhancer.enhance(rng.uniform(0.8, 1.2)))
 
     return augmented
 
 
-def embed_image(path: Path, augment: bool = False, aug_strength: str = "light") -> np.ndarray:
-    """Embed image with optional augmentation."""
-    img = Image.open(path).convert("RGB")
+def _as_rgb(img_or_path) -> Image.Image:
+    return decode_image(img_or_path)
 
-    if not augment:
-        inputs = clip_processor(images=img, return_tensors="pt").to(DEVICE)
-        with torch.no_grad():
-            emb = clip_model.get_image_features(**inputs)
-        v = emb[0].cpu().numpy()
-        return v / np.linalg.norm(v)
 
-    imgs = augment_image(img, strength=aug_strength)
-    embeddings = []
+def embed_image(
+    path,
+    augment: bool = False,
+    aug_strength: str = "light",
+    clean_embedding: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Embed image (path or PIL image) with optional augmentation.
+    `clean_embedding` is the already computed vector of the un-augmented
+    image; it is reused instead of running CLIP on that view again.
+    """
+    if not augment:
+        if clean_embedding is not None:
+            return clean_embedding
+        return encode_image(_as_rgb(path))
 
-    for aug_img in imgs:
-        inputs = clip_processor(images=aug_img, return_tensors="pt").to(DEVICE)
-        with torch.no_grad():
-            emb = clip_model.get_image_features(**inputs)
-        v = emb[0].cpu().numpy()
-        embeddings.append(v / np.linalg.norm(v))
+    imgs = augment_image(_as_rgb(path), strength=aug_strength, seed=seed)
 
-    return np.mean(embeddings, axis=0)
+    # augment_image always returns the original image first; all remaining
+    # views go through CLIP as a single batch.
+    if clean_embedding is not None and len(imgs) == 1:
+        return clean_embedding
+    if clean_embedding is not None:
+        embeddings = np.vstack([clean_embedding.reshape(1, -1), encode_images(imgs[1:])])
+    else:
+        embeddings = encode_images(imgs)
 
+    return embeddings.mean(axis=0)
 
-def build_class_index(class_dir: Path, augment_index: bool = False, aug_per_image: int = 5):
-    """
-    Build FAISS index for a class. Optionally augment each image multiple times.
-    """
-    vectors, paths = [], []
 
+# ==== INDEX BUILDING ====
+def _class_listing(class_dir: Path) -> Dict[str, Tuple[int, float]]:
+    """{path: (size, mtime)} of a class's images, from the dataset manifest when possible."""
+    if class_dir.resolve().parent == DATA_ROOT.resolve():
+        return {str(p): (size, mtime) for p, size, mtime in dataset_manifest.class_files(class_dir.name)}
+    listing = {}
     for slug_dir in class_dir.iterdir():
         if not slug_dir.is_dir():
             continue
         for ext in ("*.jpg", "*.jpeg", "*.png"):
-            for img_path in slug_dir.glob(ext):
-                try:
-                    if not augment_index:
-                        v = embed_image(img_path)
-                        vectors.append(v.astype("float32"))
-                        paths.append(str(img_path))
-                    else:
-                        img = Image.open(img_path).convert("RGB")
-                        augmented_imgs = augment_image(img, strength="medium")
-                        for aug_img in augmented_imgs[:aug_per_image]:
-                            inputs = clip_processor(images=aug_img, return_tensors="pt").to(DEVICE)
-                            with torch.no_grad():
-                                emb = clip_model.get_image_features(**inputs)
-                            v = emb[0].cpu().numpy()
-                            v_norm = v / np.linalg.norm(v)
-                            vectors.append(v_norm.astype("float32"))
-                            paths.append(str(img_path))
-                except Exception as e:
-                    print(f"[FAISS] Skip {img_path}: {e}")
+            for f in slug_dir.glob(ext):
+                st = f.stat()
+                listing[str(f)] = (st.st_size, st.st_mtime)
+    return listing
+
+
+def _sha1(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def _decode(path: Path) -> Optional[Tuple[Image.Image, str]]:
+    """Read + hash + decode one file (runs on the decode thread pool)."""
+    try:
+        data = path.read_bytes()
+        return decode_image(data), _sha1(data)  # reduced-size decode, CLIP only needs 224
+    except Exception as e:
+        print(f"[FAISS] Skip {path}: {e}")
+        return None
+
+
+def _iter_decoded_batches(files: List[Path], batch_size: int, workers: int):
+    """
+    Yield (paths, images, sha1s) batches. Images are decoded by a thread pool and
+    the next batch is already decoding while the caller runs CLIP on the current one.
+    """
+    batches = [files[i:i + batch_size] for i in range(0, len(files), batch_size)]
+    if not batches:
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit(batch):
+            return [(p, pool.submit(_decode, p)) for p in batch]
+
+        upcoming = submit(batches[0])
+        for k in range(len(batches)):
+            current = upcoming
+            upcoming = submit(batches[k + 1]) if k + 1 < len(batches) else []
+
+            ok_paths, imgs, hashes = [], [], []
+            for p, fut in current:
+                decoded = fut.result()
+                if decoded is not None:
+                    ok_paths.append(p)
+                    imgs.append(decoded[0])
+                    hashes.append(decoded[1])
+            yield ok_paths, imgs, hashes
+
+
+def _encode_in_chunks(imgs: List[Image.Image], batch_size: int) -> np.ndarray:
+    # bulk: bypasses the live-request micro-batcher
+    return np.vstack([encode_images(imgs[i:i + batch_size], bulk=True) for i in range(0, len(imgs), batch_size)])
+
+
+def _checkpoint_settings(augment_index: bool, aug_per_image: int) -> str:
+    """Build settings a checkpoint was made with; a checkpoint made with others is discarded."""
+    return json.dumps(
+        {"augment_index": bool(augment_index), "aug_per_image": aug_per_image, "embedding": embedding_key()},
+        sort_keys=True,
+    )
+
+
+def _save_checkpoint(
+    checkpoint_path: Path, vectors: List[np.ndarray], paths: List[str], hashes: Dict[str, str], settings: str
+):
+    # per-process tmp name: two workers building the same class never share a half-written file
+    tmp = checkpoint_path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp.npz")
+    np.savez(
+        tmp,
+        vectors=np.vstack(vectors),
+        paths=np.array(paths),
+        hashes=np.array([hashes[p] for p in paths]),
+        settings=np.array(settings),
+    )
+    tmp.replace(checkpoint_path)
+
+
+def _load_checkpoint(checkpoint_path: Path, settings: str, files: List[Path]):
+    """(vectors, owner paths, {path: sha1}) from a matching checkpoint, or None."""
+    try:
+        ckpt = np.load(checkpoint_path)
+        saved = str(ckpt["settings"]) if "settings" in ckpt.files else None
+        if saved != settings:
+            print(f"[FAISS] Ignoring {checkpoint_path.name}: built with other settings")
+            return None
+        owners = [str(p) for p in ckpt["paths"]]
+        current = {str(f) for f in files}
+        keep = np.array([p in current for p in owners], dtype=bool)  # files deleted since
+        vectors = ckpt["vectors"].astype("float32")[keep] if len(owners) else ckpt["vectors"].astype("float32")
+        owners = [p for p, k in zip(owners, keep) if k]
+        hashes = {p: str(h) for p, h in zip((str(p) for p in ckpt["paths"]), ckpt["hashes"]) if p in current}
+        return vectors, owners, hashes
+    except (OSError, ValueError, KeyError) as exc:
+        print(f"[FAISS] Ignoring unreadable checkpoint {checkpoint_path.name}: {exc}")
+        return None
+
+
+def _embed_files(
+    files: List[Path],
+    label: str,
+    augment_index: bool = False,
+    aug_per_image: int = 5,
+    batch_size: Optional[int] = None,
+    workers: Optional[int] = None,
+    checkpoint_path: Optional[Path] = None,
+):
+    """
+    Embed `files` with parallel decoding and batched CLIP forwards.
+    Returns (vectors (N, D) float32, owner path per vector, {path: sha1}).
+    """
+    batch_size = batch_size or BUILD_BATCH_SIZE
+    workers = workers or BUILD_WORKERS
+    vectors: List[np.ndarray] = []
+    paths: List[str] = []
+    hashes: Dict[str, str] = {}
+    settings = _checkpoint_settings(augment_index, aug_per_image)
+
+    resumed = _load_checkpoint(checkpoint_path, settings, files) if checkpoint_path and checkpoint_path.exists() else None
+    if resumed is not None and resumed[1]:
+        vectors.append(resumed[0])
+        paths.extend(resumed[1])
+        hashes.update(resumed[2])
+        print(f"[FAISS] Resuming {label} from checkpoint ({len(hashes)} images done)")
+
+    todo = [f for f in files if str(f) not in hashes]
+    total = len(files)
+    processed = total - len(todo)
+
+    for n, (batch_paths, imgs, batch_hashes) in enumerate(_iter_decoded_batches(todo, batch_size, workers), 1):
+        if imgs:
+            try:
+                if not augment_index:
+                    owners = batch_paths
+                    emb = _encode_in_chunks(imgs, batch_size)
+                else:
+                    owners, views = [], []
+                    for p, img in zip(batch_paths, imgs):
+                        for aug_img in augment_image(img, strength="medium")[:aug_per_image]:
+                            owners.append(p)
+                            views.append(aug_img)
+                    emb = _encode_in_chunks(views, batch_size)
+                vectors.append(emb.astype("float32"))
+                paths.extend(str(p) for p in owners)
+                hashes.update((str(p), h) for p, h in zip(batch_paths, batch_hashes))
+            except Exception as e:
+                print(f"[FAISS] Skip batch of {len(imgs)} images in {label}: {e}")
+
+        processed += len(batch_paths)
+        print(f"[FAISS] {label}: {processed}/{total} images embedded")
+        if checkpoint_path is not None and vectors and n % CHECKPOINT_EVERY == 0:
+            _save_checkpoint(checkpoint_path, vectors, paths, hashes, settings)
 
     if not vectors:
-        raise RuntimeError(f"No images found under {class_dir.resolve()}")
+        return np.zeros((0, 0), dtype="float32"), [], {}
+    return np.vstack(vectors), paths, hashes
+
+
+# ==== INDEX TYPES ====
+def _load_index_types() -> Dict[str, str]:
+    if not INDEX_TYPES_FILE.exists():
+        return {}
+    with open(INDEX_TYPES_FILE, "r") as f:
+        return json.load(f)
+
+
+def index_type_for(class_name: str, n_vectors: int) -> str:
+    """
+    FAISS factory string for a class: per-class override from INDEX_TYPES_FILE,
+    else FAISS_INDEX_TYPE. "auto" picks by size: brute force while small,
+    HNSW for mid-sized classes, IVF + 8-bit scalar quantizer beyond that.
+    """
+    spec = _load_index_types().get(class_name, INDEX_TYPE)
+    if spec == "auto":
+        if n_vectors < 10_000:
+            spec = "Flat"
+        elif n_vectors < 200_000:
+            spec = "HNSW32"
+        else:
+            spec = f"IVF{int(4 * np.sqrt(n_vectors))},SQ8"
+    return _fit_ivf(spec, n_vectors)
+
 
-    arr = np.stack(vectors)
+def _fit_ivf(spec: str, n_vectors: int) -> str:
+    """
+    Make a factory string trainable on n_vectors: shrink nlist so k-means gets ~39
+    training points per centroid, and drop PQ (which needs 2**nbits points per
+    sub-quantizer, 256 by default) for SQ8 -- or Flat without IVF -- below that.
+    """
+    pq = re.search(r"(?:^|,)(O?PQ\d+(?:x(\d+))?)", spec)
+    if pq and n_vectors < 2 ** int(pq.group(2) or 8):
+        spec = spec.replace(pq.group(1), "SQ8", 1) if spec.startswith("IVF") else "Flat"
+    m = re.match(r"IVF(\d+)", spec)
+    if not m:
+        return spec
+    nlist = max(1, min(int(m.group(1)), n_vectors // 39))
+    return spec.replace(m.group(0), f"IVF{nlist}", 1)
+
+
+def _new_index(dim: int, spec: str = "Flat") -> faiss.Index:
+    """Empty ID-mapped index so single entries can be added/removed by id."""
+    return faiss.IndexIDMap2(faiss.index_factory(dim, spec, faiss.METRIC_INNER_PRODUCT))
+
+
+def _tune_for_search(index: faiss.Index):
+    """Apply query-time knobs (HNSW efSearch, IVF nprobe) to a loaded index."""
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = EF_SEARCH
+    try:
+        faiss.extract_index_ivf(inner).nprobe = NPROBE
+    except RuntimeError:
+        pass
+
+
+def _add_vectors(index: faiss.Index, paths: Dict[int, str], manifest: dict, vectors: np.ndarray, owners: List[str]):
+    """Append vectors under fresh ids, updating the id->path table and manifest ids."""
+    arr = np.ascontiguousarray(vectors, dtype="float32")
     faiss.normalize_L2(arr)
+    if not index.is_trained:
+        print(f"[FAISS] Training {manifest.get('index_type')} on {len(arr)} vectors")
+        index.train(arr)
+    ids = np.arange(manifest["next_id"], manifest["next_id"] + len(owners), dtype="int64")
+    index.add_with_ids(arr, ids)
+    manifest["next_id"] += len(owners)
+    for i, path in zip(ids.tolist(), owners):
+        paths[i] = path
+        manifest["files"][path]["ids"].append(i)
 
-    index = faiss.IndexFlatIP(arr.shape[1])
-    index.add(arr)
 
-    unique_images = len(set(paths))
-    print(f"[FAISS] Indexed {len(paths)} embeddings ({unique_images} unique) for {class_dir.name}")
-    return index, paths
+def _manifest_entry(path: Path, sha1: Optional[str], stat: Optional[Tuple[int, float]] = None) -> dict:
+    """`stat` is a known (size, mtime), e.g. from the dataset manifest; stats the file otherwise."""
+    if stat is not None:
+        size, mtime = stat
+    else:
+        try:
+            st = path.stat()
+            size, mtime = st.st_size, st.st_mtime
+        except OSError:
+            size, mtime = None, None
+    return {"size": size, "mtime": mtime, "sha1": sha1, "ids": []}
+
+
+def build_class_index(
+    class_dir: Path,
+    augment_index: bool = False,
+    aug_per_image: int = 5,
+    batch_size: Optional[int] = None,
+    workers: Optional[int] = None,
+    checkpoint_path: Optional[Path] = None,
+):
+    """
+    Build FAISS index for a class. Optionally augment each image multiple times.
+    Images are decoded in parallel and embedded `batch_size` at a time; when
+    `checkpoint_path` is given, progress is saved periodically so an
+    interrupted build resumes where it stopped.
+    Returns (index, {id: path}, manifest).
+    """
+    listing = _class_listing(class_dir)
+    files = [Path(p) for p in listing]
+    vectors, owners, hashes = _embed_files(
+        files,
+        class_dir.name,
+        augment_index=augment_index,
+        aug_per_image=aug_per_image,
+        batch_size=batch_size,
+        workers=workers,
+        checkpoint_path=checkpoint_path,
+    )
+
+    if not owners:
+        raise RuntimeError(f"No images found under {class_dir.resolve()}")
+
+    spec = index_type_for(class_dir.name, len(owners))
+    manifest = {
+        "index_type": spec,
+        "augment_index": augment_index,
+        "aug_per_image": aug_per_image,
+        "next_id": 0,
+        "files": {p: _manifest_entry(Path(p), h, listing.get(p)) for p, h in hashes.items()},
+    }
+    index = _new_index(vectors.shape[1], spec)
+    paths: Dict[int, str] = {}
+    _add_vectors(index, paths, manifest, vectors, owners)
+    _tune_for_search(index)
+
+    print(f"[FAISS] Indexed {len(owners)} embeddings ({len(hashes)} unique) for {class_dir.name} [{spec}]")
+    return index, paths, manifest
+
+
+# ==== PERSISTENCE ====
+# Per class, faiss_cache holds:
+#   <class>.current                  name of the live version (swapped with one rename)
+#   <class>.versions/<v>/index.faiss native FAISS index, opened with mmap (shared page cache across workers)
+#   <class>.versions/<v>/ids.npy     sorted int64 vector ids      } compact path table, also mmapped
+#   <class>.versions/<v>/paths.npy   utf-8 path per id (bytes)    }
+#   <class>.versions/<v>/embedding   embedding_key() the vectors were made with
+#   <class>.manifest.json            indexed files (size/mtime/sha1/ids) for incremental refresh
+# Old <class>.pkl blobs and the flat <class>.faiss/.ids.npy/.paths.npy layout are
+# still read and are replaced by a version directory on the next write.
+class PathTable:
+    """Read-only id -> path lookup over two (memory-mapped) numpy arrays."""
+
+    def __init__(self, ids: np.ndarray, paths: np.ndarray):
+        self.ids = ids
+        self.paths = paths
+
+    @classmethod
+    def from_dict(cls, mapping: Dict[int, str]) -> "PathTable":
+        ids = np.array(sorted(mapping), dtype="int64")
+        paths = np.array([mapping[i].encode("utf-8") for i in ids.tolist()], dtype=bytes)
+        return cls(ids, paths)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, i, default=None):
+        pos = int(np.searchsorted(self.ids, i))
+        if pos < len(self.ids) and self.ids[pos] == i:
+            return self.paths[pos].decode("utf-8")
+        return default
+
+    def __getitem__(self, i) -> str:
+        path = self.get(i)
+        if path is None:
+            raise KeyError(i)
+        return path
+
+    def items(self):
+        for i, p in zip(self.ids.tolist(), self.paths):
+            yield i, p.decode("utf-8")
+
+    def to_dict(self) -> Dict[int, str]:
+        return dict(self.items())
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.ids.nbytes + self.paths.nbytes)
+
+
+def _legacy_cache_file(class_name: str) -> Path:
+    return INDEX_CACHE_DIR / f"{class_name}.pkl"
+
+
+def _pointer_file(class_name: str) -> Path:
+    return INDEX_CACHE_DIR / f"{class_name}.current"
+
+
+def _versions_dir(class_name: str) -> Path:
+    return INDEX_CACHE_DIR / f"{class_name}.versions"
+
+
+def _current_version(class_name: str) -> Optional[str]:
+    try:
+        version = _pointer_file(class_name).read_text().strip()
+    except OSError:
+        return None
+    return version if version and (_versions_dir(class_name) / version).is_dir() else None
+
+
+def _files(class_name: str) -> Optional[Tuple[Path, Path, Path]]:
+    """(index, ids, paths) files of the live version; the flat pre-versioning layout as fallback."""
+    version = _current_version(class_name)
+    if version is not None:
+        d = _versions_dir(class_name) / version
+        return d / "index.faiss", d / "ids.npy", d / "paths.npy"
+    flat = INDEX_CACHE_DIR / f"{class_name}.faiss"
+    if flat.exists():
+        return flat, INDEX_CACHE_DIR / f"{class_name}.ids.npy", INDEX_CACHE_DIR / f"{class_name}.paths.npy"
+    return None
+
+
+def _has_native(class_name: str) -> bool:
+    return _files(class_name) is not None
+
+
+def _manifest_file(class_name: str) -> Path:
+    return INDEX_CACHE_DIR / f"{class_name}.manifest.json"
+
+
+def is_cached(class_name: str) -> bool:
+    """True if a native or legacy on-disk index exists for the class."""
+    return _has_native(class_name) or _legacy_cache_file(class_name).exists()
+
+
+# vectors of the old .pkl caches came from CLIPProcessor at full resolution
+LEGACY_EMBEDDING = "clipprocessor"
+# An index embedded under another embedding_key() (old .pkl caches, another CLIP_BACKEND)
+# is served as is and logged; `python build_indexes.py` rebuilds such classes offline.
+# 1 rebuilds on the request path instead: minutes per class, in every worker.
+EMBEDDING_REBUILD = os.environ.get("FAISS_EMBEDDING_REBUILD", "0") in {"1", "true", "True", "yes"}
+_embedding_warned = set()
+
+
+def index_embedding(class_name: str) -> Optional[str]:
+    """embedding_key() the live index was built with; None for the flat layout (unknown)."""
+    version = _current_version(class_name)
+    if version is None:
+        return None
+    try:
+        return (_versions_dir(class_name) / version / "embedding").read_text().strip()
+    except OSError:
+        return None
+
+
+def index_version(class_name: str) -> Optional[str]:
+    """
+    Changes whenever the on-disk index is rebuilt or refreshed (every write goes
+    through _save_index), so results computed against it can be invalidated.
+    Includes the embedding key (CLIP preprocessing + backend) the index was built with.
+    """
+    version = _current_version(class_name)
+    if version is not None:
+        return f"{version}:{index_embedding(class_name) or 'unknown'}"
+    try:
+        return str((INDEX_CACHE_DIR / f"{class_name}.faiss").stat().st_mtime_ns)
+    except OSError:
+        return None
+
+
+KEEP_VERSIONS = 2  # live version + the previous one (readers that just read the pointer)
+
+
+def _prune_versions(class_name: str, live: str):
+    root = _versions_dir(class_name)
+    old = sorted((d for d in root.iterdir() if d.is_dir() and d.name != live), key=lambda d: d.name)
+    for d in old[: max(len(old) - (KEEP_VERSIONS - 1), 0)]:
+        shutil.rmtree(d, ignore_errors=True)  # files still mmapped elsewhere stay readable (POSIX)
+    for name in (f"{class_name}.faiss", f"{class_name}.ids.npy", f"{class_name}.paths.npy"):
+        try:
+            (INDEX_CACHE_DIR / name).unlink()  # flat layout superseded by the versioned one
+        except OSError:
+            pass
+
+
+def _save_index(class_name: str, index: faiss.Index, paths, embedding: Optional[str] = None):
+    """
+    Write index + path table into a fresh version directory, then switch the
+    <class>.current pointer to it with one atomic rename: readers see either the
+    old trio of files or the new one, never a mix. `embedding` defaults to the
+    current embedding_key().
+    """
+    table = paths if isinstance(paths, PathTable) else PathTable.from_dict(paths)
+    version = f"{time.time_ns()}-{os.getpid()}"
+    d = _versions_dir(class_name) / version
+    d.mkdir(parents=True)
+    with open(d / "ids.npy", "wb") as f:
+        np.save(f, table.ids)
+    with open(d / "paths.npy", "wb") as f:
+        np.save(f, table.paths)
+    faiss.write_index(index, str(d / "index.faiss"))
+    (d / "embedding").write_text(embedding or embedding_key())
+
+    pointer = _pointer_file(class_name)
+    tmp = pointer.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_text(version)
+    tmp.replace(pointer)
+    _prune_versions(class_name, version)
+
+
+def _read_index(class_name: str, mmap: bool = True):
+    """Open the native index (mmapped when possible) and its path table."""
+    files = _files(class_name)
+    if files is None:
+        raise FileNotFoundError(f"No native index for {class_name}")
+    index_path, ids_path, paths_path = files
+    path = str(index_path)
+    index = None
+    if mmap:
+        flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+        try:
+            index = faiss.read_index(path, flags)
+        except RuntimeError:
+            index = None  # index type without mmap support
+    if index is None:
+        index = faiss.read_index(path)
+
+    mode = "r" if mmap else None
+    table = PathTable(
+        np.load(ids_path, mmap_mode=mode),
+        np.load(paths_path, mmap_mode=mode),
+    )
+    return index, table
+
+
+def _migrate_legacy(class_name: str):
+    """Convert <class>.pkl (serialized index + path list/dict) to the native layout."""
+    print(f"[FAISS] Migrating {class_name}.pkl to native index files")
+    with open(_legacy_cache_file(class_name), "rb") as f:
+        index_data = pickle.load(f)
+    index = faiss.deserialize_index(index_data["index"])
+    paths = index_data["paths"]
+    if isinstance(paths, list):
+        # positional index: ids are row numbers
+        paths = {i: str(p) for i, p in enumerate(paths)}
+    _save_index(class_name, index, paths, embedding=LEGACY_EMBEDDING)
+    try:
+        _legacy_cache_file(class_name).unlink()
+    except OSError as exc:
+        print(f"[FAISS] Could not remove {class_name}.pkl: {exc}")
+
+
+def _load_manifest(class_name: str) -> Optional[dict]:
+    path = _manifest_file(class_name)
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def _save_manifest(class_name: str, manifest: dict):
+    path = _manifest_file(class_name)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(manifest, f)
+    tmp.replace(path)
+
+
+# ==== IN-MEMORY INDEX CACHE ====
+def _index_nbytes(index: faiss.Index) -> int:
+    """Approximate resident size of an index: codes + id map (+ graph links for HNSW)."""
+    try:
+        code_size = index.sa_code_size()
+    except Exception:
+        code_size = index.d * 4
+    total = index.ntotal * code_size
+    if hasattr(index, "id_map"):
+        total += index.ntotal * 8
+    hnsw = getattr(faiss.downcast_index(index.index) if hasattr(index, "id_map") else index, "hnsw", None)
+    if hnsw is not None:
+        total += hnsw.neighbors.size() * 4
+    return int(total)
+
+
+def _paths_nbytes(paths) -> int:
+    if isinstance(paths, PathTable):
+        return paths.nbytes
+    return sum(8 + len(p) for p in paths.values())
+
+
+@contextlib.contextmanager
+def _file_lock(path: Path):
+    """Exclusive advisory lock on `path` shared by all worker processes."""
+    with open(path, "a+") as f:
+        if os.name == "nt":
+            import msvcrt
+
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+            try:
+                yield
+            finally:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class IndexCache:
+    """
+    LRU of loaded class indexes bounded by an approximate byte budget.
+    Each entry remembers the index_version it was read at; a lookup with another
+    version (the class was rebuilt/refreshed by another process) is a miss.
+    Tracks hit/miss/eviction counters and per-class popularity (persisted to
+    POPULARITY_FILE so a fresh worker can prewarm the hottest classes).
+    """
+
+    def __init__(self, max_bytes: int = 0, persist_every: int = 100, persist_seconds: float = 60.0):
+        self.max_bytes = max_bytes
+        self.persist_every = persist_every
+        self.persist_seconds = persist_seconds  # also flush a trickle of lookups this often
+        self._saved_at = time.monotonic()
+        self._entries: "OrderedDict[str, Tuple[faiss.Index, PathTable]]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._versions: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.popularity: Counter = Counter()
+        self._unsaved = 0
+
+    def __contains__(self, class_name: str) -> bool:
+        return class_name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def total_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    def _current(self, class_name: str, version: Optional[str]):
+        entry = self._entries.get(class_name)
+        if entry is not None and version is not None and self._versions.get(class_name) != version:
+            return None  # outdated: the caller re-reads the index and put()s it
+        return entry
+
+    def get(self, class_name: str, version: Optional[str] = None):
+        with self._lock:
+            self.popularity[class_name] += 1
+            self._unsaved += 1
+            entry = self._current(class_name, version)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self._entries.move_to_end(class_name)
+            persist = self._unsaved >= self.persist_every or (
+                time.monotonic() - self._saved_at >= self.persist_seconds
+            )
+        inc("index_cache_total", result="miss" if entry is None else "hit")
+        if persist:
+            self.save_popularity()
+        return entry
+
+    def put(self, class_name: str, entry: Tuple[faiss.Index, "PathTable"], version: Optional[str] = None):
+        size = _index_nbytes(entry[0]) + _paths_nbytes(entry[1])
+        with self._lock:
+            self._entries[class_name] = entry
+            self._entries.move_to_end(class_name)
+            self._sizes[class_name] = size
+            self._versions[class_name] = version
+            # always keep the newest entry, even if it alone exceeds the budget
+            while self.max_bytes and self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                evicted, _ = self._entries.popitem(last=False)
+                self._sizes.pop(evicted, None)
+                self._versions.pop(evicted, None)
+                self.evictions += 1
+                print(f"[FAISS] Evicted {evicted} from index cache")
+
+    def peek(self, class_name: str, version: Optional[str] = None):
+        """Entry without touching the hit/miss counters or popularity."""
+        with self._lock:
+            return self._current(class_name, version)
+
+    def pop(self, class_name: str, default=None):
+        with self._lock:
+            self._sizes.pop(class_name, None)
+            self._versions.pop(class_name, None)
+            return self._entries.pop(class_name, default)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "classes": list(self._entries),
+            }
+
+    def save_popularity(self):
+        """Merge this worker's lookup counts into POPULARITY_FILE (under a cross-process file lock)."""
+        with self._lock:
+            counts, self.popularity = self.popularity, Counter()
+            self._unsaved = 0
+            self._saved_at = time.monotonic()
+        if not counts:
+            return
+        try:
+            with _file_lock(POPULARITY_FILE.with_suffix(".lock")):
+                stored = Counter(json.loads(POPULARITY_FILE.read_text())) if POPULARITY_FILE.exists() else Counter()
+                stored.update(counts)
+                tmp = POPULARITY_FILE.with_suffix(f".{os.getpid()}.tmp")
+                tmp.write_text(json.dumps(dict(stored)))
+                tmp.replace(POPULARITY_FILE)
+        except Exception as e:
+            print(f"[FAISS] Could not save popularity counts: {e}")
+            with self._lock:  # keep them for the next flush
+                self.popularity.update(counts)
+
+
+_index_cache = IndexCache(max_bytes=int(INDEX_CACHE_MAX_MB * 1024 * 1024))
+# counts since the last periodic flush would otherwise be lost on shutdown
+atexit.register(_index_cache.save_popularity)
+
+
+def index_cache_stats() -> dict:
+    return _index_cache.stats()
+
+
+def prewarm_indexes(top_n: int = PREWARM_TOP_N) -> List[str]:
+    """Load the `top_n` most requested classes (per POPULARITY_FILE) into the cache."""
+    if top_n <= 0 or not POPULARITY_FILE.exists():
+        return []
+    counts = Counter(json.loads(POPULARITY_FILE.read_text()))
+    loaded = []
+    for class_name, _ in counts.most_common(top_n):
+        if not is_cached(class_name):
+            continue
+        try:
+            if not _has_native(class_name):
+                _migrate_legacy(class_name)
+            if EMBEDDING_REBUILD and index_embedding(class_name) != embedding_key():
+                continue  # rebuilt by _load_or_build on first use
+            version = index_version(class_name)
+            entry = _read_index(class_name)
+            _tune_for_search(entry[0])
+            _index_cache.put(class_name, entry, version)
+            loaded.append(class_name)
+        except Exception as e:
+            print(f"[FAISS] Prewarm failed for {class_name}: {e}")
+    print(f"[FAISS] Prewarmed {len(loaded)} indexes: {loaded}")
+    return loaded
+
+
+_class_locks: Dict[str, threading.RLock] = {}
+_class_locks_guard = threading.Lock()
+
+
+def _class_lock(class_name: str) -> threading.RLock:
+    """One lock per class: concurrent misses load/build (and checkpoint) a class once."""
+    with _class_locks_guard:
+        lock = _class_locks.get(class_name)
+        if lock is None:
+            lock = _class_locks[class_name] = threading.RLock()
+        return lock
 
 
 def get_or_build_index(class_name: str, rebuild: bool = False, augment_index: bool = False):
-    """Get cached index or build new one (and cache to disk)."""
-    if class_name in _index_cache and not rebuild:
-        return _index_cache[class_name]
+    """
+    Get cached index or build new one (and cache to disk). The in-memory copy is
+    re-read when the on-disk version moved on (another process rebuilt/refreshed it).
+    """
+    if not rebuild:
+        cached = _index_cache.get(class_name, index_version(class_name))
+        if cached is not None:
+            return cached
+
+    with _class_lock(class_name):
+        if not rebuild and class_name in _index_cache:
+            # loaded by the request we waited for
+            cached = _index_cache.peek(class_name, index_version(class_name))
+            if cached is not None:
+                return cached
+        return _load_or_build(class_name, rebuild, augment_index)
 
-    cache_file = INDEX_CACHE_DIR / f"{class_name}.pkl"
 
-    if cache_file.exists() and not rebuild:
+def _load_or_build(class_name: str, rebuild: bool, augment_index: bool):
+    if not rebuild and not _has_native(class_name) and _legacy_cache_file(class_name).exists():
+        _migrate_legacy(class_name)
+
+    if _has_native(class_name) and not rebuild:
+        built_with = index_embedding(class_name)
+        if built_with != embedding_key():
+            if EMBEDDING_REBUILD:
+                print(f"[FAISS] {class_name} index was embedded with {built_with or 'unknown'}; rebuilding")
+                try:
+                    return _build_and_save(class_name, augment_index)
+                except Exception as exc:
+                    print(f"[FAISS] Rebuild of {class_name} failed ({exc}); serving the existing index")
+            elif class_name not in _embedding_warned:
+                _embedding_warned.add(class_name)
+                print(f"[FAISS] {class_name} index was embedded with {built_with or 'unknown'}, queries use "
+                      f"{embedding_key()}; run build_indexes.py to rebuild it")
+
+    if _has_native(class_name) and not rebuild:
         print(f"[FAISS] Loading cached index for {class_name}")
-        with open(cache_file, "rb") as f:
-            index_data = pickle.load(f)
-        _index_cache[class_name] = (
-            faiss.deserialize_index(index_data["index"]),
-            index_data["paths"],
-        )
-        return _index_cache[class_name]
+        start = time.perf_counter()
+        version = index_version(class_name)  # read first: a swap meanwhile only causes one more reload
+        entry = _read_index(class_name)
+        _tune_for_search(entry[0])
+        observe("index_load_seconds", time.perf_counter() - start)
+        _index_cache.put(class_name, entry, version)
+        return entry
 
+    return _build_and_save(class_name, augment_index)
+
+
+def _build_and_save(class_name: str, augment_index: bool):
     class_dir = DATA_ROOT / class_name
-    index, paths = build_class_index(class_dir, augment_index=augment_index)
+    dataset_manifest.refresh_class(class_name)
+    # kept across --rebuild so an interrupted rebuild resumes; _embed_files ignores a
+    # checkpoint made with different build settings and drops vectors of deleted files
+    checkpoint = INDEX_CACHE_DIR / f"{class_name}.partial.npz"
+    index, paths, manifest = build_class_index(class_dir, augment_index=augment_index, checkpoint_path=checkpoint)
 
-    with open(cache_file, "wb") as f:
-        pickle.dump({"index": faiss.serialize_index(index), "paths": paths}, f)
+    _save_index(class_name, index, paths)
+    _save_manifest(class_name, manifest)
+    if checkpoint.exists():
+        checkpoint.unlink()
 
-    _index_cache[class_name] = (index, paths)
+    _index_cache.put(class_name, (index, paths), index_version(class_name))
     return index, paths
 
 
-def search_in_class(
-    query_img: Path,
-    class_name: str,
-    top_k: int = 5,
-    use_query_augmentation: bool = True,
-    augment_index: bool = False,
-    rebuild_index: bool = False,
-):
-    """Search for similar images inside one class."""
-    index, paths = get_or_build_index(class_name, rebuild=rebuild_index, augment_index=augment_index)
+def _upgrade_legacy(class_name: str, index: faiss.Index, paths):
+    """
+    Convert an old positional cache (IndexFlatIP, ids are row numbers) into an
+    ID-mapped index + manifest without re-embedding anything.
+    """
+    print(f"[FAISS] Upgrading {class_name} cache to an ID-mapped index with manifest")
+    vectors = index.reconstruct_n(0, index.ntotal)
+    owners = [paths[i] for i in range(index.ntotal)]
+    augment_index = len(set(owners)) < len(owners)
+    manifest = {
+        "index_type": "Flat",
+        "augment_index": augment_index,
+        "aug_per_image": 5,
+        "next_id": 0,
+        "files": {},
+    }
+    for p in dict.fromkeys(owners):
+        f = Path(p)
+        sha1 = _sha1(f.read_bytes()) if f.exists() else None
+        manifest["files"][p] = _manifest_entry(f, sha1)
+
+    new_index = _new_index(index.d)
+    new_paths: Dict[int, str] = {}
+    _add_vectors(new_index, new_paths, manifest, vectors, owners)
+    return new_index, new_paths, manifest
+
+
+def refresh_class_index(class_name: str, batch_size: Optional[int] = None, workers: Optional[int] = None) -> dict:
+    """
+    Bring a cached class index in line with its image folder: embed only new or
+    changed files and drop vectors of deleted ones. Files whose size/mtime moved
+    but whose content hash is unchanged are not re-embedded.
+    """
+    get_or_build_index(class_name)  # builds or migrates if needed
+    # private, writable copy; the mmapped one stays with concurrent readers
+    index, table = _read_index(class_name, mmap=False)
+    paths = table.to_dict()
+    manifest = _load_manifest(class_name)
+    if not hasattr(index, "id_map"):
+        index, paths, manifest = _upgrade_legacy(class_name, index, paths)
+    elif manifest is None:
+        # ID-mapped cache without its manifest: nothing to diff against
+        index, paths = get_or_build_index(class_name, rebuild=True)
+        manifest = _load_manifest(class_name)
+
+    known = manifest["files"]
+    # one stat pass over the class (also catches files modified in place)
+    dataset_manifest.refresh_class(class_name, full=True)
+    current = _class_listing(DATA_ROOT / class_name)
+
+    removed = [p for p in known if p not in current]
+    new, changed, touched = [], [], 0
+    for p, (size, mtime) in current.items():
+        entry = known.get(p)
+        f = Path(p)
+        if entry is None:
+            new.append(f)
+            continue
+        if size == entry["size"] and mtime == entry["mtime"]:
+            continue
+        if size == entry["size"] and _sha1(f.read_bytes()) == entry["sha1"]:
+            entry["mtime"] = mtime
+            touched += 1
+            continue
+        changed.append(f)
+
+    stale = removed + [str(f) for f in changed]
+    stale_ids = [i for p in stale for i in known[p]["ids"]]
+    if stale_ids:
+        try:
+            index.remove_ids(np.array(stale_ids, dtype="int64"))
+        except RuntimeError:
+            # e.g. HNSW cannot delete vectors
+            print(f"[FAISS] {manifest.get('index_type')} does not support removal; rebuilding {class_name}")
+            index, _ = get_or_build_index(class_name, rebuild=True, augment_index=manifest["augment_index"])
+            return {
+                "class_name": class_name,
+                "rebuilt": True,
+                "added": len(new),
+                "changed": len(changed),
+                "removed": len(removed),
+                "touched": touched,
+                "ntotal": int(index.ntotal),
+            }
+        for i in stale_ids:
+            paths.pop(i, None)
+    for p in stale:
+        known.pop(p)
 
+    todo = new + changed
+    if todo:
+        vectors, owners, hashes = _embed_files(
+            todo,
+            class_name,
+            augment_index=manifest["augment_index"],
+            aug_per_image=manifest["aug_per_image"],
+            batch_size=batch_size,
+            workers=workers,
+        )
+        for p, h in hashes.items():
+            known[p] = _manifest_entry(Path(p), h, current.get(p))
+        if owners:
+            _add_vectors(index, paths, manifest, vectors, owners)
+
+    wanted = index_type_for(class_name, int(index.ntotal))
+    if wanted != manifest.get("index_type", "Flat"):
+        print(f"[FAISS] {class_name} would now use {wanted} (has {manifest.get('index_type')}); run a --rebuild to switch")
+
+    # new vectors join the old ones, so the index keeps the key it was built with
+    _save_index(class_name, index, paths, embedding=index_embedding(class_name) or "unknown")
+    _save_manifest(class_name, manifest)
+    # next lookup re-opens (and mmaps) the refreshed files
+    _index_cache.pop(class_name, None)
+
+    summary = {
+        "class_name": class_name,
+        "rebuilt": False,
+        "added": len(new),
+        "changed": len(changed),
+        "removed": len(removed),
+        "touched": touched,
+        "ntotal": int(index.ntotal),
+    }
+    print(f"[FAISS] Refreshed {class_name}: {summary}")
+    return summary
+
+
+def load_class_vectors(class_name: str):
+    """
+    Read back the stored vectors of a cached class index.
+    Returns (ids int64 (N,), vectors float32 (N, D), paths list aligned with ids).
+    """
+    if not _has_native(class_name) and _legacy_cache_file(class_name).exists():
+        _migrate_legacy(class_name)
+    index, table = _read_index(class_name, mmap=False)
+    if hasattr(index, "id_map"):
+        ids = np.asarray(table.ids, dtype="int64")
+        inner = faiss.downcast_index(index.index)
+        try:
+            faiss.extract_index_ivf(inner).make_direct_map()
+        except RuntimeError:
+            pass
+        vectors = np.vstack([index.reconstruct(int(i)) for i in ids]) if len(ids) else np.zeros((0, index.d), "float32")
+    else:
+        ids = np.arange(index.ntotal, dtype="int64")
+        vectors = index.reconstruct_n(0, index.ntotal)
+    paths = [table[int(i)] for i in ids]
+    return ids, vectors.astype("float32"), paths
+
+
+def query_vector(
+    query_img,
+    use_query_augmentation: bool = True,
+    query_embedding: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """Normalized (1, D) float32 query matrix for FAISS."""
     if use_query_augmentation:
-        qvec = embed_image(Path(query_img), augment=True, aug_strength="medium")
+        qvec = embed_image(
+            query_img, augment=True, aug_strength="medium", clean_embedding=query_embedding, seed=seed
+        )
     else:
-        qvec = embed_image(Path(query_img))
+        qvec = embed_image(query_img, clean_embedding=query_embedding)
 
-    qvec = qvec.astype("float32").reshape(1, -1)
+    qvec = np.ascontiguousarray(qvec, dtype="float32").reshape(1, -1)
     faiss.normalize_L2(qvec)
+    return qvec
 
-    search_k = top_k * 10 if augment_index else top_k
-    sims, idxs = index.search(qvec, search_k)
 
+_tta_lock = threading.Lock()
+_tta_inflight = 0
+_tta_stats = {"clean_only": 0, "augmented": 0, "skipped_load": 0}
+
+
+def _needs_tta(results: List[dict], confidence: Optional[float]) -> bool:
+    if confidence is not None and confidence < TTA_CONFIDENCE:
+        return True
+    if len(results) < 2:
+        return False
+    return results[0]["score"] - results[1]["score"] < TTA_MARGIN
+
+
+def search_with_tta(run, query_img, use_query_augmentation=True, query_embedding=None, confidence=None, seed=None):
+    """
+    run(qvec) -> result items. use_query_augmentation is True/False or "adaptive"
+    (clean view first, augmented views only when the clean result is ambiguous).
+    """
+    global _tta_inflight
+    if use_query_augmentation != "adaptive":
+        return run(query_vector(query_img, bool(use_query_augmentation), query_embedding, seed))
+
+    with _tta_lock:
+        _tta_inflight += 1
+        busy = _tta_inflight > TTA_MAX_INFLIGHT
+    try:
+        clean = query_vector(query_img, False, query_embedding)
+        results = run(clean)
+        if not _needs_tta(results, confidence):
+            outcome = "clean_only"
+        elif busy:
+            outcome = "skipped_load"
+        else:
+            outcome = "augmented"
+        with _tta_lock:
+            _tta_stats[outcome] += 1
+        if outcome != "augmented":
+            return results
+        return run(query_vector(query_img, True, clean[0], seed))
+    finally:
+        with _tta_lock:
+            _tta_inflight -= 1
+
+
+def tta_stats() -> dict:
+    with _tta_lock:
+        return {"mode": QUERY_TTA, "inflight": _tta_inflight, **_tta_stats}
+
+
+def format_results(sims: np.ndarray, idxs: np.ndarray, paths, top_k: int) -> List[dict]:
+    """Turn one row of FAISS output into deduplicated (best score per path) result items."""
     seen_paths: Dict[str, float] = {}
-    for i, score in zip(idxs[0], sims[0]):
-        path = paths[i]
+    for i, score in zip(idxs, sims):
+        path = paths.get(int(i)) if i >= 0 else None  # -1: fewer than search_k vectors
+        if path is None:
+            continue
         if path not in seen_paths or score > seen_paths[path]:
             seen_paths[path] = score
 
@@ -223,3 +1189,44 @@ def search_in_class(
             }
         )
     return items
+
+
+def search_in_class(
+    query_img,
+    class_name: str,
+    top_k: int = 5,
+    use_query_augmentation: bool = True,
+    augment_index: bool = False,
+    rebuild_index: bool = False,
+    query_embedding: Optional[np.ndarray] = None,
+    confidence: Optional[float] = None,
+):
+    """
+    Search for similar images inside one class.
+    `query_img` may be a path or a PIL image; pass `query_embedding` (the clean
+    CLIP vector, e.g. from the sneaker gate) to avoid re-encoding it.
+    `use_query_augmentation` may also be "adaptive" (see search_with_tta), which
+    uses the classifier `confidence` as one of its triggers.
+    """
+    with timed("faiss_index"):
+        index, paths = get_or_build_index(class_name, rebuild=rebuild_index, augment_index=augment_index)
+    search_k = top_k * 10 if augment_index else top_k
+
+    def run(qvec):
+        sims, idxs = index.search(qvec, search_k)
+        return format_results(sims[0], idxs[0], paths, top_k)
+
+    with timed("faiss_search"):
+        return search_with_tta(run, query_img, use_query_augmentation, query_embedding, confidence)
+
+
+def search_batch_in_class(class_name: str, qvecs: np.ndarray, top_k: int = 5) -> List[List[dict]]:
+    """
+    Search several query vectors (M, D) against one class with a single
+    multi-row index.search call. Returns one result list per query row.
+    """
+    index, paths = get_or_build_index(class_name)
+    q = np.ascontiguousarray(qvecs, dtype="float32").reshape(len(qvecs), -1)
+    faiss.normalize_L2(q)
+    sims, idxs = index.search(q, top_k)
+    return [format_results(sims[r], idxs[r], paths, top_k) for r in range(len(q))]
@@ -19,6 +19,8 @@ export const addInventory = (data) => API.post("/add-to-inventory", data);
 
 export const listInventory = () => API.get("/inventory");
 
+export const repriceInventory = () => API.post("/inventory/reprice");
+
 // =======================
 // IMAGE PIPELINE (GRIDFS)
 // =======================
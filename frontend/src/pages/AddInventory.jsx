@@ -15,7 +15,7 @@ function AddInventory() {
   const handleSave = async () => {
     try {
       setSaving(true);
-      await addInventory({
+      const res = await addInventory({
         slug: result.slug_used,
         class_name: result.class_name,
         brand: result.brand,
@@ -23,10 +23,12 @@ function AddInventory() {
         product_name: result.product_name,
         product_type: result.product_type,
         price_predicted: result.predicted_price,
+        image_id: result.image_id,
         quantity: Number(qty),
         price: Number(price),
       });
 
+      if (res.data?.warning) alert(res.data.warning);
       navigate("/dashboard");
     } catch (err) {
       console.error(err);
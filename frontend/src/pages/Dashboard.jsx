@@ -1,19 +1,39 @@
 import { useEffect, useState } from "react";
-import { listInventory } from "../api/api";
+import { listInventory, repriceInventory } from "../api/api";
 import "./Upload.css";
 
 function Dashboard() {
   const [items, setItems] = useState([]);
+  const [repricing, setRepricing] = useState(false);
+
+  const load = () => listInventory().then((res) => setItems(res.data));
 
   useEffect(() => {
-    listInventory().then((res) => setItems(res.data));
+    load();
   }, []);
 
+  const handleReprice = async () => {
+    try {
+      setRepricing(true);
+      const res = await repriceInventory();
+      alert(`Repriced ${res.data.updated} item(s); ${res.data.missing_price} without a price.`);
+      await load();
+    } catch (err) {
+      console.error(err);
+      alert("Repricing failed.");
+    } finally {
+      setRepricing(false);
+    }
+  };
+
   return (
     <div className="page">
       <div className="card wide" style={{ marginBottom: 12 }}>
         <p className="eyebrow">Inventory</p>
         <h2>Dashboard</h2>
+        <button className="primary" onClick={handleReprice} disabled={repricing || items.length === 0}>
+          {repricing ? "Repricing..." : "Reprice all"}
+        </button>
       </div>
 
       {items.length === 0 && (
@@ -0,0 +1,222 @@
+"""
+One FAISS index over the whole catalog, searchable with an optional class/slug filter.
+Vector ids encode the class: (class_index << 32) | per-class id, so restricting a
+search to some classes is an IDSelectorRange per class instead of loading and
+querying several per-class indexes.
+
+Built offline from the per-class caches (python build_indexes.py --global).
+"""
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import faiss
+import numpy as np
+
+from faiss_search import (
+    EF_SEARCH,
+    INDEX_CACHE_DIR,
+    NPROBE,
+    _has_native,
+    _new_index,
+    _read_index,
+    _save_index,
+    _tune_for_search,
+    format_results,
+    index_type_for,
+    index_version,
+    is_cached,
+    load_class_vectors,
+    search_with_tta,
+)
+
+BASE_DIR = Path(__file__).resolve().parent
+CLASS_INDICES_PATH = BASE_DIR / "ai" / "class_indices.json"
+
+GLOBAL_NAME = "_global"
+GLOBAL_META_FILE = INDEX_CACHE_DIR / f"{GLOBAL_NAME}.meta.json"
+
+with open(CLASS_INDICES_PATH, "r") as f:
+    class_to_idx: Dict[str, int] = json.load(f)
+
+# how often a worker re-checks whether class indexes moved on since the global build
+GLOBAL_STALE_CHECK_SECONDS = float(os.environ.get("GLOBAL_STALE_CHECK_SECONDS", "30"))
+
+_state = {"index": None, "paths": None, "slug_ids": None, "version": None}
+_stale = {"value": False, "checked": 0.0}
+_lock = threading.Lock()
+
+
+def _class_range(class_name: str):
+    c = class_to_idx[class_name]
+    return c << 32, (c + 1) << 32
+
+
+def build_global_index() -> dict:
+    """Concatenate the vectors of every cached class index into one index."""
+    all_ids, all_vectors, paths = [], [], {}
+    classes = {}
+    versions = {}
+    for class_name, c in sorted(class_to_idx.items(), key=lambda kv: kv[1]):
+        if not is_cached(class_name):
+            continue
+        versions[class_name] = index_version(class_name)
+        ids, vectors, class_paths = load_class_vectors(class_name)
+        gids = (np.int64(c) << 32) | ids
+        all_ids.append(gids)
+        all_vectors.append(vectors)
+        paths.update(zip(gids.tolist(), class_paths))
+        classes[class_name] = len(ids)
+        print(f"[GLOBAL] {class_name}: {len(ids)} vectors")
+
+    if not all_vectors:
+        raise RuntimeError("No per-class indexes cached yet; build them first")
+
+    vectors = np.ascontiguousarray(np.vstack(all_vectors), dtype="float32")
+    ids = np.concatenate(all_ids)
+    faiss.normalize_L2(vectors)
+
+    spec = index_type_for(GLOBAL_NAME, len(ids))
+    index = _new_index(vectors.shape[1], spec)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add_with_ids(vectors, ids)
+    _save_index(GLOBAL_NAME, index, paths)
+
+    meta = {
+        "index_type": spec,
+        "ntotal": int(index.ntotal),
+        "classes": classes,
+        "class_versions": versions,
+        "built_at": time.time(),
+    }
+    tmp = GLOBAL_META_FILE.with_suffix(f".{os.getpid()}.tmp")
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    tmp.replace(GLOBAL_META_FILE)
+
+    with _lock:
+        _state.update(index=None, paths=None, slug_ids=None, version=None)
+    _stale["checked"] = 0.0
+    print(f"[GLOBAL] Indexed {index.ntotal} vectors from {len(classes)} classes [{spec}]")
+    return meta
+
+
+def global_index_available() -> bool:
+    return _has_native(GLOBAL_NAME)
+
+
+def global_index_stale() -> bool:
+    """True when a class index was rebuilt/refreshed (or added/removed) after the global build."""
+    now = time.monotonic()
+    if now - _stale["checked"] < GLOBAL_STALE_CHECK_SECONDS:
+        return _stale["value"]
+    try:
+        with open(GLOBAL_META_FILE, "r") as f:
+            built = json.load(f).get("class_versions")
+    except (OSError, ValueError):
+        built = None
+    if built is None:
+        stale = False  # index built before versions were recorded: unknown
+    else:
+        current = {c: index_version(c) for c in class_to_idx if is_cached(c)}
+        stale = current != built
+    if stale and not _stale["value"]:
+        print("[GLOBAL] Class indexes changed since the global build; run build_indexes.py --global")
+    _stale.update(value=stale, checked=now)
+    return stale
+
+
+def _load():
+    """The global index, re-opened when another process rebuilt it (index_version changed)."""
+    version = index_version(GLOBAL_NAME)
+    with _lock:
+        if _state["index"] is None or _state["version"] != version:
+            index, table = _read_index(GLOBAL_NAME)
+            _tune_for_search(index)
+            _state.update(index=index, paths=table, slug_ids=None, version=version)
+        return _state["index"], _state["paths"]
+
+
+def _ids_for_slugs(slugs: List[str]) -> np.ndarray:
+    """Global ids whose image lives in one of `slugs` (slug table built on first use)."""
+    _, table = _load()
+    with _lock:
+        if _state["slug_ids"] is None:
+            by_slug: Dict[str, list] = {}
+            for i, path in table.items():
+                by_slug.setdefault(Path(path).parent.name, []).append(i)
+            _state["slug_ids"] = {k: np.array(v, dtype="int64") for k, v in by_slug.items()}
+        slug_ids = _state["slug_ids"]
+    parts = [slug_ids[s] for s in slugs if s in slug_ids]
+    return np.concatenate(parts) if parts else np.zeros(0, dtype="int64")
+
+
+def _search_params(index: faiss.Index, sel: faiss.IDSelector):
+    """SearchParameters subclass matching the index type, carrying the selector."""
+    inner = faiss.downcast_index(index.index)
+    if hasattr(inner, "hnsw"):
+        params = faiss.SearchParametersHNSW()
+        params.efSearch = EF_SEARCH
+    else:
+        try:
+            faiss.extract_index_ivf(inner)
+            params = faiss.SearchParametersIVF()
+            params.nprobe = NPROBE
+        except RuntimeError:
+            params = faiss.SearchParameters()
+    params.sel = sel
+    return params
+
+
+def search_global(
+    query_img,
+    top_k: int = 5,
+    classes: Optional[List[str]] = None,
+    slugs: Optional[List[str]] = None,
+    use_query_augmentation: bool = True,
+    query_embedding: Optional[np.ndarray] = None,
+    search_k: Optional[int] = None,
+    confidence: Optional[float] = None,
+):
+    """
+    Search the whole catalog, optionally restricted to `classes` and/or `slugs`.
+    Result items have the same shape as faiss_search.search_in_class.
+    """
+    index, paths = _load()
+
+    selectors = []  # keep python refs alive for the duration of the search
+    sel = None
+    if classes:
+        for class_name in classes:
+            if class_name not in class_to_idx:
+                continue
+            lo, hi = _class_range(class_name)
+            rng = faiss.IDSelectorRange(lo, hi)
+            selectors.append(rng)
+            sel = rng if sel is None else faiss.IDSelectorOr(sel, rng)
+            selectors.append(sel)
+        if sel is None:
+            return []
+    if slugs:
+        ids = _ids_for_slugs(slugs)
+        if len(ids) == 0:
+            return []
+        batch = faiss.IDSelectorBatch(ids)
+        selectors.append(batch)
+        sel = batch if sel is None else faiss.IDSelectorAnd(sel, batch)
+        selectors.append(sel)
+
+    k = search_k or top_k * 5  # headroom for augmented duplicates
+
+    def run(qvec):
+        if sel is None:
+            sims, idxs = index.search(qvec, k)
+        else:
+            sims, idxs = index.search(qvec, k, params=_search_params(index, sel))
+        return format_results(sims[0], idxs[0], paths, top_k)
+
+    return search_with_tta(run, query_img, use_query_augmentation, query_embedding, confidence)
@@ -3,25 +3,54 @@ Minimal inventory helper backed by MongoDB + optional GridFS.
 Uses env var MONGO_URI (defaults to localhost). Collection: inventory.
 """
 import os
+import threading
 from datetime import datetime
 from typing import Optional
 
 from bson import ObjectId
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from gridfs import GridFS
 
 
 MONGO_URI = os.environ.get("MONGO_URI", "mongodb://localhost:27017/sneaker_ai_v2")
-client = MongoClient(MONGO_URI)
 
-try:
-    db_name = client.get_default_database().name
-except Exception:
-    db_name = "sneaker_ai_v2"
+# Client, GridFS and collection handles are created on first use (connect()),
+# so importing this module does not touch the network.
+_conn = {}
+_conn_lock = threading.Lock()
 
-db = client[db_name]
-fs = GridFS(db, collection="images")
-inventory_col = db["inventory"]
+
+def connect() -> dict:
+    """Create the Mongo client/handles once and ping the server."""
+    if _conn:
+        return _conn
+    with _conn_lock:
+        if not _conn:
+            client = MongoClient(MONGO_URI)
+            try:
+                db_name = client.get_default_database().name
+            except Exception:
+                db_name = "sneaker_ai_v2"
+            client.admin.command("ping")
+            db = client[db_name]
+            _conn.update(client=client, db=db, fs=GridFS(db, collection="images"), inventory=db["inventory"])
+    return _conn
+
+
+def is_connected() -> bool:
+    return bool(_conn)
+
+
+def get_db():
+    return connect()["db"]
+
+
+def get_fs() -> GridFS:
+    return connect()["fs"]
+
+
+def get_inventory_col():
+    return connect()["inventory"]
 
 
 def _now():
@@ -38,7 +67,7 @@ def find_inventory(class_name: Optional[str] = None, slug: Optional[str] = None)
     if not query:
         return {"exists": False}
 
-    doc = inventory_col.find_one(query)
+    doc = get_inventory_col().find_one(query)
     if not doc:
         return {"exists": False}
 
@@ -72,8 +101,9 @@ def add_or_update_inventory(
     """
     image_gridfs_id = None
     if image_bytes:
-        image_gridfs_id = fs.put(image_bytes, content_type=content_type)
+        image_gridfs_id = get_fs().put(image_bytes, content_type=content_type)
 
+    inventory_col = get_inventory_col()
     now = _now()
     existing = inventory_col.find_one({"slug": product.get("slug")})
 
@@ -116,3 +146,28 @@ def add_or_update_inventory(
 
     res = inventory_col.insert_one(doc)
     return {"status": "inserted", "quantity": quantity, "image_gridfs_id": str(image_gridfs_id)}
+
+
+def reprice_inventory(prices: dict, batch_size: int = 1000) -> dict:
+    """
+    Set price_predicted on every inventory item from a {slug: price} table,
+    sending the updates as unordered bulk_write batches.
+    """
+    inventory_col = get_inventory_col()
+    now = _now()
+    ops, updated, missing = [], 0, 0
+    for doc in inventory_col.find({}, {"slug": 1, "price_predicted": 1}):
+        price = prices.get(doc.get("slug"))
+        if price is None:
+            missing += 1
+            continue
+        price = round(float(price), 2)
+        if doc.get("price_predicted") == price:
+            continue
+        ops.append(UpdateOne({"_id": doc["_id"]}, {"$set": {"price_predicted": price, "updated_at": now}}))
+        if len(ops) >= batch_size:
+            updated += inventory_col.bulk_write(ops, ordered=False).modified_count
+            ops = []
+    if ops:
+        updated += inventory_col.bulk_write(ops, ordered=False).modified_count
+    return {"updated": updated, "missing_price": missing}
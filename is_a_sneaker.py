@@ -1,24 +1,96 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
 import torch
-from PIL import Image
-from transformers import CLIPModel, CLIPProcessor
+from ai.clip_features import encode_image, encode_texts, logit_scale
+from ai.utils import decode_image
+
+# ==== GATE CONFIG ====
+# Prompts whose summed probability counts as "sneaker"
+SNEAKER_PROMPTS = [
+    "a photo of a sneaker",
+    "a photo of athletic shoes",
+    "a photo of running shoes",
+    "a photo of sports footwear",
+]
+NEGATIVE_PROMPTS = [
+    "not a shoe",
+    "random object",
+    "a photo of clothing",
+    "a photo of a vehicle",
+    "a photo of an animal",
+    "a photo of food",
+]
+THRESHOLD = float(os.environ.get("SNEAKER_GATE_THRESHOLD", "0.741"))
+
+# Optional JSON file overriding the above: {"positive": [...], "negative": [...], "threshold": 0.74}
+GATE_CONFIG_PATH = os.environ.get("SNEAKER_GATE_CONFIG")
+if GATE_CONFIG_PATH and os.path.exists(GATE_CONFIG_PATH):
+    with open(GATE_CONFIG_PATH, "r") as f:
+        _cfg = json.load(f)
+    SNEAKER_PROMPTS = list(_cfg.get("positive", SNEAKER_PROMPTS))
+    NEGATIVE_PROMPTS = list(_cfg.get("negative", NEGATIVE_PROMPTS))
+    THRESHOLD = float(_cfg.get("threshold", THRESHOLD))
+
+# Text side of the gate is image independent -> encode once, keyed by the
+# prompt set so any change to the prompts triggers a re-encode.
+_prompt_cache = {"key": None, "embeddings": None}
+_prompt_lock = threading.Lock()
+
+
+def configure_gate(positive=None, negative=None, threshold=None):
+    """Swap the prompt set and/or threshold at runtime."""
+    global SNEAKER_PROMPTS, NEGATIVE_PROMPTS, THRESHOLD
+    if positive is not None:
+        SNEAKER_PROMPTS = list(positive)
+    if negative is not None:
+        NEGATIVE_PROMPTS = list(negative)
+    if threshold is not None:
+        THRESHOLD = float(threshold)
+
+
+def _prompt_embeddings():
+    """
+    Returns (embeddings, num_positive): normalized (num_prompts, D) text
+    embeddings with the sneaker prompts first.
+    """
+    key = (tuple(SNEAKER_PROMPTS), tuple(NEGATIVE_PROMPTS))
+    with _prompt_lock:
+        if _prompt_cache["key"] != key:
+            _prompt_cache["embeddings"] = encode_texts(list(key[0] + key[1]))
+            _prompt_cache["key"] = key
+        return _prompt_cache["embeddings"], len(key[0])
+
+
+def gate_signature(threshold=None) -> str:
+    """Identifies the current prompt set + threshold (cached gate results are tied to it)."""
+    t = THRESHOLD if threshold is None else threshold
+    return hashlib.sha1(json.dumps([SNEAKER_PROMPTS, NEGATIVE_PROMPTS, t]).encode()).hexdigest()[:16]
 
-# ==== SETUP ====
-DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 
-# Load model once
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32", use_safetensors=True).to(DEVICE)
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32", use_fast=True)
+def prompt_embeddings_ready() -> bool:
+    return _prompt_cache["key"] is not None
+
+
+def warm_prompt_embeddings():
+    """Encode the prompt set eagerly (call at startup to keep it off the request path)."""
+    _prompt_embeddings()
 
 
 # ==== DETECTION FUNCTION ====
-def is_sneaker(image_path, threshold=0.741):
+def is_sneaker(image_path=None, threshold=None, image_embedding=None):
     """
     Detect if an image contains a sneaker.
-    
+
     Args:
-        image_path: Path to image file
-        threshold: Classification threshold (default: 0.741) ma t8ayeraassh!!!
-    
+        image_path: Path to image file (or PIL image)
+        threshold: Classification threshold (default: THRESHOLD = 0.741) ma t8ayeraassh!!!
+        image_embedding: normalized CLIP image vector; when given, the image
+            is not re-encoded (lets /predict reuse it for FAISS search)
+
     Returns:
         dict: {
             'is_sneaker': bool,
@@ -26,40 +98,37 @@ def is_sneaker(image_path, threshold=0.741):
             'confidence': str
         }
     """
-    img = Image.open(image_path).convert("RGB")
-    
-    texts = [
-        "a photo of a sneaker",
-        "a photo of athletic shoes", 
-        "a photo of running shoes",
-        "a photo of sports footwear",
-        "not a shoe",
-        "random object",
-        "a photo of clothing",
-        "a photo of a vehicle",
-        "a photo of an animal",
-        "a photo of food"
-    ]
-    
-    inputs = processor(text=texts, images=img, return_tensors="pt", padding=True).to(DEVICE)
-    
-    with torch.no_grad():
-        outputs = model(**inputs)
-        probs = outputs.logits_per_image.softmax(dim=1)
-    
-    shoe_prob = float(probs[0][:4].sum())
-    is_sneaker_result = shoe_prob >= threshold
-    
-    if is_sneaker_result:
-        confidence = "high" if shoe_prob >= 0.85 else "medium"
-    else:
-        confidence = "high" if shoe_prob <= 0.30 else "medium"
-    
-    return {
-        "is_sneaker": is_sneaker_result,
-        "probability": round(shoe_prob, 3),
-        "confidence": confidence
-    }
+    if image_embedding is None:
+        image_embedding = encode_image(decode_image(image_path))
+
+    return is_sneaker_batch(np.asarray(image_embedding).reshape(1, -1), threshold)[0]
+
+
+def is_sneaker_batch(image_embeddings, threshold=None):
+    """Gate several normalized CLIP image vectors (N, D) with one matmul."""
+    if threshold is None:
+        threshold = THRESHOLD
+
+    img_emb = torch.from_numpy(np.asarray(image_embeddings, dtype="float32"))
+    text_emb, num_positive = _prompt_embeddings()
+    logits = logit_scale() * img_emb @ text_emb.T
+    probs = logits.softmax(dim=1)
+
+    results = []
+    for shoe_prob in probs[:, :num_positive].sum(dim=1).tolist():
+        is_sneaker_result = shoe_prob >= threshold
+
+        if is_sneaker_result:
+            confidence = "high" if shoe_prob >= 0.85 else "medium"
+        else:
+            confidence = "high" if shoe_prob <= 0.30 else "medium"
+
+        results.append({
+            "is_sneaker": is_sneaker_result,
+            "probability": round(shoe_prob, 3),
+            "confidence": confidence
+        })
+    return results
 
 
 # ==== USAGE ====
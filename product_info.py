@@ -1,10 +1,9 @@
-import pandas as pd
+from ai.catalog import CLASS_COLUMN, PRODUCTS_CSV, product_by_class
 
-# point to ai/products_nodup.csv (scraped data)
-CSV_PATH = "ai/products_nodup.csv"
+# products_nodup.csv (scraped data) is loaded once by ai/catalog.py
+CSV_PATH = str(PRODUCTS_CSV)
 
 # Column names from your screenshot
-CLASS_COLUMN = "class_name"
 NAME_COLUMN = "title"
 BRAND_COLUMN = "brand"
 RETAIL_COLUMN = "retail_price_usd"
@@ -13,32 +12,15 @@ URL_COLUMN = "product_url"
 RELEASE_COLUMN = "release_date"
 SILHOUETTE_COLUMN = "silhouette"
 
-# Load CSV once
-try:
-    df = pd.read_csv(CSV_PATH)
-    print("[CSV] Loaded products_nodup.csv successfully")
-except FileNotFoundError:
-    df = None
-    print(f"[CSV] ERROR: File {CSV_PATH} not found")
-
 
 def get_product_info(class_name: str) -> dict:
-    if df is None:
-        return _empty_result(class_name)
-
-    if CLASS_COLUMN not in df.columns:
+    # first catalog row of the predicted class (dict lookup, no DataFrame scan)
+    r = product_by_class(class_name)
+    if r is None:
         return _empty_result(class_name)
 
-    # Filter by predicted class
-    rows = df[df[CLASS_COLUMN] == class_name]
-
-    if rows.empty:
-        return _empty_result(class_name)
-
-    r = rows.iloc[0]
-
     def safe(col):
-        return r[col] if col in df.columns else None
+        return r.get(col)
 
     return {
         "class_name": class_name,
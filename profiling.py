@@ -0,0 +1,209 @@
+"""
+On-demand profiling of a single request (opt-in, off by default).
+
+With PROFILING_ENABLED=1, /predict?profile=1 (or the header "X-Profile: 1") runs
+that one request under cProfile (the request thread plus the stage-pool stages it
+starts) and torch.profiler (model forwards, including the micro-batcher threads).
+Artifacts go to PROFILE_DIR (the oldest are deleted beyond PROFILE_MAX_FILES):
+
+    <stamp>-<ms>-<id>-<tag>.prof         pstats dump (snakeviz / python -m pstats)
+    <stamp>-<ms>-<id>-<tag>.trace.json   torch trace (chrome://tracing, Perfetto)
+
+and the response gets a "profile" block with the top Python hotspots and torch ops.
+If PROFILE_TOKEN is set, the request must also send it as "X-Profile-Token".
+Only one request is profiled at a time; others run normally. torch.profiler is
+process-wide, though: the trace and the torch ops also contain forwards of other
+requests that ran meanwhile (they share batched forwards with this one anyway).
+The summary says so in its notes.
+"""
+import contextvars
+import cProfile
+import hmac
+import io
+import os
+import pstats
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+BASE_DIR = Path(__file__).resolve().parent
+
+PROFILING_ENABLED = os.environ.get("PROFILING_ENABLED", "0") in {"1", "true", "True", "yes"}
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN", "")
+PROFILE_DIR = Path(os.environ.get("PROFILE_DIR", str(BASE_DIR / "profiles")))
+PROFILE_TOP_N = int(os.environ.get("PROFILE_TOP_N", "20"))
+PROFILE_TORCH = os.environ.get("PROFILE_TORCH", "1") not in {"0", "false", "False", "no"}
+# artifacts kept in PROFILE_DIR (0 = keep everything)
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "50"))
+
+TORCH_SCOPE_NOTE = "torch ops are process-wide: they include other requests' model forwards during this one"
+
+_busy = threading.Lock()
+_session: contextvars.ContextVar = contextvars.ContextVar("profile_session", default=None)
+
+
+def requested(args, headers) -> bool:
+    """True if this request asks for a profile and is allowed to get one."""
+    if not PROFILING_ENABLED:
+        return False
+    if args.get("profile") not in {"1", "true", "True", "yes"} and headers.get("X-Profile") != "1":
+        return False
+    if PROFILE_TOKEN and not hmac.compare_digest(headers.get("X-Profile-Token", ""), PROFILE_TOKEN):
+        return False
+    return True
+
+
+class ProfileSession:
+    """cProfile of the calling thread (+ stage threads via run_profiled) and a torch.profiler trace."""
+
+    def __init__(self, tag: str = "request"):
+        self.tag = "".join(c if c.isalnum() or c in "-_" else "_" for c in tag)[:40]
+        self.profiles = [cProfile.Profile()]
+        self.torch_prof = None
+        self.notes = []
+        self._lock = threading.Lock()
+        self._token = None
+        self._start = 0.0
+
+    def start(self):
+        self._token = _session.set(self)
+        if PROFILE_TORCH:
+            try:
+                from torch.profiler import ProfilerActivity, profile
+
+                self.torch_prof = profile(activities=[ProfilerActivity.CPU], record_shapes=True)
+                self.torch_prof.__enter__()
+                self.notes.append(TORCH_SCOPE_NOTE)
+            except Exception as exc:
+                self.torch_prof = None
+                self.notes.append(f"torch.profiler unavailable: {exc}")
+        self._start = time.perf_counter()
+        self.profiles[0].enable()
+
+    def stop(self):
+        self.profiles[0].disable()
+        self.wall_ms = (time.perf_counter() - self._start) * 1000
+        if self.torch_prof is not None:
+            self.torch_prof.__exit__(None, None, None)
+        _session.reset(self._token)
+
+    def add(self, prof: cProfile.Profile):
+        with self._lock:
+            self.profiles.append(prof)
+
+    # ---- artifacts ----
+    def _stats(self) -> Optional[pstats.Stats]:
+        stats = None
+        for prof in self.profiles:
+            try:
+                if stats is None:
+                    stats = pstats.Stats(prof, stream=io.StringIO())
+                else:
+                    stats.add(prof)
+            except TypeError:  # profile that never ran
+                continue
+        return stats
+
+    def save(self) -> dict:
+        """Write the artifacts and return the summary for the response."""
+        PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+        now = time.time()
+        stamp = f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(now))}-{int(now * 1000) % 1000:03d}"
+        base = PROFILE_DIR / f"{stamp}-{uuid.uuid4().hex[:6]}-{self.tag}"
+        summary = {"wall_ms": round(self.wall_ms, 2), "files": {}, "python": [], "torch": []}
+
+        stats = self._stats()
+        if stats is not None:
+            stats.dump_stats(str(base.with_suffix(".prof")))
+            summary["files"]["cprofile"] = str(base.with_suffix(".prof"))
+            rows = sorted(stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)  # cumulative
+            for (filename, line, func), (_, ncalls, tottime, cumtime, _) in rows[:PROFILE_TOP_N]:
+                summary["python"].append({
+                    "function": f"{Path(filename).name}:{line}({func})",
+                    "calls": ncalls,
+                    "self_ms": round(tottime * 1000, 2),
+                    "cumulative_ms": round(cumtime * 1000, 2),
+                })
+
+        if self.torch_prof is not None:
+            trace = base.with_suffix(".trace.json")
+            try:
+                self.torch_prof.export_chrome_trace(str(trace))
+                summary["files"]["torch_trace"] = str(trace)
+                events = sorted(self.torch_prof.key_averages(), key=lambda e: e.self_cpu_time_total, reverse=True)
+                for e in events[:PROFILE_TOP_N]:
+                    summary["torch"].append({
+                        "op": e.key,
+                        "calls": e.count,
+                        "self_cpu_ms": round(e.self_cpu_time_total / 1000, 2),
+                        "cpu_ms": round(e.cpu_time_total / 1000, 2),
+                    })
+            except Exception as exc:
+                self.notes.append(f"torch trace export failed: {exc}")
+
+        if self.notes:
+            summary["notes"] = self.notes
+        print(f"[PROFILE] Wrote {base.name} ({summary['wall_ms']:.0f} ms)")
+        _prune()
+        return summary
+
+
+def _prune(max_files: int = PROFILE_MAX_FILES):
+    """Delete the oldest artifacts so PROFILE_DIR holds at most max_files."""
+    if max_files <= 0:
+        return
+    files = []
+    for p in PROFILE_DIR.iterdir():
+        if p.name.endswith((".prof", ".trace.json")):
+            try:
+                files.append((p.stat().st_mtime, p))
+            except OSError:
+                continue
+    files.sort(reverse=True)  # newest first
+    for _, p in files[max_files:]:
+        try:
+            p.unlink()
+        except OSError:
+            pass
+
+
+def try_start(tag: str) -> Optional[ProfileSession]:
+    """Start a session unless one is already running (then None: serve the request unprofiled)."""
+    if not _busy.acquire(blocking=False):
+        return None
+    session = ProfileSession(tag)
+    try:
+        session.start()
+    except Exception:
+        _busy.release()
+        raise
+    return session
+
+
+def finish(session: ProfileSession) -> dict:
+    try:
+        session.stop()
+        return session.save()
+    finally:
+        _busy.release()
+
+
+def run_profiled(fn, *args):
+    """Call fn; when the current context belongs to a profiled request, under its own cProfile."""
+    session = _session.get()
+    if session is None:
+        return fn(*args)
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError as exc:  # Python 3.12+: one profiler per process, already covering this thread
+        if str(exc) not in session.notes:
+            session.notes.append(str(exc))
+        return fn(*args)
+    try:
+        return fn(*args)
+    finally:
+        prof.disable()
+        session.add(prof)
@@ -0,0 +1,201 @@
+"""
+Classification from the CLIP embedding we already compute for the gate and FAISS.
+
+Each class is represented by the centroid of the normalized CLIP vectors in its
+FAISS index; the query is scored against every centroid with one matmul and the
+cosines are turned into probabilities with CLIP's logit scale. Centroids are
+cached on disk (faiss_cache/prototypes.pkl) and a class is recomputed only when
+its index_version changes.
+
+CLASSIFIER_MODE:
+    resnet     ResNet50 only (default, previous behaviour)
+    prototype  centroids only; the ResNet is never run
+    cascade    centroids first, ResNet50 only when the top-1/top-2 cosine margin is
+               below PROTOTYPE_MARGIN or too few classes have an index
+"""
+import json
+import os
+import pickle
+import threading
+import time
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from faiss_search import INDEX_CACHE_DIR, index_version, is_cached, load_class_vectors
+
+BASE_DIR = Path(__file__).resolve().parent
+CLASS_INDICES_PATH = BASE_DIR / "ai" / "class_indices.json"
+PROTOTYPES_FILE = INDEX_CACHE_DIR / "prototypes.pkl"
+
+CLASSIFIER_MODE = os.environ.get("CLASSIFIER_MODE", "resnet")
+# cosine gap between the best and second-best centroid needed to skip the ResNet
+PROTOTYPE_MARGIN = float(os.environ.get("PROTOTYPE_MARGIN", "0.02"))
+# share of classes that must have an index before the cascade trusts the centroids
+PROTOTYPE_MIN_COVERAGE = float(os.environ.get("PROTOTYPE_MIN_COVERAGE", "0.9"))
+# softmax temperature for the cosines (0 = CLIP's own logit scale, ~100)
+PROTOTYPE_SCALE = float(os.environ.get("PROTOTYPE_SCALE", "0"))
+PROTOTYPE_CHECK_SECONDS = float(os.environ.get("PROTOTYPE_CHECK_SECONDS", "30"))
+
+with open(CLASS_INDICES_PATH, "r") as f:
+    class_to_idx: Dict[str, int] = json.load(f)
+
+_lock = threading.Lock()
+# entries: class -> (index_version, centroid). proto: (classes, matrix) with matrix rows
+# following classes, published as ONE tuple so readers never pair new classes with an old matrix
+_state = {"entries": None, "proto": ([], None), "checked": 0.0, "scale": None}
+_stats = {"prototype": 0, "resnet": 0}
+
+
+def _load_file() -> Dict[str, Tuple[str, np.ndarray]]:
+    try:
+        with open(PROTOTYPES_FILE, "rb") as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError):
+        return {}
+
+
+def _save_file(entries: Dict[str, Tuple[str, np.ndarray]]):
+    """Best effort (runs on the request path): a failed save only means recomputing later."""
+    # per process/thread tmp name: workers refreshing at the same time each rename their own file
+    tmp = PROTOTYPES_FILE.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+        with open(tmp, "wb") as f:
+            pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        tmp.replace(PROTOTYPES_FILE)
+    except OSError as exc:
+        print(f"[PROTO] Could not save {PROTOTYPES_FILE.name}: {exc}")
+        try:
+            tmp.unlink()
+        except OSError:
+            pass
+
+
+def _centroid(class_name: str) -> Optional[np.ndarray]:
+    _, vectors, _ = load_class_vectors(class_name)
+    if not len(vectors):
+        return None
+    vectors = vectors / np.linalg.norm(vectors, axis=1, keepdims=True).clip(min=1e-12)
+    c = vectors.mean(axis=0)
+    return (c / max(np.linalg.norm(c), 1e-12)).astype("float32")
+
+
+def refresh_prototypes() -> dict:
+    """Recompute the centroids of classes whose index changed since the last call."""
+    with _lock:
+        entries = _state["entries"] if _state["entries"] is not None else _load_file()
+        start = time.perf_counter()
+        changed = 0
+        for class_name in class_to_idx:
+            if not is_cached(class_name):
+                if entries.pop(class_name, None) is not None:
+                    changed += 1
+                continue
+            # None for a class that only has a legacy .pkl: reading its vectors migrates it
+            version = index_version(class_name)
+            if version is not None and entries.get(class_name, (None,))[0] == version:
+                continue
+            try:
+                centroid = _centroid(class_name)
+            except Exception as exc:
+                print(f"[PROTO] Could not read {class_name} index: {exc}")
+                continue
+            version = version or index_version(class_name)
+            if centroid is not None and version is not None:
+                entries[class_name] = (version, centroid)
+                changed += 1
+        if changed or _state["proto"][1] is None:
+            classes = sorted(entries, key=class_to_idx.get)
+            matrix = np.vstack([entries[c][1] for c in classes]) if classes else None
+            _state["proto"] = (classes, matrix)
+            if changed:
+                _save_file(entries)
+                print(f"[PROTO] Updated {changed} class centroids in {time.perf_counter() - start:.2f}s")
+        _state["entries"] = entries
+        _state["checked"] = time.monotonic()
+        return prototype_stats()
+
+
+def _prototypes():
+    if _state["entries"] is None or time.monotonic() - _state["checked"] > PROTOTYPE_CHECK_SECONDS:
+        refresh_prototypes()
+    return _state["proto"]
+
+
+def _scale() -> float:
+    if PROTOTYPE_SCALE:
+        return PROTOTYPE_SCALE
+    if _state["scale"] is None:
+        from ai.clip_features import logit_scale
+
+        _state["scale"] = logit_scale()
+    return _state["scale"]
+
+
+def prototype_probabilities(embedding: np.ndarray) -> Optional[Tuple[List[float], float]]:
+    """
+    Normalized CLIP embedding -> (probabilities aligned with class_indices.json, top-1/top-2
+    cosine margin); None when no class index exists yet. Classes without an index get 0.
+    """
+    classes, matrix = _prototypes()
+    if matrix is None:
+        return None
+    q = np.asarray(embedding, dtype="float32").reshape(-1)
+    q = q / max(np.linalg.norm(q), 1e-12)
+    cos = matrix @ q
+    top2 = np.sort(cos)[-2:]
+    margin = float(top2[-1] - top2[0]) if len(cos) > 1 else 1.0
+    logits = _scale() * cos
+    p = np.exp(logits - logits.max())
+    p /= p.sum()
+    probs = [0.0] * len(class_to_idx)
+    for class_name, value in zip(classes, p.tolist()):
+        probs[class_to_idx[class_name]] = value
+    return probs, margin
+
+
+def _coverage() -> float:
+    return len(_state["proto"][0]) / max(len(class_to_idx), 1)
+
+
+def _prototype_result(embedding: np.ndarray, mode: str) -> Optional[List[float]]:
+    """Centroid probabilities if `mode` accepts them for this query, else None (use the ResNet)."""
+    if mode not in {"prototype", "cascade"}:
+        return None
+    scored = prototype_probabilities(embedding)
+    if scored is None:
+        return None
+    probs, margin = scored
+    if mode == "cascade" and (margin < PROTOTYPE_MARGIN or _coverage() < PROTOTYPE_MIN_COVERAGE):
+        return None
+    return probs
+
+
+def classify(embedding: np.ndarray, resnet_probs: Callable[[], List[float]], mode: str = None):
+    """
+    Class probabilities for one query under CLASSIFIER_MODE.
+    resnet_probs() is only called when the ResNet is needed.
+    Returns (probs, "prototype" | "resnet").
+    """
+    probs = _prototype_result(embedding, mode or CLASSIFIER_MODE)
+    if probs is not None:
+        _stats["prototype"] += 1
+        return probs, "prototype"
+    _stats["resnet"] += 1
+    return resnet_probs(), "resnet"
+
+
+def needs_resnet(embedding: np.ndarray, mode: str = None) -> bool:
+    """Cheap pre-check (one matmul): would classify() run the ResNet for this query?"""
+    return _prototype_result(embedding, mode or CLASSIFIER_MODE) is None
+
+
+def prototype_stats() -> dict:
+    return {
+        "mode": CLASSIFIER_MODE,
+        "classes": len(_state["proto"][0]),
+        "coverage": round(_coverage(), 3),
+        "margin": PROTOTYPE_MARGIN,
+        **_stats,
+    }
@@ -0,0 +1,255 @@
+"""
+Per-image result cache keyed by the sha256 of the uploaded bytes.
+A repeated upload (re-submit, duplicate listing, retry after a timeout) reuses the
+CLIP embedding, gate result, class probabilities and similarity results instead of
+running the models again.
+
+Entries look like:
+    {"created": ts, "embedding": [...], "gate": {"sig": ..., "result": {...}},
+     "probs": [...], "similar": {"<scope key>": {"version": ..., "result": {...}}}}
+
+Similarity results carry the FAISS index version they were computed against
+(faiss_search.index_version); after a rebuild/refresh of that index they no
+longer match and are recomputed. Entries are stored per PIPELINE_TAG (CLIP
+preprocessing, CLIP_BACKEND, CLASSIFIER_BACKEND): embeddings and probabilities
+from an fp32 run are never served to an int8/bf16 one, and vice versa.
+
+Backend (RESULT_CACHE_BACKEND): memory (default), disk (RESULT_CACHE_DIR),
+mongo (collection in the inventory database, shared by all workers) or off.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional
+
+from ai.backends import CLASSIFIER_BACKEND, CLIP_BACKEND
+from ai.metrics import inc
+from ai.utils import CLIP_PREPROCESS_VERSION
+
+BASE_DIR = Path(__file__).resolve().parent
+
+RESULT_CACHE_BACKEND = os.environ.get("RESULT_CACHE_BACKEND", "memory")
+RESULT_CACHE_TTL = float(os.environ.get("RESULT_CACHE_TTL", str(24 * 3600)))  # seconds, 0 = no expiry
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "2000"))
+RESULT_CACHE_DIR = Path(os.environ.get("RESULT_CACHE_DIR", str(BASE_DIR / "result_cache")))
+RESULT_CACHE_COLLECTION = "result_cache"
+PIPELINE_TAG = f"{CLIP_PREPROCESS_VERSION}-{CLIP_BACKEND}-{CLASSIFIER_BACKEND}"
+
+
+def _expired(entry: dict) -> bool:
+    return bool(RESULT_CACHE_TTL) and time.time() - entry.get("created", 0) > RESULT_CACHE_TTL
+
+
+class MemoryBackend:
+    """Process-local LRU."""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._data: "OrderedDict[str, dict]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                self._data.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: dict):
+        with self._lock:
+            self._data[key] = entry
+            self._data.move_to_end(key)
+            while self.max_entries and len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def delete(self, key: str):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class DiskBackend:
+    """One JSON file per image under RESULT_CACHE_DIR; survives restarts."""
+
+    CLEANUP_EVERY = 100  # writes between size sweeps
+
+    def __init__(self, root: Path, max_entries: int):
+        self.root = root
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self._writes = 0
+
+    def _file(self, key: str) -> Path:
+        return self.root / f"{key}.json"
+
+    def get(self, key: str) -> Optional[dict]:
+        try:
+            with open(self._file(key), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def put(self, key: str, entry: dict):
+        path = self._file(key)
+        tmp = path.with_suffix(f".{threading.get_ident()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(entry, f)
+        tmp.replace(path)
+        self._writes += 1
+        if self._writes % self.CLEANUP_EVERY == 0:
+            self._cleanup()
+
+    def delete(self, key: str):
+        try:
+            self._file(key).unlink()
+        except OSError:
+            pass
+
+    def _cleanup(self):
+        files = []
+        for p in self.root.glob("*.json"):
+            try:
+                files.append((p.stat().st_mtime, p))
+            except OSError:
+                continue
+        files.sort(reverse=True)  # newest first
+        now = time.time()
+        for n, (mtime, p) in enumerate(files):
+            too_old = RESULT_CACHE_TTL and now - mtime > RESULT_CACHE_TTL
+            if too_old or (self.max_entries and n >= self.max_entries):
+                try:
+                    p.unlink()
+                except OSError:
+                    pass
+
+    def __len__(self):
+        return sum(1 for _ in self.root.glob("*.json"))
+
+
+class MongoBackend:
+    """Collection next to the inventory; expiry handled by a Mongo TTL index."""
+
+    def __init__(self):
+        from inventory import get_db
+
+        self.col = get_db()[RESULT_CACHE_COLLECTION]
+        if RESULT_CACHE_TTL:
+            self.col.create_index("created_at", expireAfterSeconds=int(RESULT_CACHE_TTL))
+
+    def get(self, key: str) -> Optional[dict]:
+        doc = self.col.find_one({"_id": key})
+        return doc["entry"] if doc else None
+
+    def put(self, key: str, entry: dict):
+        from datetime import datetime
+
+        self.col.replace_one(
+            {"_id": key}, {"_id": key, "entry": entry, "created_at": datetime.utcnow()}, upsert=True
+        )
+
+    def delete(self, key: str):
+        self.col.delete_one({"_id": key})
+
+    def __len__(self):
+        return self.col.estimated_document_count()
+
+
+def _make_backend():
+    if RESULT_CACHE_BACKEND == "off":
+        return None
+    if RESULT_CACHE_BACKEND == "disk":
+        return DiskBackend(RESULT_CACHE_DIR, RESULT_CACHE_MAX_ENTRIES)
+    if RESULT_CACHE_BACKEND == "mongo":
+        return MongoBackend()
+    return MemoryBackend(RESULT_CACHE_MAX_ENTRIES)
+
+
+_backend = None
+_backend_lock = threading.Lock()
+_stats = {"hits": 0, "misses": 0, "stale_similar": 0}
+# read-modify-write of one entry from concurrent stages
+_write_lock = threading.Lock()
+
+
+def _key(image_id: str) -> str:
+    return f"{image_id}.{PIPELINE_TAG}"
+
+
+def _get_backend():
+    """Created on first use (the mongo backend connects to the server)."""
+    global _backend
+    if _backend is None and RESULT_CACHE_BACKEND != "off":
+        with _backend_lock:
+            if _backend is None:
+                _backend = _make_backend()
+    return _backend
+
+
+def lookup(image_id: str) -> dict:
+    """Cached entry for an image (empty dict on miss/expiry)."""
+    backend = _get_backend()
+    if backend is None or not image_id:
+        return {}
+    entry = backend.get(_key(image_id))
+    if entry is None or _expired(entry):
+        _stats["misses"] += 1
+        inc("result_cache_total", result="miss")
+        return {}
+    _stats["hits"] += 1
+    inc("result_cache_total", result="hit")
+    return entry
+
+
+def store(image_id: str, **fields):
+    """Merge fields (embedding, gate, probs, ...) into the image's entry."""
+    backend = _get_backend()
+    if backend is None or not image_id:
+        return
+    with _write_lock:
+        entry = backend.get(_key(image_id))
+        if entry is None or _expired(entry):
+            entry = {"created": time.time()}
+        entry.update(fields)
+        backend.put(_key(image_id), entry)
+
+
+def cached_similar(entry: dict, scope_key: str, version: Optional[str]) -> Optional[dict]:
+    """Similarity result for scope_key, only if computed against the current index version."""
+    hit = entry.get("similar", {}).get(scope_key)
+    if hit is None or version is None:
+        return None
+    if hit.get("version") != version:
+        _stats["stale_similar"] += 1
+        return None
+    return hit["result"]
+
+
+def store_similar(image_id: str, scope_key: str, version: Optional[str], result: dict):
+    backend = _get_backend()
+    if backend is None or not image_id or version is None:
+        return
+    with _write_lock:
+        entry = backend.get(_key(image_id))
+        if entry is None or _expired(entry):
+            entry = {"created": time.time()}
+        entry.setdefault("similar", {})[scope_key] = {"version": version, "result": result}
+        backend.put(_key(image_id), entry)
+
+
+def invalidate(image_id: str):
+    backend = _get_backend()
+    if backend is not None:
+        backend.delete(_key(image_id))
+
+
+def result_cache_stats() -> dict:
+    if RESULT_CACHE_BACKEND == "off":
+        return {"backend": "off"}
+    if _backend is None:
+        return {"backend": RESULT_CACHE_BACKEND, "entries": 0, **_stats}
+    return {"backend": RESULT_CACHE_BACKEND, "entries": len(_backend), **_stats}
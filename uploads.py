@@ -0,0 +1,171 @@
+"""
+In-memory handling of uploaded images.
+An upload is read and decoded once from the request stream; every pipeline stage
+gets the same decoded PIL image. Bytes are only written to disk when needed
+(PERSIST_UPLOADS=1, or when an item is added to the inventory), under a
+content-addressed name so re-uploads dedupe instead of overwriting each other.
+
+The in-memory copy behind an image_id is per process: with several workers,
+/add-to-inventory may land on a worker that never saw the upload. Run such
+deployments with PERSIST_UPLOADS=1 (UPLOAD_DIR shared by the workers). An
+image_id that cannot be resolved still saves the item, and the response says
+image_attached: false with a warning.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Tuple
+
+from ai.utils import decode_image
+
+BASE_DIR = Path(__file__).resolve().parent
+UPLOAD_DIR = BASE_DIR / "uploads"
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+PERSIST_UPLOADS = os.environ.get("PERSIST_UPLOADS", "0") in {"1", "true", "True", "yes"}
+# retention for persisted files (0 disables the respective limit)
+UPLOAD_RETENTION_HOURS = float(os.environ.get("UPLOAD_RETENTION_HOURS", "72"))
+UPLOAD_MAX_FILES = int(os.environ.get("UPLOAD_MAX_FILES", "5000"))
+# recent upload bytes kept in memory so /add-to-inventory can attach them later
+RECENT_UPLOADS_MAX_MB = float(os.environ.get("RECENT_UPLOADS_MAX_MB", "256"))
+
+CONTENT_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png"}
+CLEANUP_EVERY = 50  # persists between retention sweeps
+
+
+class Upload:
+    """One uploaded image: raw bytes, content hash and the decoded (working-size) RGB image."""
+
+    def __init__(self, data: bytes, ext: str, filename: str = ""):
+        self.data = data
+        self.ext = ext
+        self.filename = filename
+        self.sha256 = hashlib.sha256(data).hexdigest()
+        self.image = decode_image(data)
+
+    @property
+    def image_id(self) -> str:
+        return self.sha256
+
+    @property
+    def content_type(self) -> str:
+        return CONTENT_TYPES.get(self.ext, "application/octet-stream")
+
+
+_recent: "OrderedDict[str, Tuple[bytes, str]]" = OrderedDict()
+_recent_bytes = 0
+_lock = threading.Lock()
+_persist_count = 0
+
+
+def _remember(upload: Upload):
+    global _recent_bytes
+    limit = int(RECENT_UPLOADS_MAX_MB * 1024 * 1024)
+    with _lock:
+        if upload.sha256 in _recent:
+            _recent.move_to_end(upload.sha256)
+            return
+        _recent[upload.sha256] = (upload.data, upload.ext)
+        _recent_bytes += len(upload.data)
+        while _recent_bytes > limit and len(_recent) > 1:
+            _, (data, _) = _recent.popitem(last=False)
+            _recent_bytes -= len(data)
+
+
+def read_upload(file) -> Upload:
+    """Read a werkzeug FileStorage into memory and decode it once."""
+    ext = file.filename.split(".")[-1].lower()
+    upload = Upload(file.read(), ext, filename=file.filename)
+    _remember(upload)
+    if PERSIST_UPLOADS:
+        try:
+            persist_upload(upload.sha256, upload.data, upload.ext)
+        except OSError as exc:  # the image itself is fine; keep serving it from memory
+            print(f"[UPLOADS] Could not persist {upload.sha256}: {exc}")
+    return upload
+
+
+def _stored_path(image_id: str) -> Optional[Path]:
+    matches = list(UPLOAD_DIR.glob(f"{image_id}.*"))
+    return matches[0] if matches else None
+
+
+def persist_upload(image_id: str, data: bytes, ext: str) -> Path:
+    """Write bytes as uploads/<sha256>.<ext> (no-op if already stored)."""
+    global _persist_count
+    path = UPLOAD_DIR / f"{image_id}.{ext}"
+    if path.exists():
+        try:
+            os.utime(path)  # refresh retention clock
+        except OSError:
+            pass
+    else:
+        # unique tmp per writer: concurrent identical uploads (other threads or
+        # workers) each rename their own complete copy onto the same content
+        with tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, prefix=f".{image_id}.", suffix=".tmp", delete=False) as f:
+            f.write(data)
+            tmp = Path(f.name)
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            tmp.unlink(missing_ok=True)
+            if not path.exists():
+                raise
+    with _lock:
+        _persist_count += 1
+        sweep = _persist_count % CLEANUP_EVERY == 0
+    if sweep:
+        cleanup_uploads()
+    return path
+
+
+def get_upload_bytes(image_id: str) -> Optional[Tuple[bytes, str]]:
+    """(bytes, content_type) of a recent or persisted upload, or None."""
+    if not image_id or not all(c in "0123456789abcdef" for c in image_id):
+        return None
+    with _lock:
+        hit = _recent.get(image_id)
+    if hit is not None:
+        data, ext = hit
+        persist_upload(image_id, data, ext)
+        return data, CONTENT_TYPES.get(ext, "application/octet-stream")
+    path = _stored_path(image_id)
+    if path is None:
+        return None
+    return path.read_bytes(), CONTENT_TYPES.get(path.suffix.lstrip("."), "application/octet-stream")
+
+
+def cleanup_uploads(max_age_hours: float = None, max_files: int = None) -> int:
+    """Delete persisted uploads older than the retention window / beyond the file cap."""
+    max_age_hours = UPLOAD_RETENTION_HOURS if max_age_hours is None else max_age_hours
+    max_files = UPLOAD_MAX_FILES if max_files is None else max_files
+
+    files = []
+    for p in UPLOAD_DIR.iterdir():
+        if p.suffix == ".tmp":
+            continue  # being written right now
+        if p.is_file():
+            try:
+                files.append((p.stat().st_mtime, p))
+            except OSError:
+                continue
+    files.sort(reverse=True)  # newest first
+
+    now = time.time()
+    removed = 0
+    for n, (mtime, p) in enumerate(files):
+        too_old = max_age_hours and now - mtime > max_age_hours * 3600
+        too_many = max_files and n >= max_files
+        if too_old or too_many:
+            try:
+                p.unlink()
+                removed += 1
+            except OSError:
+                pass
+    if removed:
+        print(f"[UPLOADS] Removed {removed} old uploads")
+    return removed